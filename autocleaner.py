@@ -15,7 +15,8 @@ import psutil
 import ruamel.yaml
 import requests
 
-from tasks.constants import JOBS_DIR, UUID_RE
+from tasks.box_inventory import BoxInventory, scan_boxes
+from tasks.constants import BOX_INVENTORY_DB, JOBS_DIR, UUID_RE
 
 """
 PRCI auto-cleaner which takes care of unused Vagrant boxes and libvirt inmages,
@@ -31,9 +32,6 @@ logger.addHandler(consoleHandler)
 PRCI_CONFIG = '/root/.config/freeipa-pr-ci/config.yml'
 PRCI_DEF_DIR = 'ipatests/prci_definitions'
 LIBVIRT_IMAGES_DIR = '/var/lib/libvirt/images/'
-LIBVIRT_IMAGE_BASE = ('freeipa-VAGRANTSLASH-{name}_vagrant_box_image'
-                      '_{version}.img')
-VAGRANT_NO_BOXES = 'There are no installed boxes!'
 
 GH_RAW_PATH = 'https://raw.githubusercontent.com/{owner}/freeipa/{ref}/{path}'
 GH_GRAPHQL_API = 'https://api.github.com/graphql'
@@ -179,6 +177,14 @@ def del_dangling_libvirt_images():
     return imgs_deleted
 
 
+def get_box_inventory():
+    """
+    Get the inventory of Vagrant boxes shared with PRCI
+    """
+    return BoxInventory(
+        load_yaml(PRCI_CONFIG).get('box_inventory_db', BOX_INVENTORY_DB))
+
+
 def get_gh_token():
     """
     Get GH token from PRCI config file
@@ -191,14 +197,12 @@ def list_vagrant_boxes():
     List present Vagrant boxes which will be then deleted if not used
     on the branch it belongs to
     """
-    res = subprocess.check_output(['vagrant', 'box', 'list'],
-                                  timeout=TIMEOUT)
-    if VAGRANT_NO_BOXES in res.decode():
+    all_boxes = scan_boxes(images_dir=LIBVIRT_IMAGES_DIR)
+    if not all_boxes:
         logger.info('No vagrant boxes found...')
-        return []
 
-    all_boxes = res.decode().strip().split('\n')
-    return [x for x in all_boxes if x.startswith(CI_PREFIX_ID)]
+    return [x for x in all_boxes
+            if x.name.startswith(CI_PREFIX_ID) and x.provider == 'libvirt']
 
 
 class PRCIDef():
@@ -281,11 +285,15 @@ class PRCIDef():
 class Box():
 
     def __init__(self, box):
-        name, ver = box.split(' ', 1)
+        name = box.name
         self.box_templ_name = name
-        self.box_templ_ver = ver.split()[-1][:-1]
+        self.box_templ_ver = box.version
+        self.libvirt_images = box.images
         self.branch = name[name.find('-')+1:name.rfind('-')]
 
+    def __str__(self):
+        return '{} ({})'.format(self.box_templ_name, self.box_templ_ver)
+
     def get_file_from_gh(self, path):
         repo_owner = load_yaml(PRCI_CONFIG)['repository']['owner']
         def_file_url = GH_RAW_PATH.format(owner=repo_owner,
@@ -338,14 +346,13 @@ class Box():
 
     def delete_libvirt_img(self):
         """
-        Delete libvirt image after its box was deleted
+        Delete libvirt images after their box was deleted
         """
-        name = self.box_templ_name.split('/')[-1]
-        del_args = ['virsh', 'vol-delete', '--pool', 'default',
-                    LIBVIRT_IMAGE_BASE.format(
-                        name=name, version=self.box_templ_ver)]
+        for image in self.libvirt_images:
+            del_args = ['virsh', 'vol-delete', '--pool', 'default',
+                        os.path.basename(image)]
 
-        subprocess.run(del_args, timeout=TIMEOUT)
+            subprocess.run(del_args, timeout=TIMEOUT)
 
 
 def create_parser():
@@ -359,6 +366,14 @@ def create_parser():
         '--jobs_dir_exp', type=int, help='Number of days after which task job '
         'directories are deleted',
     )
+    parser.add_argument(
+        '--pin_box', nargs=2, metavar=('NAME', 'VERSION'),
+        help='Never delete the Vagrant box, then exit',
+    )
+    parser.add_argument(
+        '--unpin_box', nargs=2, metavar=('NAME', 'VERSION'),
+        help='Allow deleting a pinned Vagrant box again, then exit',
+    )
 
     return parser
 
@@ -368,13 +383,19 @@ def run(args):
     Run autocleaner
     """
 
+    inventory = get_box_inventory()
     for vagrant_box in list_vagrant_boxes():
-        logger.info('Checking if box %s is used', vagrant_box)
         box = Box(vagrant_box)
+        if inventory.pinned(box.box_templ_name, box.box_templ_ver, 'libvirt'):
+            logger.info('Box %s is pinned, keeping it', box)
+            continue
+        logger.info('Checking if box %s is used', box)
         if not box.is_box_used:
-            logger.info('Deleting %s', vagrant_box)
+            logger.info('Deleting %s (%d MiB)', box,
+                        vagrant_box.total_size // 2**20)
             box.delete_box()
             box.delete_libvirt_img()
+            inventory.remove(box.box_templ_name, box.box_templ_ver, 'libvirt')
 
     if args.jobs_dir_exp:
         # search old prci job dirs to be deleted
@@ -408,6 +429,12 @@ def main():
     parser = create_parser()
     args = parser.parse_args()
 
+    if args.pin_box or args.unpin_box:
+        name, version = args.pin_box or args.unpin_box
+        get_box_inventory().pin(name, version, 'libvirt',
+                                pinned=bool(args.pin_box))
+        return
+
     try:
         while True:
             if not is_qemu_running():
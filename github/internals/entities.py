@@ -1,11 +1,14 @@
 import operator
 import sys
+import threading
 from collections.abc import Callable as AbcCallable
 from datetime import datetime, timedelta
+from functools import partial
 from enum import Enum, unique
 from random import randint
-from time import sleep
-from typing import Callable, ByteString, Dict, List, Text, Tuple, SupportsFloat
+from time import sleep, time
+from typing import (Callable, ByteString, Dict, List, Optional, Text, Tuple,
+                    SupportsFloat)
 
 import psutil
 import pytz
@@ -19,8 +22,8 @@ import parse
 import raven
 from .gql import util, queries
 
-from tasks import tasks
-from tasks.common import TaskException
+from tasks import constants, durations, tasks
+from tasks.common import DependencyException, TaskException
 
 API_CHECK_TRIES = 5
 API_CHECK_SLEEP = 7
@@ -30,6 +33,9 @@ RERUN_PENDING = "pending for rerun"
 RERUN_PENDING_FMT = "pending for rerun by {runner_id} on {date}"
 TASK_TAKEN_FMT = "Taken by {runner_id} on {date}"
 TASK_LOCKED_FMT = "Locked by {runner_id} on {date}"
+# Taken before its dependencies finished, see Task.check_prestage
+TASK_PRESTAGED_FMT = "Taken by {runner_id} on {date} (prestaged)"
+PRESTAGED_SUFFIX = "(prestaged)"
 SENTRY_URL = (
     "https://d24d8d622cbb4e2ea447c9a64f19b81a:"
     "4db0ce47706f435bb3f8a02a0a1f2e22@sentry.io/193222"
@@ -39,6 +45,7 @@ SENTRY_URL = (
 # until the reset time will come.
 EPHEMERAL_LIMIT = 60
 STALE_TASK_EXTRA_TIME = 240
+PRESTAGE_POLL_INTERVAL = 60
 
 
 def sentry_report_exception(context: Dict):
@@ -144,9 +151,12 @@ class World(object):
     def __init__(
         self, graphql_request: Callable, github_api: GitHub,
         session: Session, repo_owner: Text, repo_name: Text,
-        runner_id: Text, tasks_path: Text, whitelist: List[Text]
+        runner_id: Text, tasks_path: Text, whitelist: List[Text],
+        prestage: bool=False, rerun_failed: bool=False,
+        shortest_first: bool=False, scratch: SupportsFloat=0,
+        scratch_in_ram: bool=False
     ) -> None:
-        self.available_resources = AvailableResources()
+        self.available_resources = AvailableResources(scratch, scratch_in_ram)
         self.graphql_request = graphql_request
         self.github_api = github_api
         self.session = session
@@ -155,6 +165,9 @@ class World(object):
         self.runner_id = runner_id
         self.tasks_path = tasks_path
         self.whitelist = whitelist
+        self.prestage = prestage
+        self.rerun_failed = rerun_failed
+        self.shortest_first = shortest_first
         self.instance = self
 
     def get_rate_limit(self, resource: Text=None) -> RateLimit:
@@ -251,7 +264,8 @@ class World(object):
 
 class Topology(object):
     def __init__(
-        self, name: Text=None, memory: SupportsFloat=None, cpu: int=None
+        self, name: Text=None, memory: SupportsFloat=None, cpu: int=None,
+        scratch_disk: SupportsFloat=None
     ) -> None:
         if memory is None:
             memory = AvailableResources.initial_memory
@@ -259,12 +273,16 @@ class Topology(object):
         self.memory = float(memory)
         self.name = name if name is not None else "undefined"
         self.cpu = cpu if cpu is not None else AvailableResources.initial_cpu
+        # MB of ephemeral disks on the runner's scratch pool, 0 if the
+        # topology's disks stay on the persistent pool
+        self.scratch_disk = float(scratch_disk or 0)
 
     def __eq__(self, other) -> bool:
         return all((
             self.name == other.name,
             self.memory == other.memory,
-            self.cpu == other.cpu
+            self.cpu == other.cpu,
+            self.scratch_disk == other.scratch_disk
         ))
 
     @staticmethod
@@ -275,7 +293,8 @@ class Topology(object):
         return Topology(
             name=dict_data.get("name"),
             memory=dict_data.get("memory"),
-            cpu=dict_data.get("cpu")
+            cpu=dict_data.get("cpu"),
+            scratch_disk=dict_data.get("scratch_disk")
         )
 
 
@@ -283,24 +302,49 @@ class AvailableResources(object):
     initial_cpu = psutil.cpu_count()
     initial_memory = psutil.virtual_memory().available / float(1024 ** 2)
 
-    def __init__(self) -> None:
+    def __init__(
+        self, scratch: SupportsFloat=0, scratch_in_ram: bool=False
+    ) -> None:
+        """
+        scratch: MB of the scratch pool of ephemeral disks, 0 if there is
+                 none
+        scratch_in_ram: whether the scratch pool is a tmpfs, so ephemeral
+                        disks take memory as well
+        """
         self.cpu = AvailableResources.initial_cpu
         self.memory = AvailableResources.initial_memory
+        self.scratch = float(scratch)
+        self.scratch_in_ram = scratch_in_ram
+        self.has_scratch = bool(scratch)
 
     def __str__(self) -> Text:
-        return "{cpu} CPU, {memory}MB".format(
+        text = "{cpu} CPU, {memory}MB".format(
             cpu=self.cpu, memory=self.memory
         )
+        if self.has_scratch:
+            text += ", {scratch}MB scratch".format(scratch=self.scratch)
+        return text
+
+    def needs(self, task: "Task") -> Tuple[int, float, float]:
+        """CPU, memory and scratch space the task takes"""
+        topology = task.topology
+        scratch = topology.scratch_disk if self.has_scratch else 0
+        memory = topology.memory + (scratch if self.scratch_in_ram else 0)
+        return topology.cpu, memory, scratch
 
     def check(self, task: "Task") -> bool:
+        cpu, memory, scratch = self.needs(task)
         return all([
-            self.cpu >= task.topology.cpu,
-            self.memory >= task.topology.memory
+            self.cpu >= cpu,
+            self.memory >= memory,
+            self.scratch >= scratch
         ])
 
     def __operate(self, task: "Task", op: Callable) -> None:
-        self.cpu = op(self.cpu, task.topology.cpu)
-        self.memory = op(self.memory, task.topology.memory)
+        cpu, memory, scratch = self.needs(task)
+        self.cpu = op(self.cpu, cpu)
+        self.memory = op(self.memory, memory)
+        self.scratch = op(self.scratch, scratch)
 
     def take(self, task: "Task") -> None:
         self.__operate(task, operator.sub)
@@ -347,6 +391,10 @@ class Status(Stateful):
     def taken(self) -> bool:
         return "taken" in self.description.lower()
 
+    @property
+    def prestaged(self) -> bool:
+        return self.description.endswith(PRESTAGED_SUFFIX)
+
     @property
     def locked(self) -> bool:
         return "locked" in self.description.lower()
@@ -373,9 +421,15 @@ class Status(Stateful):
         """Checks if commit status is timed out"""
         now = datetime.now(pytz.UTC)
 
-        if self.taken:
+        if self.prestaged:
+            format_string = TASK_PRESTAGED_FMT
+            timeout = timedelta(seconds=task.stale_timeout)
+            if not timeout:
+                return False
+            timeout += timedelta(seconds=constants.BUILD_TIMEOUT)
+        elif self.taken:
             format_string = TASK_TAKEN_FMT
-            timeout = timedelta(seconds=task.timeout)
+            timeout = timedelta(seconds=task.stale_timeout)
             if not timeout:
                 return False
         elif self.locked:
@@ -409,8 +463,11 @@ class Status(Stateful):
 
 class Commit(object):
     """Represents the commit with GitHub's statuses"""
-    def __init__(self, sha: Text, statuses_data: Dict) -> None:
+    def __init__(
+        self, sha: Text, statuses_data: Dict, tree_sha: Text=None
+    ) -> None:
         self.sha = sha
+        self.tree_sha = tree_sha
         self.statuses = {
             k: Status.from_dict(v) for k, v in statuses_data.items()
         }
@@ -425,7 +482,8 @@ class Commit(object):
         """Fabric for Commit"""
         return Commit(
             sha=util.get_commit_sha(data_dict),
-            statuses_data=util.get_statuses(data_dict)
+            statuses_data=util.get_statuses(data_dict),
+            tree_sha=util.get_commit_tree(data_dict)
         )
 
 
@@ -571,7 +629,8 @@ class Task(object):
     """Represents a task defined in a task file"""
     def __init__(
         self, name: Text, pr_number: int, commit_sha: Text, pr_author: Text,
-        repo_url: Text, task_data: Dict, job_handler: Callable
+        repo_url: Text, task_data: Dict, job_handler: Callable,
+        commit_tree: Text=None
     ) -> None:
         """Constructs the instance of a Task to be processed by the handler"""
         self.name = name
@@ -605,6 +664,7 @@ class Task(object):
         job_data["args"]["task_name"] = self.name
         job_data["args"]["pr_number"] = self.pr_number
         job_data["args"]["pr_author"] = self.pr_author
+        job_data["args"]["git_tree"] = commit_tree
 
         self.job = job_handler(
             job_data,
@@ -618,11 +678,38 @@ class Task(object):
         job_arguments_data = job_data["args"]
         self.timeout = job_arguments_data.get("timeout")
         topology_data = job_arguments_data.get("topology")
+        shards = job_arguments_data.get("shards") or 1
+        if isinstance(topology_data, dict) and shards > 1:
+            # every shard runs on its own instance of the topology
+            topology_data = dict(topology_data)
+            for key in ("cpu", "memory", "scratch_disk"):
+                if topology_data.get(key) is not None:
+                    topology_data[key] = topology_data[key] * shards
         if topology_data is None:
             self.topology = Topology()
         else:
             self.topology = Topology.from_dict(topology_data)
         self.description = ""
+        self.prestaged = False
+        self.duration_key = durations.duration_key(
+            self.name, job_arguments_data.get("template"), topology_data
+        )
+
+    @property
+    def stale_timeout(self) -> int:
+        """Seconds after which a taken task is considered stale
+
+        The task's timeout, or less when the task is known to finish much
+        sooner: STALE_P99_FACTOR times the 99th percentile of its durations,
+        but at least STALE_TIMEOUT_MIN.
+        """
+        timeout = self.timeout or 0
+        estimate = durations.estimate(self.duration_key)
+        if estimate is None:
+            return timeout
+        p99 = max(int(estimate[99] * constants.STALE_P99_FACTOR),
+                  constants.STALE_TIMEOUT_MIN)
+        return min(timeout, p99) if timeout else p99
 
     def check_dependencies(self, statuses: Dict=None) -> bool:
         """Checks if the dependent tasks are done
@@ -650,6 +737,73 @@ class Task(object):
 
         return all(inner())
 
+    def check_prestage(self, statuses: Dict=None) -> bool:
+        """Checks if the task can be started before its dependencies finish
+
+        A test job spends minutes bringing up its VMs before it needs the
+        RPMs of the build, so it can be started while the build is being
+        processed, see RunPytest.before_provision.
+        """
+        if statuses is None:
+            statuses = dict()
+
+        if not self.job.prestageable:
+            return False
+
+        def inner():
+            for d in self.dependencies:
+                status = statuses.get(d)
+                if status is not None:
+                    yield status.succeeded or (status.pending and status.taken)
+                else:
+                    yield False
+
+        return all(inner())
+
+    def wait_for_dependencies(
+        self, world: World, deadline: float=None,
+        cancelled: threading.Event=None
+    ) -> Optional[Dict]:
+        """Waits until the dependent tasks finish
+
+        Args:
+            deadline: time.time() after which waiting is given up,
+                      defaults to BUILD_TIMEOUT from now
+            cancelled: event set when the waiting job is terminated
+
+        Returns:
+            dict: JobResult of every dependency, None if any of them failed.
+
+        Raises:
+            DependencyException: deadline passed or the job was terminated
+        """
+        if deadline is None:
+            deadline = time() + constants.BUILD_TIMEOUT
+        if cancelled is None:
+            cancelled = threading.Event()
+
+        while True:
+            results = {}
+            for dep in self.dependencies:
+                status = world.poll_status(self.pr_number, dep)
+                if status.failed:
+                    return None
+                if not status.succeeded:
+                    break
+                results[dep] = JobResult(
+                    status.state, status.description, status.target_url
+                )
+            else:
+                return results
+
+            if time() >= deadline:
+                raise DependencyException(
+                    self, 'timed out waiting for dependencies')
+            if cancelled.wait(min(PRESTAGE_POLL_INTERVAL,
+                                  max(deadline - time(), 0))):
+                raise DependencyException(
+                    self, 'terminated while waiting for dependencies')
+
     def lock(self, world: World) -> None:
         """Creates a commit status on GitHub using REST API
 
@@ -693,7 +847,8 @@ class Task(object):
 
         # Taking task
         time_now = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-        description = TASK_TAKEN_FMT.format(
+        taken_format = TASK_PRESTAGED_FMT if self.prestaged else TASK_TAKEN_FMT
+        description = taken_format.format(
             runner_id=world.runner_id,
             date=time_now
         )
@@ -743,12 +898,22 @@ class Task(object):
             runner_id=world.runner_id,
             date=time_now
         )
-        world.create_status(self, State.PENDING, description)
+        # keep the link to the failed run, the re-run can use its results
+        target_url = status.target_url if status.failed else ""
+        world.create_status(self, State.PENDING, description, target_url)
 
     def execute(self, world: World, statuses: Dict) -> None:
         """Runs the related task class defined in tasks/tasks.py"""
         dependencies_results = {}
-        for dep in self.dependencies:
+        dependencies_resolver = None
+        if self.prestaged:
+            # results are not known yet, the job waits for them
+            dependencies_resolver = partial(self.wait_for_dependencies, world)
+            dependencies = []
+        else:
+            dependencies = self.dependencies
+
+        for dep in dependencies:
             status = statuses.get(dep)
             if status is None:
                 raise RuntimeError(
@@ -760,7 +925,15 @@ class Task(object):
                 status.state, status.description, status.target_url
             )
 
-        result = self.job(world.repo_owner, dependencies_results)
+        previous_url = None
+        status = statuses.get(self.name)
+        if world.rerun_failed and status is not None and status.rerun_pending:
+            previous_url = status.target_url or None
+
+        result = self.job(
+            world.repo_owner, dependencies_results, dependencies_resolver,
+            previous_url
+        )
 
         try:
             status = world.poll_status(self.pr_number, self.name)
@@ -781,6 +954,10 @@ class Task(object):
                     self_desc=self.description,
                 )
             )
+        if result is None:
+            # Dependency of a prestaged task failed, the task can't run
+            world.create_status(self, State.PENDING, "unassigned")
+            return
         world.create_status(self, result.state, result.description, result.url)
 
 
@@ -851,29 +1028,81 @@ class JobDispatcher(AbcCallable):
     def timeout(self) -> int:
         return self.kwargs.get('timeout') or 0
 
-    def __call__(
-        self, repo_owner: Text, dependencies_results: Dict=None
-    ) -> JobResult:
-        """Calls the constructed job and waits for its result"""
+    @property
+    def prestageable(self) -> bool:
+        return getattr(self.task_class, "prestageable", False)
+
+    @property
+    def rerunnable(self) -> bool:
+        return getattr(self.task_class, "rerunnable", False)
 
+    def __add_dependencies_results(self, dependencies_results: Dict) -> None:
         # As we can have dependencies, obviously, we will need theirs results
         # For example, URL with RPM packages
+        for task_name, result in dependencies_results.items():
+            self.kwarg_lookup[
+                "{}_description".format(task_name)
+            ] = result.description
+            self.kwarg_lookup["{}_url".format(task_name)] = result.url
+
+    def __resolve_args(
+        self, deferred: Dict, dependencies_resolver: Callable, **kwargs
+    ) -> Optional[Dict]:
+        """Formats arguments of the job which depend on dependencies results
+        once they're known, kwargs are passed to dependencies_resolver"""
+        dependencies_results = dependencies_resolver(**kwargs)
+        if dependencies_results is None:
+            return None
+
+        self.__add_dependencies_results(dependencies_results)
+        return {
+            key: value.format(**self.kwarg_lookup)
+            for key, value in deferred.items()
+        }
+
+    def __call__(
+        self, repo_owner: Text, dependencies_results: Dict=None,
+        dependencies_resolver: Callable=None, previous_url: Text=None
+    ) -> Optional[JobResult]:
+        """Calls the constructed job and waits for its result
+
+        With dependencies_resolver, the job is started before its dependencies
+        finish; arguments referring to their results are passed as None and
+        the job resolves them when it needs them. None is returned when a
+        dependency failed.
+
+        With previous_url, the URL of a failed run of the same task, jobs
+        which support it run only the tests failed in that run.
+        """
         if dependencies_results is not None:
-            for task_name, result in dependencies_results.items():
-                self.kwarg_lookup[
-                    "{}_description".format(task_name)
-                ] = result.description
-                self.kwarg_lookup["{}_url".format(task_name)] = result.url
+            self.__add_dependencies_results(dependencies_results)
 
         kwargs = {}
+        deferred = {}
         for key, value in self.kwargs.items():
             if isinstance(value, str):
-                value = value.format(**self.kwarg_lookup)
+                try:
+                    value = value.format(**self.kwarg_lookup)
+                except KeyError:
+                    if dependencies_resolver is None:
+                        raise
+                    deferred[key] = value
+                    value = None
             kwargs[key] = value
 
+        if dependencies_resolver is not None:
+            kwargs["resolve_args"] = partial(
+                self.__resolve_args, deferred, dependencies_resolver
+            )
+
+        if previous_url is not None and self.rerunnable:
+            kwargs["previous_url"] = previous_url
+
         job = self.task_class(repo_owner=repo_owner, **kwargs)
         try:
             job()
+        except DependencyException:
+            return None
         except TaskException as e:
             description = str(e)
             state = State.ERROR
@@ -23,6 +23,9 @@ def make_pull_requests_query(owner: Text, repo: Text) -> Dict[Text, Text]:
           nodes {
             commit {
               oid
+              tree {
+                oid
+              }
               status {
                 contexts {
                   context
@@ -1,7 +1,7 @@
 """GitHub GraphQL helpers module"""
 
 import json
-from typing import Dict, List, Text
+from typing import Dict, List, Optional, Text
 
 from requests import Session
 
@@ -69,6 +69,14 @@ def get_commit_sha(commit: Dict) -> Text:
     return commit["oid"]
 
 
+def get_commit_tree(commit: Dict) -> Optional[Text]:
+    """Extracts sha of the tree from a given commit data."""
+    tree = commit.get("tree")
+    if tree is None:
+        return None
+    return tree.get("oid")
+
+
 def get_status(statuses: Dict, status_name: Text) -> Dict:
     """Extracts the status info for a given status by name."""
     return statuses.get(status_name)
@@ -20,7 +20,13 @@ from internals.entities import (
     sentry_report_exception, JobYAMLError
 )
 from internals.gql import util, queries
-from tasks.common import destroy_libvirt_domains
+from tasks import constants
+from tasks.box_eviction import BOX_USAGE
+from tasks.box_inventory import BoxInventory
+from tasks.box_prefetch import BoxPrefetcher
+from tasks.durations import JobDurations, duration_key, estimate
+from tasks.libvirt import DOMAIN_REAPER
+from tasks.warm_pool import WarmPool
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +45,33 @@ def skipping_task(reason: Text, task: Task) -> None:
     )
 
 
+def expected_duration(name: Text, task_data: Dict) -> float:
+    """Median duration of the task on the runner, inf if unknown"""
+    try:
+        args = task_data["job"]["args"]
+        key = duration_key(name, args.get("template"), args.get("topology"))
+    except (TypeError, KeyError, AttributeError):
+        return float("inf")
+    durations = estimate(key)
+    return durations[50] if durations is not None else float("inf")
+
+
+def queue_boxes(tasks_data: Dict) -> None:
+    """
+    Keep the templates of the tasks from eviction and have them downloaded
+    ahead of their jobs
+    """
+    for task_data in tasks_data.values():
+        try:
+            template = task_data["job"]["args"]["template"]
+            name, version = template["name"], template["version"]
+        except (TypeError, KeyError):
+            continue
+        BOX_USAGE.queue(name, version)
+        if tasks.BOX_PREFETCHER is not None:
+            tasks.BOX_PREFETCHER.want(name, version)
+
+
 def create_parser():
     def config_file(path):
         def load_yaml(yml_path):
@@ -106,6 +139,9 @@ def process_pull_request(
         logger.error(e)
         return None
 
+    if pull_request.author in world.whitelist or pull_request.needs_rerun:
+        queue_boxes(tasks_data)
+
     if pull_request.needs_rerun:
         # If all statuses are not failed (not in state ERROR or FAILURE) and
         # re-run label was set previously, remove the re-run label
@@ -119,11 +155,19 @@ def process_pull_request(
             except NotFoundError as e:
                 logger.warning(e)
 
-    for name, task_data in tasks_data.items():
+    tasks_items = tasks_data.items()
+    if world.shortest_first:
+        # Tasks known to be short first, so they don't wait for long ones
+        tasks_items = sorted(
+            tasks_items, key=lambda item: expected_duration(*item)
+        )
+
+    for name, task_data in tasks_items:
         try:
             task = Task(
                 name, pull_request.number, pull_request.commit.sha,
-                pull_request.author, repository_url, task_data, JobDispatcher
+                pull_request.author, repository_url, task_data, JobDispatcher,
+                pull_request.commit.tree_sha
             )
         except JobYAMLError:
             logger.warning(
@@ -209,8 +253,14 @@ def process_task(
         return None
 
     if not task.check_dependencies(statuses):
-        skipping_task("waiting for dependencies", task)
-        return None
+        if not (world.prestage and task.check_prestage(statuses)):
+            skipping_task("waiting for dependencies", task)
+            return None
+        logger.info(
+            "Prestaging %s for PR#%s while dependencies are running.",
+            task.name, task.pr_number
+        )
+        task.prestaged = True
 
     logger.info(
         "Attempting to lock a task %s for PR#%s.",
@@ -237,7 +287,25 @@ def main():
     runner_id = args.ID
     config = args.config
 
-    tasks.BOX_STATS_FILE = config["box_stats_file"]
+    tasks.BOX_INVENTORY = BoxInventory(
+        config.get("box_inventory_db", constants.BOX_INVENTORY_DB))
+    tasks.BOX_INVENTORY.import_stats_file(config.get("box_stats_file"))
+    if config.get("box_disk_quota"):
+        tasks.BOX_DISK_QUOTA = config["box_disk_quota"] * 2**30
+    tasks.ENFORCE_TOPOLOGY_LIMITS = config.get(
+        "enforce_topology_limits", False)
+    tasks.TOPOLOGY_MEMORY_HARD_LIMIT = config.get(
+        "topology_memory_hard_limit", True)
+    tasks.MOCK_CACHE_DIR = config.get("mock_cache_dir")
+    tasks.BUILD_REPO_MIRROR_DIR = config.get("build_repo_mirror_dir")
+    tasks.BUILD_REPO_MIRROR_URL = config.get("build_repo_mirror_url")
+    tasks.PACKAGE_CACHE_URL = config.get("package_cache_url")
+    tasks.CHECKPOINTS = config.get("checkpoints", False)
+    tasks.DIRECT_LIBVIRT = config.get("direct_libvirt", False)
+    tasks.SCRATCH_POOL = config.get("scratch_pool")
+    tasks.LOG_COMPRESSION_LEVEL = config.get("log_compression_level", 6)
+    if config.get("job_durations_db"):
+        tasks.JOB_DURATIONS = JobDurations(config["job_durations_db"])
     credentials = config["credentials"]
     repo = config["repository"]
     tasks_path = config["tasks_file"]
@@ -262,9 +330,32 @@ def main():
         repo_name=repo["name"],
         runner_id=runner_id,
         tasks_path=tasks_path,
-        whitelist=whitelist
+        whitelist=whitelist,
+        prestage=config.get("prestage_tests", False),
+        rerun_failed=config.get("rerun_failed_tests", False),
+        shortest_first=config.get("shortest_job_first", False),
+        scratch=(config.get("scratch_pool_size", 0) * 1024
+                 if tasks.SCRATCH_POOL else 0),
+        scratch_in_ram=config.get("scratch_pool_ram", False)
     )
 
+    # Domains left behind by a previous run of the runner (killed jobs, its
+    # warm pool) belong to nothing running now
+    DOMAIN_REAPER.reap("")
+
+    box_prefetch_budget = config.get("box_prefetch_budget", 0)
+    if box_prefetch_budget:
+        tasks.BOX_PREFETCHER = BoxPrefetcher(box_prefetch_budget * 2**30)
+        tasks.BOX_PREFETCHER.start()
+
+    warm_pool_size = config.get("warm_pool_size", 0)
+    if warm_pool_size:
+        resources = world.available_resources
+        tasks.WARM_POOL = WarmPool(
+            warm_pool_size, lambda: (resources.cpu, resources.memory)
+        )
+        tasks.WARM_POOL.start()
+
     while not exit_handler.done:
         logger.info("Checking pending pull requests.")
         world.check_graphql_limit()
@@ -294,6 +385,10 @@ def main():
         for pull_request in pull_requests:
             for task in process_pull_request(world, pull_request, repo_url):
                 exit_handler.register_task(task)
+                if tasks.WARM_POOL is not None:
+                    # the job may claim warm VMs, their resources must not
+                    # count twice; the pool makes room for the job after that
+                    tasks.WARM_POOL.expect_claim()
                 world.available_resources.take(task)
                 logger.info(
                     "Available resources: %s", world.available_resources
@@ -307,16 +402,24 @@ def main():
                     sentry_report_exception({"module": "github"})
                     sleep(ERROR_BACKOFF_TIME)
                 finally:
+                    if tasks.WARM_POOL is not None:
+                        # the job may have failed before claiming
+                        tasks.WARM_POOL.end_claim()
                     exit_handler.unregister_task()
                     world.available_resources.give(task)
-                    # Make sure every vm is destroyed
-                    destroy_libvirt_domains()
                     logger.info(
                         "Available resources: %s", world.available_resources
                     )
 
         sleep(no_task_backoff_time)
 
+    if tasks.WARM_POOL is not None:
+        tasks.WARM_POOL.stop()
+    if tasks.BOX_PREFETCHER is not None:
+        tasks.BOX_PREFETCHER.stop()
+    # disks of the last jobs may still be being removed
+    DOMAIN_REAPER.wait()
+
 
 if __name__ == "__main__":
     main()
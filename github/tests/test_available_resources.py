@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+from github.internals.entities import AvailableResources, Topology
+
+
+def task(**topology):
+    return SimpleNamespace(topology=Topology(**topology))
+
+
+def resources(**kwargs):
+    available = AvailableResources(**kwargs)
+    available.cpu, available.memory = 4, 16000
+    return available
+
+
+class TestAvailableResources(object):
+    def test_scratch_in_ram(self):
+        available = resources(scratch=4000, scratch_in_ram=True)
+        ephemeral = task(cpu=1, memory=2000, scratch_disk=3000)
+        assert available.check(ephemeral)
+        available.take(ephemeral)
+        # the tmpfs takes memory too
+        assert available.memory == 11000
+        assert available.scratch == 1000
+        assert not available.check(ephemeral)
+        assert available.check(task(cpu=1, memory=2000))
+        available.give(ephemeral)
+        assert (available.memory, available.scratch) == (16000, 4000)
+
+    def test_scratch_on_disk(self):
+        available = resources(scratch=4000)
+        available.take(task(cpu=1, memory=2000, scratch_disk=3000))
+        assert (available.memory, available.scratch) == (14000, 1000)
+
+    def test_no_scratch_pool(self):
+        available = resources()
+        # the disks stay on the persistent pool
+        ephemeral = task(cpu=1, memory=2000, scratch_disk=3000)
+        assert available.check(ephemeral)
+        available.take(ephemeral)
+        assert available.scratch == 0
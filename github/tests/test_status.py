@@ -79,3 +79,32 @@ class TestStatus(object):
     ])
     def test_unassigned(self, test_input, expected):
         assert test_input.unassigned == expected
+
+    @pytest.mark.parametrize("test_input,expected", [
+        (create_with_description("Taken by r on 2018-01-01 10:00 UTC"), False),
+        (create_with_description(
+            "Taken by r on 2018-01-01 10:00 UTC (prestaged)"), True),
+        (create_with_description("unassigned"), False)
+    ])
+    def test_prestaged(self, test_input, expected):
+        assert test_input.prestaged == expected
+
+    def test_stalled_prestaged(self):
+        class Task(object):
+            stale_timeout = 3600
+
+        def prestaged_on(date):
+            return create_with_description(
+                e.TASK_PRESTAGED_FMT.format(runner_id="r", date=date)
+            )
+
+        now = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
+        assert prestaged_on(now).taken
+        assert not prestaged_on(now).stalled(Task())
+        assert prestaged_on("2018-01-01 10:00 UTC").stalled(Task())
+
+        class UnlimitedTask(object):
+            stale_timeout = 0
+
+        assert not prestaged_on("2018-01-01 10:00 UTC").stalled(
+            UnlimitedTask())
@@ -0,0 +1,41 @@
+import threading
+import time
+
+import pytest
+
+import github.internals.entities as e
+from tasks.common import DependencyException
+
+
+class World(object):
+    def __init__(self, state):
+        self.state = state
+
+    def poll_status(self, pr_number, task_name):
+        return e.Status(task_name, "d", self.state, "")
+
+
+class Task(object):
+    name = "test"
+    pr_number = 1
+    dependencies = ["build"]
+    wait_for_dependencies = e.Task.wait_for_dependencies
+
+
+class TestTask(object):
+    def test_wait_for_dependencies(self):
+        results = Task().wait_for_dependencies(World(e.State.SUCCESS))
+        assert list(results) == ["build"]
+        assert Task().wait_for_dependencies(World(e.State.FAILURE)) is None
+
+    def test_wait_for_dependencies_deadline(self):
+        with pytest.raises(DependencyException):
+            Task().wait_for_dependencies(
+                World(e.State.PENDING), deadline=time.time())
+
+    def test_wait_for_dependencies_cancelled(self):
+        cancelled = threading.Event()
+        cancelled.set()
+        with pytest.raises(DependencyException):
+            Task().wait_for_dependencies(
+                World(e.State.PENDING), cancelled=cancelled)
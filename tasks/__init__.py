@@ -1,5 +1,50 @@
 from .common import logging_init_stream_handler, TimeoutException
 from .tasks import Build, RunPytest, RunWebuiTests, RunPytest2, RunPytest3
 
-# Singleton constant used to store stats file path
-BOX_STATS_FILE = None
+# Inventory of the runner's Vagrant boxes (box_inventory.BoxInventory)
+BOX_INVENTORY = None
+
+# Apply topology cpu and memory as limits of the jobs' VMs
+ENFORCE_TOPOLOGY_LIMITS = False
+# Whether the topology memory is a hard limit too, or only a soft one
+TOPOLOGY_MEMORY_HARD_LIMIT = True
+
+# Directory on the runner where mock caches of builds are kept (None disables)
+MOCK_CACHE_DIR = None
+
+# Directory on the runner where build repositories are mirrored and the URL
+# it's served at to the VMs (None disables)
+BUILD_REPO_MIRROR_DIR = None
+BUILD_REPO_MIRROR_URL = None
+
+# URL of the runner's caching proxy of Fedora repositories (None disables)
+PACKAGE_CACHE_URL = None
+
+# Bytes the Vagrant boxes may take in the boxes directory and libvirt pool
+# (None for no quota, only keeping enough free space)
+BOX_DISK_QUOTA = None
+
+# Prefetcher of boxes used by open PRs (box_prefetch.BoxPrefetcher, None
+# disables)
+BOX_PREFETCHER = None
+
+# libvirt pool (on tmpfs or a local NVMe drive) for the disks of jobs whose
+# topology asks for ephemeral disks (None disables)
+SCRATCH_POOL = None
+
+# gzip compression level of the logs of jobs
+LOG_COMPRESSION_LEVEL = 6
+
+# Pool of booted VMs jobs can claim (warm_pool.WarmPool, None disables)
+WARM_POOL = None
+
+# Bring up VMs of jobs through libvirt directly instead of vagrant, where
+# the Vagrantfile allows it
+DIRECT_LIBVIRT = False
+
+# Checkpoint provisioned VMs of jobs, so re-runs can restore them
+CHECKPOINTS = False
+
+# Durations of the jobs run on the runner (durations.JobDurations, None
+# disables)
+JOB_DURATIONS = None
@@ -0,0 +1,136 @@
+"""
+Eviction of Vagrant boxes to make room for a box being downloaded.
+
+Boxes (their images in the Vagrant boxes directory and in the libvirt pool)
+are kept within the runner's box disk quota, if any, and the partition within
+BOX_MIN_FREE. Boxes held by running jobs or the warm pool, boxes of tasks of
+open PRs seen recently, pinned boxes and Windows boxes are never evicted.
+
+The rest are evicted in order of the value of keeping them per byte: how
+often the box is expected to be used again, from its use count and the time
+since its last use, times the time it would take to download it again.
+Boxes idle for long and rarely used go first; of boxes used alike, big ones
+go before small ones, whose download is dominated by the fixed overhead.
+"""
+
+import collections
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import tasks
+
+from . import constants
+from .box_inventory import scan_boxes
+
+
+class BoxUsage(object):
+    """Boxes needed by running jobs and tasks waiting to run"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held = collections.Counter()
+        self.queued = {}
+
+    def hold(self, name, version):
+        with self.lock:
+            self.held[(name, version)] += 1
+
+    def release(self, name, version):
+        with self.lock:
+            self.held[(name, version)] -= 1
+            if self.held[(name, version)] <= 0:
+                del self.held[(name, version)]
+
+    def queue(self, name, version):
+        """Note a box of a task of an open PR"""
+        with self.lock:
+            self.queued[(name, version)] = time.time()
+
+    def needed(self):
+        """Return {(name, version)} of boxes which must be kept"""
+        expired = time.time() - constants.BOX_QUEUED_TTL
+        with self.lock:
+            self.queued = {key: seen for key, seen in self.queued.items()
+                           if seen > expired}
+            return set(self.held) | set(self.queued)
+
+
+BOX_USAGE = BoxUsage()
+
+
+def keep_value(box, row, now):
+    """Expected re-download time saved per byte by keeping the box"""
+    last_used = row.get('last_used') or now - 24 * 60 * 60
+    idle = max(now - last_used, 1.0)
+    use_rate = (1 + (row.get('use_count') or 0)) / idle
+    download_time = (constants.BOX_DOWNLOAD_OVERHEAD +
+                     box.total_size / constants.BOX_DOWNLOAD_RATE)
+    return use_rate * download_time / max(box.total_size, 1)
+
+
+def eviction_candidates(installed, inventory, needed, now=None):
+    """Return the installed boxes which may be evicted, first to go first"""
+    now = now or time.time()
+    candidates = [
+        box for box in installed
+        if 'windows' not in box.name and
+        (box.name, box.version) not in needed and
+        not inventory.get(box.key, {}).get('pinned')]
+    return sorted(candidates, key=lambda box: keep_value(
+        box, inventory.get(box.key, {}), now))
+
+
+def expected_size(name, installed, inventory):
+    """Guess the size of a box from other versions of it, or other boxes"""
+    sizes = [row['size'] for key, row in inventory.items()
+             if key[0] == name and row.get('size')]
+    sizes += [box.total_size for box in installed if box.name == name]
+    if not sizes:
+        sizes = [box.total_size for box in installed]
+    return max(sizes) if sizes else 0
+
+
+def remove_box(box):
+    subprocess.run([
+        'vagrant', 'box', 'remove', box.name, '--provider', box.provider,
+        '--box-version', box.version
+    ], timeout=2000)
+    for image in box.images:
+        subprocess.run(['virsh', 'vol-delete', image], timeout=2000)
+    if tasks.BOX_INVENTORY is not None:
+        tasks.BOX_INVENTORY.remove(*box.key)
+
+
+def evict_boxes(name, version, quota=None,
+                boxes_dir=constants.VAGRANT_BOXES_DIR):
+    """
+    Evict boxes so the box about to be downloaded fits into the quota
+    (bytes, None for no quota) and the free space of the partition
+    """
+    installed = scan_boxes()
+    inventory = {}
+    if tasks.BOX_INVENTORY is not None:
+        inventory = tasks.BOX_INVENTORY.boxes()
+    required = expected_size(name, installed, inventory)
+
+    usage = sum(box.total_size for box in installed)
+    stat = os.statvfs(boxes_dir)
+    free = stat.f_bavail * stat.f_frsize
+    min_free = stat.f_blocks * stat.f_frsize * constants.BOX_MIN_FREE
+
+    needed = BOX_USAGE.needed() | {(name, version)}
+    for box in eviction_candidates(installed, inventory, needed):
+        over_quota = quota is not None and usage + required > quota
+        if not over_quota and free - required >= min_free:
+            break
+        logging.info('Evicting box {name} {version} ({size} MiB)'.format(
+            name=box.name, version=box.version,
+            size=box.total_size // 2**20))
+        remove_box(box)
+        usage -= box.total_size
+        free += box.total_size
+    else:
+        if quota is not None and usage + required > quota:
+            logging.warning('Boxes needed by jobs exceed the box disk quota')
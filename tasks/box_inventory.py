@@ -0,0 +1,260 @@
+"""
+Inventory of the Vagrant boxes of the runner: when each box was last used,
+how many times, its size and whether it's pinned (never removed to make space
+for other boxes).
+
+Jobs running in parallel update it, as does the autocleaner, so every update
+is a single atomic statement.
+
+The installed boxes are found by scanning the Vagrant boxes directory and the
+libvirt images directory, which is much faster than `vagrant box list`.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+import yaml
+
+from . import constants
+
+
+# images vagrant-libvirt uploads boxes as, ln'ed by VagrantBoxDownload or
+# copied (one per disk of the box by newer vagrant-libvirt)
+LIBVIRT_BOX_IMAGE_RE = re.compile(
+    r'^(?P<name>.+)_vagrant_box_image_(?P<version>[^_]+)'
+    r'(?:_box(?:_\d+)?)?\.img$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS boxes (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    last_used REAL,
+    use_count INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, version, provider)
+);
+"""
+
+
+class BoxInventory(object):
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self):
+        # used from the threads of jobs and from other processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record_use(self, name, version, provider, size=None):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT INTO boxes '
+                '(name, version, provider, last_used, use_count, size) '
+                'VALUES (?, ?, ?, ?, 1, ?) '
+                'ON CONFLICT (name, version, provider) DO UPDATE SET '
+                'last_used = excluded.last_used, '
+                'use_count = use_count + 1, '
+                'size = COALESCE(excluded.size, size)',
+                (name, version, provider, time.time(), size))
+
+    def record_prefetch(self, name, version, provider, size=None):
+        """Record a box downloaded ahead of its use as just used"""
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT INTO boxes (name, version, provider, last_used, size) '
+                'VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (name, version, provider) DO UPDATE SET '
+                'last_used = excluded.last_used, size = excluded.size',
+                (name, version, provider, time.time(), size))
+
+    def set_size(self, name, version, provider, size):
+        with self.connect() as conn:
+            conn.execute(
+                'UPDATE boxes SET size = ? '
+                'WHERE name = ? AND version = ? AND provider = ?',
+                (size, name, version, provider))
+
+    def pin(self, name, version, provider, pinned=True):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT INTO boxes (name, version, provider, pinned) '
+                'VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (name, version, provider) DO UPDATE SET '
+                'pinned = excluded.pinned',
+                (name, version, provider, int(pinned)))
+
+    def remove(self, name, version, provider):
+        with self.connect() as conn:
+            conn.execute(
+                'DELETE FROM boxes '
+                'WHERE name = ? AND version = ? AND provider = ?',
+                (name, version, provider))
+
+    def boxes(self):
+        """
+        Return {(name, version, provider): row} of all boxes, rows being
+        dicts of the columns
+        """
+        with self.connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute('SELECT * FROM boxes').fetchall()
+        return {(row['name'], row['version'], row['provider']): dict(row)
+                for row in rows}
+
+    def last_used(self, name, version, provider):
+        """Return datetime of the last use of the box, None if unknown"""
+        with self.connect() as conn:
+            row = conn.execute(
+                'SELECT last_used FROM boxes '
+                'WHERE name = ? AND version = ? AND provider = ?',
+                (name, version, provider)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return datetime.fromtimestamp(row[0])
+
+    def pinned(self, name, version, provider):
+        with self.connect() as conn:
+            row = conn.execute(
+                'SELECT pinned FROM boxes '
+                'WHERE name = ? AND version = ? AND provider = ?',
+                (name, version, provider)).fetchone()
+        return bool(row and row[0])
+
+    def import_stats_file(self, stats_path):
+        """
+        Import last uses from the YAML stats file used before, which is then
+        renamed so it's imported only once
+        """
+        if not stats_path or not os.path.exists(stats_path):
+            return
+        try:
+            with open(stats_path) as stats_file:
+                stats = yaml.safe_load(stats_file) or {}
+        except (OSError, IOError, yaml.YAMLError) as exc:
+            logging.warning('Failed to import box stats: {}'.format(exc))
+            return
+        with self.connect() as conn:
+            for box_key, last_used in stats.items():
+                # keys are name_version_provider, names contain no '_'
+                try:
+                    name, version, provider = box_key.rsplit('_', 2)
+                except ValueError:
+                    continue
+                if isinstance(last_used, datetime):
+                    last_used = last_used.timestamp()
+                else:
+                    last_used = None
+                conn.execute(
+                    'INSERT OR IGNORE INTO boxes '
+                    '(name, version, provider, last_used) '
+                    'VALUES (?, ?, ?, ?)',
+                    (name, version, provider, last_used))
+        os.rename(stats_path, stats_path + '.imported')
+
+
+def escape_name(name):
+    return name.replace('/', '-VAGRANTSLASH-')
+
+
+def unescape_name(name):
+    return name.replace('-VAGRANTSLASH-', '/')
+
+
+class InstalledBox(object):
+    def __init__(self, name, version, provider, path):
+        self.name = name
+        self.version = version
+        self.provider = provider
+        self.path = path
+        self.size = 0
+        # libvirt images the box was uploaded as
+        self.images = []
+        # hard links to the box image take no more space
+        self.images_size = 0
+        self.inodes = set()
+        for entry in os.scandir(path):
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                # images are sparse, count allocated blocks only
+                self.size += stat.st_blocks * 512
+                self.inodes.add((stat.st_dev, stat.st_ino))
+
+    @property
+    def key(self):
+        return (self.name, self.version, self.provider)
+
+    def add_image(self, path):
+        self.images.append(path)
+        stat = os.stat(path)
+        if (stat.st_dev, stat.st_ino) not in self.inodes:
+            self.images_size += stat.st_blocks * 512
+
+    @property
+    def total_size(self):
+        return self.size + self.images_size
+
+    def __repr__(self):
+        return '<InstalledBox {name} {version} ({provider})>'.format(
+            name=self.name, version=self.version, provider=self.provider)
+
+
+def provider_dirs(version_dir):
+    """
+    Yield (provider, path) of a box version directory; newer Vagrant puts
+    providers into architecture directories
+    """
+    for entry in os.scandir(version_dir):
+        if not entry.is_dir():
+            continue
+        if os.path.exists(os.path.join(entry.path, 'metadata.json')):
+            yield entry.name, entry.path
+            continue
+        for arch_entry in os.scandir(entry.path):
+            if arch_entry.is_dir() and os.path.exists(
+                    os.path.join(arch_entry.path, 'metadata.json')):
+                yield arch_entry.name, arch_entry.path
+
+
+def scan_boxes(boxes_dir=constants.VAGRANT_BOXES_DIR,
+               images_dir=constants.LIBVIRT_IMAGES_DIR):
+    """
+    Return InstalledBox of every box in the Vagrant boxes directory, with
+    its libvirt images
+    """
+    boxes = {}
+    try:
+        name_entries = list(os.scandir(boxes_dir))
+    except FileNotFoundError:
+        name_entries = []
+    for name_entry in name_entries:
+        if not name_entry.is_dir():
+            continue
+        for version_entry in os.scandir(name_entry.path):
+            if not version_entry.is_dir():
+                continue
+            for provider, path in provider_dirs(version_entry.path):
+                box = InstalledBox(unescape_name(name_entry.name),
+                                   version_entry.name, provider, path)
+                boxes[box.key] = box
+
+    try:
+        image_entries = list(os.scandir(images_dir))
+    except FileNotFoundError:
+        image_entries = []
+    for entry in image_entries:
+        match = LIBVIRT_BOX_IMAGE_RE.match(entry.name)
+        if match is None:
+            continue
+        box = boxes.get((unescape_name(match.group('name')),
+                         match.group('version'), 'libvirt'))
+        if box is not None:
+            box.add_image(entry.path)
+
+    return sorted(boxes.values(), key=lambda box: box.key)
@@ -0,0 +1,246 @@
+"""
+Prefetching of the Vagrant boxes the open PRs will need, so a job using a
+newly bumped template doesn't wait for its download.
+
+The runner tells the prefetcher the templates of the tasks of every open PR
+it could run. Boxes which aren't installed are downloaded one at a time in
+the background, as long as all boxes fit into the disk budget. Downloads are
+resumed after failures and restarts and verified against the checksum from
+the box catalog before the box is added to Vagrant.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+import requests
+
+import tasks
+
+from . import constants
+from .box_inventory import scan_boxes
+from .common import PopenTask, OutputClassifier, TaskException
+from .vagrant import VagrantBox
+
+
+def catalog_url(name):
+    server = os.environ.get('VAGRANT_SERVER_URL',
+                            constants.VAGRANT_CATALOG_URL)
+    return '{server}/{name}'.format(server=server.rstrip('/'), name=name)
+
+
+def catalog_provider(name, version, provider):
+    """
+    Return the catalog entry of the box provider (url, checksum and
+    checksum_type)
+    """
+    res = requests.get(catalog_url(name),
+                       headers={'Accept': 'application/json'},
+                       timeout=constants.BOX_PREFETCH_TIMEOUT)
+    res.raise_for_status()
+    for box_version in res.json().get('versions', []):
+        if box_version.get('version') != version:
+            continue
+        for entry in box_version.get('providers', []):
+            if entry.get('name') == provider:
+                return entry
+    raise ValueError('{name} {version} ({provider}) not in the catalog'.format(
+        name=name, version=version, provider=provider))
+
+
+def content_length(url):
+    """Size of the content at url, None if unknown"""
+    res = requests.head(url, allow_redirects=True,
+                        timeout=constants.BOX_PREFETCH_TIMEOUT)
+    try:
+        return int(res.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def download(url, path):
+    """Download url to path, resuming the partial content of path"""
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    with requests.get(url, headers=headers, stream=True,
+                      timeout=constants.BOX_PREFETCH_TIMEOUT) as res:
+        if offset and res.status_code == 416:
+            # nothing left to download
+            return
+        res.raise_for_status()
+        # servers not supporting ranges send everything
+        mode = 'ab' if res.status_code == 206 else 'wb'
+        with open(path, mode) as fh:
+            for chunk in res.iter_content(chunk_size=1024 * 1024):
+                fh.write(chunk)
+
+
+def verify_checksum(path, checksum_type, checksum):
+    """Return whether the file matches the checksum, if there is any"""
+    if not checksum or not checksum_type:
+        return True
+    digest = hashlib.new(checksum_type)
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest() == checksum.lower()
+
+
+class BoxPrefetcher(object):
+    def __init__(self, budget, download_dir=constants.BOX_PREFETCH_DIR):
+        """
+        budget: bytes all boxes, including the downloaded ones, may take
+        download_dir: directory of partial downloads
+        """
+        self.budget = budget
+        self.download_dir = download_dir
+        self.wanted = collections.OrderedDict()
+        self.current = None
+        # boxes jobs are downloading themselves
+        self.downloading = collections.Counter()
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.wakeup = threading.Event()
+        self.done = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # a download in progress is resumed on the next start
+        self.done = True
+        self.wakeup.set()
+
+    def want(self, name, version):
+        """Have the box prefetched unless it's installed"""
+        with self.lock:
+            if (name, version) in self.wanted or \
+                    self.downloading[(name, version)]:
+                return
+            self.wanted[(name, version)] = None
+        self.wakeup.set()
+
+    def begin_download(self, name, version):
+        """
+        Called before a job downloads the box: waits until the box is
+        prefetched if it's being downloaded, and keeps the prefetcher off
+        the box until end_download
+        """
+        key = (name, version)
+        with self.lock:
+            while self.current == key:
+                self.finished.wait()
+            self.wanted.pop(key, None)
+            self.downloading[key] += 1
+
+    def end_download(self, name, version):
+        with self.lock:
+            self.downloading[(name, version)] -= 1
+            if not self.downloading[(name, version)]:
+                del self.downloading[(name, version)]
+
+    def run(self):
+        while not self.done:
+            key = self.next_box()
+            if key is None:
+                self.wakeup.wait(constants.BOX_PREFETCH_INTERVAL)
+                self.wakeup.clear()
+                continue
+            try:
+                self.prefetch(*key)
+            except Exception as exc:
+                # wanted again with the next check of the PRs
+                logging.error('Prefetching box {name} {version} failed: '
+                              '{exc}'.format(name=key[0], version=key[1],
+                                             exc=exc))
+                logging.debug(exc, exc_info=True)
+            finally:
+                with self.lock:
+                    self.wanted.pop(key, None)
+                    self.current = None
+                    self.finished.notify_all()
+
+    def next_box(self):
+        """Take the first wanted box which isn't installed"""
+        with self.lock:
+            for key in list(self.wanted):
+                if not (VagrantBox(*key).exists() or
+                        self.downloading[key]):
+                    self.current = key
+                    return key
+                del self.wanted[key]
+        return None
+
+    def partial_path(self, box):
+        return os.path.join(
+            self.download_dir, '{name}_{version}_{provider}.box'.format(
+                name=box.escaped_name, version=box.version,
+                provider=box.provider))
+
+    def fits(self, size, path):
+        """
+        Return whether the rest of the download fits into the budget and
+        the free space; downloads of unknown size only need some budget left
+        """
+        used = sum(box.total_size for box in scan_boxes())
+        if os.path.isdir(self.download_dir):
+            used += sum(entry.stat().st_blocks * 512
+                        for entry in os.scandir(self.download_dir))
+        if size is None:
+            return used < self.budget
+        remaining = size
+        if os.path.exists(path):
+            remaining -= os.path.getsize(path)
+        free = shutil.disk_usage(os.path.dirname(self.download_dir)).free
+        return used + remaining <= self.budget and remaining < free
+
+    def prefetch(self, name, version):
+        box = VagrantBox(name, version)
+        entry = catalog_provider(box.name, box.version, box.provider)
+        path = self.partial_path(box)
+        os.makedirs(self.download_dir, exist_ok=True)
+        if not self.fits(content_length(entry['url']), path):
+            logging.info('Box {name} {version} does not fit into the '
+                         'prefetch budget'.format(name=name, version=version))
+            return
+
+        logging.info('Prefetching box {name} {version}'.format(
+            name=name, version=version))
+        download(entry['url'], path)
+        if not verify_checksum(path, entry.get('checksum_type'),
+                               entry.get('checksum')):
+            os.unlink(path)
+            raise ValueError('checksum of {} does not match'.format(path))
+        self.add(box, path)
+        logging.info('Box {name} {version} prefetched'.format(
+            name=name, version=version))
+
+    def add(self, box, path):
+        """Add the downloaded box to Vagrant under its catalog version"""
+        # a local catalog makes vagrant keep the name and version of the box
+        metadata_path = path + '.json'
+        with open(metadata_path, 'w') as fh:
+            json.dump({'name': box.name, 'versions': [{
+                'version': box.version,
+                'providers': [{'name': box.provider,
+                               'url': 'file://' + path}]}]}, fh)
+        try:
+            PopenTask(['vagrant', 'box', 'add', metadata_path,
+                       '--box-version', box.version,
+                       '--provider', box.provider],
+                      classifier=OutputClassifier(), timeout=None)()
+        except TaskException:
+            # added by someone else meanwhile
+            if not box.exists():
+                raise
+        finally:
+            os.unlink(metadata_path)
+        os.unlink(path)
+        if tasks.BOX_INVENTORY is not None:
+            tasks.BOX_INVENTORY.record_prefetch(*box.key, size=box.size())
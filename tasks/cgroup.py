@@ -0,0 +1,145 @@
+"""
+Every job runs the processes it spawns (vagrant, ansible, ssh, ...) in its own
+cgroup v2 group. Killing the job, accounting its CPU and memory usage and
+finding leaked processes then only touches the processes of that job instead
+of scanning every process on the host.
+
+The runner has to own a delegated cgroup subtree (Delegate=yes in
+prci.service). When it doesn't, or the host doesn't use the unified cgroup v2
+hierarchy, jobs simply run without a cgroup.
+"""
+
+import logging
+import os
+import signal
+import time
+
+from . import constants
+
+
+CONTROLLERS = ['cpu', 'memory', 'pids']
+KILL_RETRIES = 10
+
+
+def own_cgroup():
+    """Return the cgroup v2 path of the current process or None"""
+    with open('/proc/self/cgroup') as cgroup_file:
+        for line in cgroup_file:
+            hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+            if hierarchy == '0' and not controllers:
+                return path
+    return None
+
+
+def _write(path, value):
+    with open(path, 'w') as cgroup_file:
+        cgroup_file.write(value)
+
+
+def _read(path):
+    with open(path) as cgroup_file:
+        return cgroup_file.read()
+
+
+def delegated_root():
+    """
+    Return the directory of the cgroup subtree delegated to the runner.
+
+    cgroup v2 does not allow processes in inner nodes with controllers
+    enabled, so the runner itself is moved to a leaf group first, then the
+    controllers are enabled for the job groups.
+    """
+    path = own_cgroup()
+    if path is None:
+        raise OSError('unified cgroup v2 hierarchy is not available')
+
+    root = os.path.join(constants.CGROUP_MOUNT, path.lstrip('/'))
+    if os.path.basename(root) == constants.CGROUP_RUNNER_LEAF:
+        return os.path.dirname(root)
+
+    leaf = os.path.join(root, constants.CGROUP_RUNNER_LEAF)
+    os.makedirs(leaf, exist_ok=True)
+    _write(os.path.join(leaf, 'cgroup.procs'), str(os.getpid()))
+
+    available = _read(os.path.join(root, 'cgroup.controllers')).split()
+    enable = ' '.join(
+        '+{}'.format(ctrl) for ctrl in CONTROLLERS if ctrl in available)
+    if enable:
+        _write(os.path.join(root, 'cgroup.subtree_control'), enable)
+    return root
+
+
+class JobCgroup(object):
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def create(name):
+        """Create the cgroup of a job, None if cgroups are unavailable"""
+        try:
+            path = os.path.join(delegated_root(), 'job-{}'.format(name))
+            os.makedirs(path, exist_ok=True)
+        except (OSError, IOError) as exc:
+            logging.warning('Job runs without cgroup: %s', exc)
+            return None
+        return JobCgroup(path)
+
+    def attach(self):
+        """
+        Move the calling process to the cgroup. Meant to be called in the
+        child between fork and exec, so everything it spawns stays there.
+        """
+        _write(os.path.join(self.path, 'cgroup.procs'), '0')
+
+    def pids(self):
+        pids = []
+        for root, _dirs, _files in os.walk(self.path):
+            try:
+                procs = _read(os.path.join(root, 'cgroup.procs'))
+            except (OSError, IOError):
+                continue
+            pids.extend(int(pid) for pid in procs.split())
+        return pids
+
+    def kill(self):
+        """Kill every process of the cgroup and wait until they're gone"""
+        kill_file = os.path.join(self.path, 'cgroup.kill')
+        for _i in range(KILL_RETRIES):
+            pids = self.pids()
+            if not pids:
+                return
+            if os.path.exists(kill_file):
+                _write(kill_file, '1')
+            else:
+                for pid in pids:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+            time.sleep(0.1)
+        logging.warning('Processes %s survived killing the job cgroup',
+                        self.pids())
+
+    def stats(self):
+        """CPU time in seconds and peak memory in MB used by the job"""
+        stats = {}
+        try:
+            for line in _read(os.path.join(self.path, 'cpu.stat')).split('\n'):
+                if line.startswith('usage_usec '):
+                    stats['cpu'] = int(line.split()[1]) / 1e6
+        except (OSError, IOError):
+            pass
+        for memory_file in ('memory.peak', 'memory.current'):
+            try:
+                memory = _read(os.path.join(self.path, memory_file))
+            except (OSError, IOError):
+                continue
+            stats['memory'] = int(memory) / float(1024 ** 2)
+            break
+        return stats
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except (OSError, IOError) as exc:
+            logging.warning('Failed to remove job cgroup: %s', exc)
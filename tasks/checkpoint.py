@@ -0,0 +1,205 @@
+"""
+Checkpoints of provisioned VMs, so a re-run of a task on the same runner can
+skip vagrant up and provisioning.
+
+A checkpoint keeps, for every domain of the job, a copy of its disks taken
+while the domain was paused, its inactive XML definition (MAC addresses
+included, so the VMs get their IP addresses back from the vagrant-libvirt
+network and the provisioned /etc/hosts and test config stay valid) and the
+vagrant state of the job. Restored domains get thin qcow2 overlays on top of
+the checkpoint disks, so one checkpoint can be restored by many jobs.
+
+Checkpoints are keyed by the source tree and the task name and removed when
+they haven't been used for CHECKPOINT_MAX_AGE.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from . import constants
+from .common import FallibleTask, PopenTask, TaskException
+from .libvirt import (create_overlay, job_domains, domain_disks,
+                      domain_addresses, virsh)
+
+
+MANIFEST = 'manifest.json'
+# files the provisioning creates in the job directory
+PROVISIONED_FILES = ['ipa-test-config.yaml']
+# vagrant machine state referring to the project directory, vagrant
+# recreates it
+VAGRANT_PROJECT_FILES = ['index_uuid', 'vagrant_cwd', 'synced_folders']
+
+
+def checkpoint_path(key):
+    return os.path.join(constants.CHECKPOINT_DIR, key)
+
+
+def prune_checkpoints():
+    """Remove checkpoints which weren't used for a while"""
+    if not os.path.isdir(constants.CHECKPOINT_DIR):
+        return
+    limit = time.time() - constants.CHECKPOINT_MAX_AGE
+    for entry in os.scandir(constants.CHECKPOINT_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < limit:
+            logging.info('Removing unused checkpoint {}'.format(entry.name))
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+class CreateCheckpoint(FallibleTask):
+    """Save the provisioned VMs of a job as a checkpoint"""
+    def __init__(self, key, domain_prefix, data_dir, **kwargs):
+        super(CreateCheckpoint, self).__init__(**kwargs)
+        self.key = key
+        self.domain_prefix = domain_prefix
+        self.data_dir = data_dir
+
+    def _run(self):
+        path = checkpoint_path(self.key)
+        if os.path.exists(path):
+            return
+        prune_checkpoints()
+        os.makedirs(constants.CHECKPOINT_DIR, exist_ok=True)
+
+        stat = os.statvfs(constants.CHECKPOINT_DIR)
+        if stat.f_bavail < stat.f_blocks * constants.CHECKPOINT_MIN_FREE:
+            raise TaskException(self, 'not enough free disk space')
+
+        domains = job_domains(self.domain_prefix)
+        if not domains:
+            raise TaskException(self, 'no domains found')
+
+        tmp_dir = tempfile.mkdtemp(prefix='.{}-'.format(self.key),
+                                   dir=constants.CHECKPOINT_DIR)
+        try:
+            manifest = {}
+            for domain in domains:
+                machine = domain[len(self.domain_prefix):]
+                manifest[machine] = self.save_domain(domain, machine, tmp_dir)
+            for name in PROVISIONED_FILES:
+                if os.path.exists(os.path.join(self.data_dir, name)):
+                    shutil.copy(os.path.join(self.data_dir, name), tmp_dir)
+            shutil.copytree(os.path.join(self.data_dir, '.vagrant'),
+                            os.path.join(tmp_dir, 'vagrant'))
+            with open(os.path.join(tmp_dir, MANIFEST), 'w') as fh:
+                json.dump(manifest, fh, indent=2)
+            os.rename(tmp_dir, path)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        logging.info('Created checkpoint {key}'.format(key=self.key))
+
+    def save_domain(self, domain, machine, tmp_dir):
+        # flush the guest's page cache, the disks are copied while paused
+        self.execute_subtask(
+            PopenTask(['vagrant', 'ssh', machine, '-c', 'sync'],
+                      raise_on_err=False))
+        addresses = domain_addresses(domain)
+        disks = {}
+        virsh('suspend', domain)
+        try:
+            for target, source in domain_disks(domain).items():
+                disks[target] = '{machine}-{target}.qcow2'.format(
+                    machine=machine, target=target)
+                self.execute_subtask(
+                    PopenTask(['cp', '--reflink=auto', '--sparse=always',
+                               '--preserve=mode,ownership', source,
+                               os.path.join(tmp_dir, disks[target])],
+                              timeout=None))
+        finally:
+            virsh('resume', domain)
+        with open(os.path.join(tmp_dir, machine + '.xml'), 'w') as fh:
+            fh.write(virsh('dumpxml', '--inactive', domain))
+        return {'disks': disks, 'addresses': addresses}
+
+
+class RestoreCheckpoint(FallibleTask):
+    """
+    Define the job's domains from a checkpoint. The domains are only defined,
+    vagrant up starts them and mounts the job's synced folders.
+    """
+    def __init__(self, key, domain_prefix, data_dir, **kwargs):
+        super(RestoreCheckpoint, self).__init__(**kwargs)
+        self.key = key
+        self.domain_prefix = domain_prefix
+        self.data_dir = data_dir
+
+    @property
+    def path(self):
+        return checkpoint_path(self.key)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, MANIFEST))
+
+    def _run(self):
+        # mark as used, so it's not pruned
+        os.utime(self.path)
+        with open(os.path.join(self.path, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+
+        vagrant_dir = os.path.join(self.data_dir, '.vagrant')
+        shutil.copytree(os.path.join(self.path, 'vagrant'), vagrant_dir)
+        for name in PROVISIONED_FILES:
+            if os.path.exists(os.path.join(self.path, name)):
+                shutil.copy(os.path.join(self.path, name), self.data_dir)
+
+        for machine, saved in self.manifest.items():
+            domain = self.domain_prefix + machine
+            self.define_domain(domain, machine, saved['disks'])
+            machine_dir = os.path.join(vagrant_dir, 'machines', machine,
+                                       'libvirt')
+            for name in VAGRANT_PROJECT_FILES:
+                try:
+                    os.unlink(os.path.join(machine_dir, name))
+                except OSError:
+                    pass
+            with open(os.path.join(machine_dir, 'id'), 'w') as fh:
+                fh.write(virsh('domuuid', domain).strip())
+        logging.info('Restored checkpoint {key}'.format(key=self.key))
+
+    def define_domain(self, domain, machine, disks):
+        tree = ET.parse(os.path.join(self.path, machine + '.xml'))
+        root = tree.getroot()
+        old_domain = root.find('name').text
+        root.find('name').text = domain
+        root.remove(root.find('uuid'))
+        for disk in root.findall("./devices/disk[@device='disk']"):
+            target = disk.find('target').get('dev')
+            source = disk.find('source')
+            image = os.path.basename(source.get('file')).replace(
+                old_domain, domain)
+            source.set('file', create_overlay(
+                image, os.path.join(self.path, disks[target])))
+            # libvirt probes the new backing chain
+            for backing in disk.findall('backingStore'):
+                disk.remove(backing)
+        with tempfile.NamedTemporaryFile('w', suffix='.xml') as fh:
+            tree.write(fh, encoding='unicode')
+            fh.flush()
+            virsh('define', fh.name)
+
+    def verify_addresses(self):
+        """
+        Check the restored VMs got the addresses of the checkpoint, which the
+        provisioned configuration refers to
+        """
+        for machine, saved in self.manifest.items():
+            addresses = domain_addresses(self.domain_prefix + machine)
+            if addresses != saved['addresses']:
+                raise TaskException(
+                    self, '{machine} got addresses {new} instead of '
+                    '{old}'.format(machine=machine, new=addresses,
+                                   old=saved['addresses']))
+
+    def discard(self):
+        """Remove what was restored, after a failed restore"""
+        for domain in job_domains(self.domain_prefix):
+            PopenTask(['virsh', 'destroy', domain], raise_on_err=False)()
+            PopenTask(['virsh', 'undefine', '--remove-all-storage', domain],
+                      raise_on_err=False)()
+        shutil.rmtree(os.path.join(self.data_dir, '.vagrant'),
+                      ignore_errors=True)
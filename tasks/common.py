@@ -1,30 +1,45 @@
 import abc
 import errno
+import glob
 import logging
 import os
+import re
 import signal
 import subprocess
 import threading
+import time
 from collections.abc import Callable as AbcCallable
-from typing import Callable, List, Text
+from typing import TYPE_CHECKING, Text
 
 import jinja2
-import psutil
 
 from . import constants
 
+if TYPE_CHECKING:
+    from .cgroup import JobCgroup
+
 ERROR_STRINGS = [
     'Domain is not running',
 ]
 
+# Output signatures of failures a job can't recover from. A process printing
+# any of them is killed right away instead of running until its timeout.
+FATAL_PATTERNS = [
+    ('libvirt', r'Call to virDomainCreateWithFlags failed'
+                r'|error: Failed to (?:start|create) domain'
+                r'|Call to virStoragePoolLookupByName failed'
+                r'|Error while activating network'),
+    ('disk-full', r'No space left on device'),
+    ('dnf-mirror', r'Cannot download repomd\.xml'
+                   r'|Failed to download metadata for repo'
+                   r'|All mirrors were tried'),
+    ('unreachable', r'fatal: \[[^\]]+\]: UNREACHABLE!'),
+]
+
 LOG_FILE_HANDLER = None
 LOG_FORMAT = '%(asctime)-15s %(levelname)8s  %(message)s'
 
 
-PopenFileType = type(psutil._pslinux.popenfile)
-KillPredicateType = Callable[[PopenFileType], bool]
-
-
 def message_contains_error(message):
     for error_string in ERROR_STRINGS:
         if error_string in message:
@@ -60,13 +75,58 @@ class PopenException(TaskException):
             error=self.task.returncode)
 
 
+class FatalOutputException(PopenException):
+    def __init__(self, task, reason):
+        super(FatalOutputException, self).__init__(task)
+        self.reason = reason
+        self.msg = 'aborted on fatal output ({reason})'.format(reason=reason)
+
+
+class DependencyException(TaskException):
+    """A task the job depends on failed, so the job can't be finished"""
+    def __init__(self, task, msg='dependency failed'):
+        super(DependencyException, self).__init__(task, msg)
+
+
+class OutputClassifier(object):
+    """
+    Streaming classifier of process output.
+
+    All signatures are compiled into a single regular expression, so every
+    line is scanned once regardless of the number of signatures.
+    """
+    def __init__(self, patterns=None):
+        if patterns is None:
+            patterns = FATAL_PATTERNS
+        self.reasons = {}
+        alternatives = []
+        for index, (reason, pattern) in enumerate(patterns):
+            group = 'p{index}'.format(index=index)
+            self.reasons[group] = reason
+            alternatives.append('(?P<{group}>{pattern})'.format(
+                group=group, pattern=pattern))
+        self.regex = re.compile('|'.join(alternatives))
+
+    def classify(self, message):
+        """Return the reason matching the message, or None"""
+        match = self.regex.search(message)
+        if match is None:
+            return None
+        return self.reasons[match.lastgroup]
+
+
 class Task(AbcCallable):
     __metaclass__ = abc.ABCMeta
+    trace_category = 'task'
 
     def __init__(self, timeout=120):
         self.timeout = timeout
         self.tasks = []
         self.exc = None
+        self.tracer = None
+        self.cgroup = None
+        # seconds spent in the phases of the task
+        self.phase_durations = {}
 
     def execute_subtask(self, task):
         """
@@ -77,8 +137,16 @@ class Task(AbcCallable):
         able to kill the child process and the timeout won't work properly.
         """
         self.tasks.append(task)
+        for attr in ('tracer', 'cgroup'):
+            if getattr(task, attr) is None:
+                setattr(task, attr, getattr(self, attr))
         task()
 
+    def trace_event(self, name, **args):
+        """Record an instant event (e.g. a retry) if the task is traced"""
+        if self.tracer is not None:
+            self.tracer.instant(name, **args)
+
     @abc.abstractmethod
     def _run(self):
         pass
@@ -97,19 +165,45 @@ class Task(AbcCallable):
             task.terminate()
         self._terminate()
 
+    def __phase(self, phase):
+        start = time.time()
+        try:
+            if self.tracer is None:
+                return phase()
+            with self.tracer.span('{task} {phase}'.format(
+                    task=self, phase=phase.__name__), cat='phase'):
+                return phase()
+        finally:
+            self.phase_durations[phase.__name__.lstrip('_')] = (
+                time.time() - start)
+
     def __target(self):
         self.exc = None
         try:
             try:
-                self._before()
-                self._run()
+                self.__phase(self._before)
+                self.__phase(self._run)
             finally:
-                self._after()
+                self.__phase(self._after)
         except Exception as exc:
             self.exc = exc
 
     def __call__(self):
         logging.info('Executing: {task}'.format(task=self))
+        if self.tracer is None:
+            return self.__execute()
+        with self.tracer.span(str(self), cat=self.trace_category) as args:
+            try:
+                self.__execute()
+            except Exception as exc:
+                args['error'] = str(exc)
+                raise
+            finally:
+                returncode = getattr(self, 'returncode', None)
+                if returncode is not None:
+                    args['returncode'] = returncode
+
+    def __execute(self):
         thread = threading.Thread(target=self.__target)
         thread.start()
         thread.join(self.timeout)
@@ -142,23 +236,40 @@ class FallibleTask(Task):
 
 
 class PopenTask(FallibleTask):
-    def __init__(self, cmd, shell=False, env=None, **kwargs):
+    trace_category = 'popen'
+
+    def __init__(self, cmd, shell=False, env=None, classifier=None,
+                 **kwargs):
+        """
+        classifier: OutputClassifier; the process is killed as soon as it
+                    prints a line matching one of its signatures
+        """
         super(PopenTask, self).__init__(**kwargs)
         self.cmd = cmd
         self.shell = shell
         self.env = env
+        self.classifier = classifier
+        self.fatal_reason = None
         self.process = None
         self.returncode = None
         if self.env is not None:
             self.env = os.environ.copy()
             self.env.update(env)
 
+    def _preexec(self):
+        os.setsid()
+        if self.cgroup is not None:
+            try:
+                self.cgroup.attach()
+            except (OSError, IOError):
+                pass
+
     def _run(self):
         self.process = subprocess.Popen(
             self.cmd,
             shell=self.shell,
             env=self.env,
-            preexec_fn=os.setsid,
+            preexec_fn=self._preexec,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT)
 
@@ -169,10 +280,20 @@ class PopenTask(FallibleTask):
                 # Force error if message contains some error but exit code is 0
                 force_error = True
             logging.debug(message)
+            if self.classifier is not None:
+                self.fatal_reason = self.classifier.classify(message)
+                if self.fatal_reason is not None:
+                    logging.error('Fatal output detected ({reason}), '
+                                  'aborting {task}'.format(
+                                      reason=self.fatal_reason, task=self))
+                    os.killpg(self.process.pid, signal.SIGKILL)
+                    break
 
         self.process.wait()
         self.returncode = self.process.returncode
         self.process = None
+        if self.fatal_reason is not None:
+            raise FatalOutputException(self, self.fatal_reason)
         if force_error:
             self.returncode = 1
         if self.returncode != 0:
@@ -227,59 +348,22 @@ def create_file_from_template(template_path, dest, data):
         fh.write(rendered_template)
 
 
-def get_processes(pname: Text) -> List[psutil.Process]:
-    """Gets all of the processes by name"""
-    return [
-        proc for proc in psutil.process_iter(
-            attrs=["pid", "name", "open_files"]
-        ) if pname in proc.info["name"]
-    ]
-
-
-def kill_processes(proc_list: List[psutil.Process],
-                   kill_predicate: KillPredicateType) -> None:
-    """Kills the processes using given predicate"""
-    for proc in proc_list:
-        open_files = proc.info["open_files"]
-        if open_files is None:
-            continue
-        for open_file in open_files:
-            if kill_predicate(open_file):
-                proc.send_signal(signal.SIGKILL)
-
+def kill_vagrant_processes(cgroup: "JobCgroup") -> None:
+    """Kills all of Vagrant (and other) processes spawned by a job"""
+    cgroup.kill()
 
-def get_ruby_processes() -> List[psutil.Process]:
-    """Because every Vagrant process is just a Ruby one"""
-    return get_processes("ruby-mri")
 
+def kill_vagrant_vms(domain_prefix: Text) -> None:
+    """Kills the QEMU processes of Vagrant created VMs of a job
 
-def get_qemu_processes() -> List[psutil.Process]:
-    """Fetches every QEMU process on the host"""
-    return get_processes("qemu-system-x86_64")
-
-
-def kill_vagrant_processes() -> None:
-    """Kills all of Vagrant processes"""
-    return kill_processes(get_ruby_processes(), lambda f: "vagrant" in f.path)
-
-
-def kill_vagrant_vms() -> None:
-    """Kills all of Vagrant created VMs"""
-    def predicate(f: PopenFileType) -> bool:
-        roles = ["master", "replica", "controller", "client"]
-        return any([role in f.path for role in roles])
-
-    return kill_processes(get_qemu_processes(), predicate)
-
-
-def destroy_libvirt_domains() -> None:
-    """Destroy all libvirt domains by calling 'virsh' cli application"""
-    logging.info("Destroying all libvirt domains.")
-    res_virs_list = subprocess.run(
-        ["virsh", "list", "--all", "--name"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    for domain in res_virs_list.stdout.decode().strip().splitlines():
-        subprocess.run(["virsh", "destroy", domain])
-        subprocess.run(["virsh", "undefine", "--remove-all-storage", domain])
+    libvirt keeps a pid file for every running domain, so only the job's
+    own VMs are looked up and killed.
+    """
+    pid_files = glob.glob(constants.LIBVIRT_QEMU_PIDFILE.format(
+        domain='{}*'.format(domain_prefix)))
+    for pid_file in pid_files:
+        try:
+            with open(pid_file) as pid_f:
+                os.kill(int(pid_f.read().strip()), signal.SIGKILL)
+        except (OSError, IOError, ValueError) as exc:
+            logging.debug(exc, exc_info=True)
@@ -12,6 +12,10 @@ CLOUD_JOBS_DIR = 'jobs/'
 CLOUD_JOBS_URL = urllib.parse.urljoin(CLOUD_URL, CLOUD_JOBS_DIR)
 CLOUD_DB = 'PRCI_JOB_RUN'
 CLOUD_REGION = 'eu-central-1'
+CLOUD_BUILD_CACHE_DIR = 'build-cache/'
+
+# Bump to invalidate all cached builds, e.g. when the build process changes
+BUILD_CACHE_VERSION = 1
 
 TASKS_DIR = os.path.join(BASE_DIR, 'tasks')
 
@@ -21,11 +25,91 @@ BUILD_FAILED_DESCRIPTION = "(✖╭╮✖)"
 UUID_RE = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 
 RUNNER_LOG = 'runner.log'
+TRACE_FILE = 'trace.json'
 FREEIPA_PRCI_REPOFILE = 'freeipa-prci.repo'
 ANSIBLE_VARS_TEMPLATE = '{action_name}.vars.yml'
 VAGRANTFILE_TEMPLATE = os.path.join('vagrantfiles', 'Vagrantfile.{vagrantfile_name}')
-VAGRANT_IMAGE_PATH = '/root/.vagrant.d/boxes/{name}/{version}/{provider}/box.img'
-LIBVIRT_IMAGE_PATH = '/var/lib/libvirt/images/{libvirt_name}_{version}.img'
+VAGRANT_BOXES_DIR = '/root/.vagrant.d/boxes'
+VAGRANT_IMAGE_PATH = os.path.join(VAGRANT_BOXES_DIR,
+                                  '{name}/{version}/{provider}/box.img')
+LIBVIRT_IMAGES_DIR = '/var/lib/libvirt/images'
+LIBVIRT_IMAGE_PATH = os.path.join(LIBVIRT_IMAGES_DIR,
+                                  '{libvirt_name}_{version}.img')
+LIBVIRT_QEMU_PIDFILE = '/run/libvirt/qemu/{domain}.pid'
+
+VIRSH_TIMEOUT = 120
+# jobs whose domains are removed at the same time
+DOMAIN_REAPER_WORKERS = 4
+
+# Direct libvirt driver (see libvirt_driver.py)
+VAGRANT_INSECURE_KEY = '/root/.vagrant.d/insecure_private_key'
+DIRECT_NETWORK = 'vagrant-libvirt'
+DIRECT_BOOT_TIMEOUT = 10*60
+DIRECT_REBOOT_DELAY = 10
+DIRECT_SSH_PERSIST = 600  # seconds an idle SSH connection is kept
+
+BOX_INVENTORY_DB = '/root/.config/freeipa-pr-ci/vagrant_boxes.sqlite'
+
+# Eviction of boxes (see box_eviction.py)
+BOX_MIN_FREE = 0.1  # fraction of the boxes partition
+BOX_QUEUED_TTL = 60*60  # boxes of open PRs not seen since then can go
+BOX_DOWNLOAD_OVERHEAD = 60  # seconds
+BOX_DOWNLOAD_RATE = 20 * 2**20  # bytes per second
+
+# Prefetching of boxes used by open PRs (see box_prefetch.py); partial
+# downloads are kept on the boxes partition so they can be resumed
+BOX_PREFETCH_DIR = '/root/.vagrant.d/prci-prefetch'
+BOX_PREFETCH_INTERVAL = 60
+BOX_PREFETCH_TIMEOUT = 60  # seconds without data
+VAGRANT_CATALOG_URL = 'https://vagrantcloud.com'
+
+# Topology limits (see libvirt.ApplyTopologyLimits)
+CPU_QUOTA_PERIOD = 100000  # default CFS period in microseconds
+QEMU_MEMORY_OVERHEAD = 512  # MB
+RESOURCES_FILE = 'resources.json'
+RIGHT_SIZE_RATIO = 0.5
+
+# Runner-local mirrors of build repositories (see repo_mirror.py)
+BUILD_REPO_MIRROR_TIMEOUT = 60
+BUILD_REPO_MIRROR_WORKERS = 4
+BUILD_REPO_MIRROR_MAX_AGE = 3*24*60*60
+
+# Warm pool of booted VMs (see warm_pool.py)
+WARM_POOL_INTERVAL = 30
+WARM_POOL_HISTORY = 20  # jobs
+WARM_POOL_BOOT_TIMEOUT = 30*60
+
+# Checkpoints of provisioned VMs (see checkpoint.py); on the libvirt images
+# partition, so disks can be copied by reflink
+CHECKPOINT_DIR = '/var/lib/libvirt/images/prci-checkpoints'
+CHECKPOINT_MAX_AGE = 24*60*60
+CHECKPOINT_MIN_FREE = 0.2  # fraction of the partition
+CHECKPOINT_TIMEOUT = 15*60
+
+# Test results are written to the guest's disk and copied to /vagrant, the
+# uncached sshfs share, in one go
+GUEST_RESULTS_DIR = '/var/tmp/prci-results/'
+RESULTS_COPY_TIMEOUT = 5*60
+
+# Sharded test runs (see sharding.py)
+TEST_DURATIONS_FILE = os.path.join(BASE_DIR, 'test-durations.json')
+COLLECTED_TESTS_FILE = 'collected-tests.txt'
+SHARD_TESTS_FILE = 'shard-tests.txt'
+
+# Re-runs of failed tests only
+PREVIOUS_JUNIT_FILE = 'previous-junit.xml'
+PREVIOUS_JUNIT_TIMEOUT = 60
+RERUN_TESTS_FILE = 'rerun-tests.txt'
+PYTEST_USAGE_ERROR = 4
+
+# Job durations (see durations.py)
+JOB_DURATIONS_HISTORY = 50  # runs of every task
+JOB_DURATIONS_MIN_SAMPLES = 5
+STALE_P99_FACTOR = 1.5
+STALE_TIMEOUT_MIN = 30 * 60  # seconds
+
+CGROUP_MOUNT = '/sys/fs/cgroup'
+CGROUP_RUNNER_LEAF = 'runner'
 
 ANSIBLE_CFG_FILE = os.path.join(TEMPLATES_DIR, 'ansible.cfg')
 
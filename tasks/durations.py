@@ -0,0 +1,109 @@
+"""
+Durations of the jobs run on the runner, so the scheduler knows how long a
+task usually takes.
+
+Every successful full run of a job (not reusing a cached build, a checkpoint or
+results of a previous run) records the durations of its phases (before,
+provision, tests, run, after) and its total duration, keyed by the task name,
+template and topology.
+Only the last JOB_DURATIONS_HISTORY runs of every key are kept.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+import tasks
+
+from . import constants
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_durations (
+    key TEXT NOT NULL,
+    finished REAL NOT NULL,
+    returncode INTEGER,
+    total REAL NOT NULL,
+    phases TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_durations_key
+    ON job_durations (key, finished);
+"""
+
+
+def duration_key(task_name, template, topology):
+    """
+    Key of durations of a task, from the task name and its template and
+    topology arguments as defined in the tasks file
+    """
+    if not isinstance(template, dict):
+        template = {}
+    if not isinstance(topology, dict):
+        topology = {}
+    return '{task} {template} {topology}'.format(
+        task=task_name, template=template.get('name'),
+        topology=topology.get('name'))
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of values"""
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def estimate(key):
+    """
+    Estimates of the duration of a task from the runner's job durations,
+    None if unknown
+    """
+    if tasks.JOB_DURATIONS is None:
+        return None
+    try:
+        return tasks.JOB_DURATIONS.estimate(key)
+    except sqlite3.Error as exc:
+        logging.warning('Failed to estimate job duration: %s', exc)
+        return None
+
+
+class JobDurations(object):
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self):
+        # jobs record from their own threads, so every call connects
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, key, total, phases, returncode=None):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT INTO job_durations '
+                '(key, finished, returncode, total, phases) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, time.time(), returncode, total, json.dumps(phases)))
+            conn.execute(
+                'DELETE FROM job_durations WHERE key = ? AND rowid NOT IN '
+                '(SELECT rowid FROM job_durations WHERE key = ? '
+                'ORDER BY finished DESC LIMIT ?)',
+                (key, key, constants.JOB_DURATIONS_HISTORY))
+
+    def totals(self, key):
+        with self.connect() as conn:
+            rows = conn.execute(
+                'SELECT total FROM job_durations '
+                'WHERE key = ? AND returncode = 0', (key,))
+            return [total for (total,) in rows]
+
+    def estimate(self, key):
+        """
+        Return p50, p95 and p99 of the total duration of the key's jobs as
+        {50: seconds, ...}, None if there are too few of them
+        """
+        totals = self.totals(key)
+        if len(totals) < constants.JOB_DURATIONS_MIN_SAMPLES:
+            return None
+        return {percent: percentile(totals, percent)
+                for percent in (50, 95, 99)}
@@ -0,0 +1,94 @@
+"""
+Helpers for the junit.xml files written by pytest of test jobs.
+"""
+
+import xml.etree.ElementTree as ET
+
+
+COUNTERS = ['tests', 'failures', 'errors', 'skipped']
+
+
+def node_id(case):
+    """Return the pytest node ID of a testcase element"""
+    # classname is the dotted module path followed by the test classes
+    parts = case.get('classname', '').split('.')
+    split = next((index for index, part in enumerate(parts)
+                  if part[:1].isupper()), len(parts))
+    module = '/'.join(parts[:split]) + '.py'
+    return '::'.join([module] + parts[split:] + [case.get('name')])
+
+
+def outcome(case):
+    """Return failures, errors, skipped or None of a testcase element"""
+    for tag, counter in (('failure', 'failures'), ('error', 'errors'),
+                         ('skipped', 'skipped')):
+        if case.find(tag) is not None:
+            return counter
+    return None
+
+
+def cases(path):
+    """Yield (node ID, duration) of the test cases of a junit.xml"""
+    root = ET.parse(path).getroot()
+    for case in root.iter('testcase'):
+        try:
+            duration = float(case.get('time', 0))
+        except ValueError:
+            continue
+        yield node_id(case), duration
+
+
+def failed_tests(path):
+    """Return node IDs of the failed test cases of a junit.xml"""
+    root = ET.parse(path).getroot()
+    return sorted({node_id(case) for case in root.iter('testcase')
+                   if outcome(case) in ('failures', 'errors')})
+
+
+def suites(root):
+    return [root] if root.tag == 'testsuite' else root.findall('testsuite')
+
+
+def merge(paths, dest):
+    """Merge test suites of several junit.xml files into one"""
+    merged = ET.Element('testsuites')
+    totals = dict.fromkeys(COUNTERS, 0)
+    time = 0.0
+    for path in paths:
+        for suite in suites(ET.parse(path).getroot()):
+            for counter in COUNTERS:
+                totals[counter] += int(suite.get(counter, 0))
+            time = max(time, float(suite.get('time', 0)))
+            merged.append(suite)
+    for counter, value in totals.items():
+        merged.set(counter, str(value))
+    merged.set('time', str(time))
+    ET.ElementTree(merged).write(dest, encoding='utf-8',
+                                 xml_declaration=True)
+    return totals
+
+
+def replace_results(path, rerun_path, dest):
+    """
+    Write junit.xml with results of test cases of path replaced by their
+    results in rerun_path, return the totals
+    """
+    rerun = {node_id(case): case
+             for case in ET.parse(rerun_path).getroot().iter('testcase')}
+    tree = ET.parse(path)
+    totals = dict.fromkeys(COUNTERS, 0)
+    for suite in suites(tree.getroot()):
+        counts = dict.fromkeys(COUNTERS, 0)
+        for index, case in enumerate(list(suite)):
+            if case.tag != 'testcase':
+                continue
+            case = rerun.get(node_id(case), case)
+            suite[index] = case
+            counts['tests'] += 1
+            if outcome(case) is not None:
+                counts[outcome(case)] += 1
+        for counter, value in counts.items():
+            suite.set(counter, str(value))
+            totals[counter] += value
+    tree.write(dest, encoding='utf-8', xml_declaration=True)
+    return totals
@@ -0,0 +1,314 @@
+"""
+Helpers working with the libvirt domains of a single job. vagrant-libvirt
+names the domains '<project directory>_<machine>', so the domains of a job are
+the ones prefixed by its UUID. Jobs running next to each other on the runner
+only ever touch their own domains.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from . import constants
+from .common import FallibleTask, PopenTask, TaskException
+
+
+def job_domains(domain_prefix):
+    """List the names of the libvirt domains of a job"""
+    res = subprocess.run(
+        ['virsh', 'list', '--all', '--name'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        timeout=constants.VIRSH_TIMEOUT,
+    )
+    return [
+        domain for domain in res.stdout.decode().strip().splitlines()
+        if domain.startswith(domain_prefix)
+    ]
+
+
+def stop_domain(domain):
+    subprocess.run(['virsh', 'destroy', domain],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   timeout=constants.VIRSH_TIMEOUT)
+
+
+def undefine_domain(domain):
+    """Remove the domain with its disks"""
+    res = subprocess.run(
+        ['virsh', 'undefine', '--remove-all-storage', domain],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if res.returncode != 0:
+        logging.warning('Failed to remove {domain}: {error}'.format(
+            domain=domain, error=res.stdout.decode().strip()))
+
+
+class DomainReaper(object):
+    """
+    Tears down the domains of finished jobs. The domains of a job are all
+    stopped at once right away, so the resources they took are free for the
+    next job; their disks are removed in the background.
+    """
+    def __init__(self, workers=constants.DOMAIN_REAPER_WORKERS):
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def reap(self, domain_prefix, cleanup=None):
+        """
+        Tear down the domains of a job; cleanup is called in the background
+        once they are gone. An empty prefix tears down every domain.
+        """
+        domains = job_domains(domain_prefix)
+        if domains:
+            logging.info('Stopping {count} domains of {prefix}*'.format(
+                count=len(domains), prefix=domain_prefix))
+            with ThreadPoolExecutor(len(domains)) as executor:
+                list(executor.map(stop_domain, domains))
+        future = self.executor.submit(self.remove, domains, cleanup)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def remove(self, domains, cleanup):
+        if domains:
+            with ThreadPoolExecutor(len(domains)) as executor:
+                list(executor.map(undefine_domain, domains))
+        if cleanup is not None:
+            cleanup()
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        if future.exception() is not None:
+            logging.warning('Teardown failed: {exc}'.format(
+                exc=future.exception()))
+
+    def wait(self):
+        """Wait for all teardowns to finish"""
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.exception()
+
+
+DOMAIN_REAPER = DomainReaper()
+
+
+def domain_info(domain):
+    """Return number of vCPUs and memory (in MB) of a domain"""
+    res = subprocess.run(
+        ['virsh', 'dominfo', domain],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        timeout=constants.VIRSH_TIMEOUT,
+    )
+    info = {}
+    for line in res.stdout.decode().splitlines():
+        key, _sep, value = line.partition(':')
+        info[key.strip()] = value.strip()
+    try:
+        vcpus = int(info['CPU(s)'])
+        memory = int(info['Max memory'].split()[0]) / 1024.0
+    except (KeyError, ValueError, IndexError):
+        raise TaskException(domain, 'unable to get domain info')
+    return vcpus, memory
+
+
+def virsh(*args):
+    """Run virsh, return its output"""
+    res = subprocess.run(
+        ('virsh',) + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        timeout=constants.VIRSH_TIMEOUT,
+    )
+    if res.returncode != 0:
+        raise TaskException(' '.join(('virsh',) + args),
+                            res.stdout.decode().strip())
+    return res.stdout.decode()
+
+
+def image_virtual_size(path):
+    """Return the size of the disk of an image in bytes"""
+    try:
+        res = subprocess.run(
+            ['qemu-img', 'info', '--force-share', '--output=json', path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+            timeout=constants.VIRSH_TIMEOUT)
+        return json.loads(res.stdout.decode())['virtual-size']
+    except (subprocess.SubprocessError, OSError, ValueError, KeyError):
+        raise TaskException(path, 'unable to get image size')
+
+
+def create_overlay(name, backing, pool='default'):
+    """
+    Create a thin qcow2 volume in the pool on top of the backing image and
+    return its path. The volume is registered by libvirt as it's created, so
+    the pool doesn't have to be refreshed.
+    """
+    virsh('vol-create-as', pool, name, str(image_virtual_size(backing)),
+          '--format', 'qcow2', '--backing-vol', backing,
+          '--backing-vol-format', 'qcow2')
+    return virsh('vol-path', '--pool', pool, name).strip()
+
+
+def domain_disks(domain):
+    """Return {target: source file} of the disks of a domain"""
+    disks = {}
+    for line in virsh('domblklist', domain, '--details').splitlines()[2:]:
+        fields = line.split()
+        if len(fields) == 4 and fields[:2] == ['file', 'disk']:
+            disks[fields[2]] = fields[3]
+    return disks
+
+
+def domain_addresses(domain):
+    """Return sorted IPv4 addresses the domain leased"""
+    addresses = []
+    for line in virsh('domifaddr', domain).splitlines()[2:]:
+        fields = line.split()
+        if len(fields) == 4 and fields[2] == 'ipv4':
+            addresses.append(fields[3].split('/')[0])
+    return sorted(addresses)
+
+
+def domain_pid(domain):
+    """Return PID of the QEMU process running the domain or None"""
+    try:
+        with open(constants.LIBVIRT_QEMU_PIDFILE.format(domain=domain)) as fh:
+            return int(fh.read().strip())
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def peak_rss(pid):
+    """Return the peak resident memory of a process in MB"""
+    with open('/proc/{pid}/status'.format(pid=pid)) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+class ApplyTopologyLimits(FallibleTask):
+    """
+    Turn the cpu and memory declared by the job's topology into real limits
+    of its QEMU processes, so a job can't starve the other jobs on the
+    runner.
+
+    The limits are split among the domains proportionally to their vCPUs and
+    memory. CPU is limited by a CFS quota, memory by a soft limit of the
+    domain's share and a hard limit leaving room for the QEMU overhead. VMs
+    of a topology declaring less memory than its guests have may get OOM
+    killed, so with hard_memory_limit=False memory is only soft-limited.
+    """
+    def __init__(self, domain_prefix, cpu=None, memory=None,
+                 hard_memory_limit=True, **kwargs):
+        super(ApplyTopologyLimits, self).__init__(**kwargs)
+        self.domain_prefix = domain_prefix
+        self.cpu = cpu
+        self.memory = memory
+        self.hard_memory_limit = hard_memory_limit
+
+    def _run(self):
+        if not self.cpu and not self.memory:
+            return
+        domains = {
+            domain: domain_info(domain)
+            for domain in job_domains(self.domain_prefix)
+        }
+        if not domains:
+            raise TaskException(self, 'no domains found')
+
+        total_vcpus = sum(vcpus for vcpus, _memory in domains.values())
+        total_memory = sum(memory for _vcpus, memory in domains.values())
+
+        for domain, (vcpus, memory) in domains.items():
+            if self.cpu:
+                quota = int(constants.CPU_QUOTA_PERIOD *
+                            self.cpu * vcpus / total_vcpus)
+                self.execute_subtask(
+                    PopenTask(['virsh', 'schedinfo', domain, '--live',
+                               '--set', 'global_quota={}'.format(quota)]))
+            if self.memory:
+                share = float(self.memory) * memory / total_memory
+                cmd = ['virsh', 'memtune', domain, '--live',
+                       '--soft-limit', str(int(share * 1024))]
+                if self.hard_memory_limit:
+                    hard_limit = share + constants.QEMU_MEMORY_OVERHEAD
+                    cmd += ['--hard-limit', str(int(hard_limit * 1024))]
+                self.execute_subtask(PopenTask(cmd))
+            logging.info('Limited {domain} to {cpu} CPU, {memory}MB'.format(
+                domain=domain,
+                cpu=(self.cpu * vcpus / total_vcpus) if self.cpu else '-',
+                memory=int(share) if self.memory else '-'))
+
+
+class CollectResourceUsage(FallibleTask):
+    """
+    Measure the CPU time and peak memory the QEMU processes of a job used
+    and store them with the declared topology in the job directory, so
+    over-declared topologies can be right-sized.
+    """
+    def __init__(self, domain_prefix, data_dir, cpu=None, memory=None,
+                 **kwargs):
+        super(CollectResourceUsage, self).__init__(**kwargs)
+        self.domain_prefix = domain_prefix
+        self.data_dir = data_dir
+        self.cpu = cpu
+        self.memory = memory
+
+    def _run(self):
+        now = time.time()
+        usage = {}
+        for domain in job_domains(self.domain_prefix):
+            pid = domain_pid(domain)
+            if pid is None:
+                continue
+            try:
+                process = psutil.Process(pid)
+                cpu_times = process.cpu_times()
+                cpu_seconds = cpu_times.user + cpu_times.system
+                runtime = now - process.create_time()
+                memory = peak_rss(pid)
+            except (psutil.Error, OSError, IOError) as exc:
+                logging.debug(exc, exc_info=True)
+                continue
+            usage[domain] = {
+                'cpu_seconds': round(cpu_seconds, 1),
+                'cpu_average': round(cpu_seconds / max(runtime, 1), 2),
+                'memory_peak': int(memory),
+            }
+
+        if not usage:
+            raise TaskException(self, 'no running domains found')
+
+        used_cpu = sum(u['cpu_average'] for u in usage.values())
+        used_memory = sum(u['memory_peak'] for u in usage.values())
+        resources = {
+            'declared': {'cpu': self.cpu, 'memory': self.memory},
+            'used': {'cpu_average': round(used_cpu, 2),
+                     'memory_peak': used_memory},
+            'domains': usage,
+        }
+        with open(os.path.join(self.data_dir,
+                               constants.RESOURCES_FILE), 'w') as fh:
+            json.dump(resources, fh, indent=2)
+
+        logging.info('Topology resource usage: {used_cpu} CPU on average, '
+                     '{used_memory}MB peak (declared {cpu} CPU, '
+                     '{memory}MB)'.format(
+                         used_cpu=round(used_cpu, 2), used_memory=used_memory,
+                         cpu=self.cpu, memory=self.memory))
+        if (self.memory and
+                used_memory < float(self.memory) * constants.RIGHT_SIZE_RATIO):
+            logging.warning('Topology memory looks over-declared: '
+                            '{used}MB used of {declared}MB'.format(
+                                used=used_memory, declared=self.memory))
@@ -0,0 +1,436 @@
+"""
+Driver bringing up the VMs of a job directly through libvirt instead of
+vagrant, so a job doesn't pay for the start of vagrant and its plugins in
+every step and for a new SSH session in every command.
+
+The machines are read from the job's Vagrantfile: every machine gets a thin
+qcow2 overlay volume on top of the box image, in the libvirt pool the
+Vagrantfile puts its disk in, and a domain named '<uuid>_<machine>' as
+vagrant-libvirt would name it, attached to the vagrant-libvirt management
+network. The job directory is shared to /vagrant by virtiofs. The ansible
+provisioners of the Vagrantfile are run with an inventory written where
+vagrant writes its own, so the playbooks run by jobs find their hosts.
+Commands run in the VMs share a persistent SSH connection.
+
+Playbooks split into 'host' and 'topology' plays (see provision.yml) are run
+pipelined: the host plays run on every machine as soon as it answers on SSH,
+only the topology plays wait for all of them.
+
+Only the Vagrantfiles this driver fully understands are driven by it (e.g.
+not ones with Windows machines), the others are left to vagrant.
+"""
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from . import constants
+from .common import FallibleTask, PopenTask, TaskException, OutputClassifier
+from .libvirt import (DOMAIN_REAPER, create_overlay, domain_addresses,
+                      virsh)
+
+
+MACHINE_RE = re.compile(
+    r'^\s*config\.vm\.define\s+"(?P<name>[\w-]+)"\s*(?P<options>[^\n]*?)'
+    r'\s*do\s*\|\w+\|', re.M)
+CPUS_RE = re.compile(r'domain\.cpus\s*=\s*(\d+)')
+MEMORY_RE = re.compile(r'domain\.memory\s*=\s*(\d+)')
+PLAYBOOK_RE = re.compile(r'ansible\.playbook\s*=\s*"([^"]+)"')
+EXTRA_VARS_RE = re.compile(r'ansible\.extra_vars\s*=\s*"([^"]+)"')
+LIMIT_RE = re.compile(r'ansible\.limit\s*=\s*"([^"]+)"')
+POOL_RE = re.compile(r'domain\.snapshot_pool_name\s*=\s*"([^"]+)"')
+# settings which need vagrant, e.g. machines with boxes of their own
+UNSUPPORTED_RE = re.compile(
+    r'winrm|communicator|private_network|forwarded_port|type:\s*"nfs"'
+    r'|\b(?!config\b)\w+\.vm\.(?:box|synced_folder)\b')
+
+DOMAIN_XML = """<domain type='kvm'>
+  <name>{name}</name>
+  <memory unit='MiB'>{memory}</memory>
+  <vcpu>{cpus}</vcpu>
+  <cpu mode='host-passthrough'/>
+  <memoryBacking>
+    <source type='memfd'/>
+    <access mode='shared'/>
+  </memoryBacking>
+  <os>
+    <type arch='x86_64'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+  </features>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2' cache='unsafe'/>
+      <source file='{disk}'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <interface type='network'>
+      <source network='{network}'/>
+      <model type='virtio'/>
+    </interface>
+    <filesystem type='mount' accessmode='passthrough'>
+      <driver type='virtiofs'/>
+      <source dir='{shared_dir}'/>
+      <target dir='vagrant'/>
+    </filesystem>
+    <serial type='pty'/>
+    <console type='pty'/>
+  </devices>
+</domain>
+"""
+
+
+class Machine(object):
+    def __init__(self, name, cpus, memory, primary=False, playbook=None,
+                 extra_vars=None, limit=None, pool='default'):
+        self.name = name
+        self.cpus = cpus
+        self.memory = memory
+        self.pool = pool
+        self.primary = primary
+        self.playbook = playbook
+        self.extra_vars = extra_vars
+        self.limit = limit
+        self.address = None
+
+
+def parse_vagrantfile(content):
+    """
+    Return the machines of a rendered Vagrantfile, None if it uses anything
+    the driver doesn't support
+    """
+    if UNSUPPORTED_RE.search(content):
+        return None
+    defines = list(MACHINE_RE.finditer(content))
+    if not defines:
+        return None
+
+    # libvirt provider defaults precede the machines
+    defaults = content[:defines[0].start()]
+    default_cpus = int((CPUS_RE.findall(defaults) or [1])[-1])
+    default_memory = int((MEMORY_RE.findall(defaults) or [512])[-1])
+    default_pool = (POOL_RE.findall(defaults) or ['default'])[-1]
+
+    machines = []
+    for index, define in enumerate(defines):
+        end = (defines[index + 1].start() if index + 1 < len(defines)
+               else len(content))
+        body = content[define.end():end]
+        playbook = PLAYBOOK_RE.search(body)
+        extra_vars = EXTRA_VARS_RE.search(body)
+        limit = LIMIT_RE.search(body)
+        machines.append(Machine(
+            define.group('name'),
+            int((CPUS_RE.findall(body) or [default_cpus])[-1]),
+            int((MEMORY_RE.findall(body) or [default_memory])[-1]),
+            primary='primary: true' in define.group('options'),
+            playbook=playbook.group(1) if playbook else None,
+            extra_vars=extra_vars.group(1) if extra_vars else None,
+            limit=limit.group(1) if limit else None,
+            pool=(POOL_RE.findall(body) or [default_pool])[-1]))
+    if not any(machine.primary for machine in machines):
+        machines[0].primary = True
+    return machines
+
+
+class LibvirtDriver(object):
+    def __init__(self, machines, domain_prefix, data_dir, base_image):
+        """
+        machines: Machine of the topology, from parse_vagrantfile
+        domain_prefix: prefix of the names of the job's domains
+        data_dir: job directory, shared to the VMs as /vagrant
+        base_image: box image in the libvirt pool the disks are based on
+        """
+        self.machines = machines
+        self.domain_prefix = domain_prefix
+        self.data_dir = data_dir
+        self.base_image = base_image
+
+    @classmethod
+    def from_vagrantfile(cls, path, domain_prefix, data_dir, base_image):
+        """Return the driver of the Vagrantfile, None if it needs vagrant"""
+        with open(path) as fh:
+            machines = parse_vagrantfile(fh.read())
+        if machines is None:
+            return None
+        return cls(machines, domain_prefix, data_dir, base_image)
+
+    @property
+    def primary(self):
+        return next(machine for machine in self.machines if machine.primary)
+
+    def domain(self, machine):
+        return '{prefix}{name}'.format(prefix=self.domain_prefix,
+                                       name=machine.name)
+
+    def volume(self, machine):
+        """Name of the machine's disk in its pool"""
+        return '{}.img'.format(self.domain(machine))
+
+    @property
+    def control_dir(self):
+        return os.path.join(self.data_dir, '.ssh')
+
+    @property
+    def inventory_path(self):
+        # where vagrant writes the inventory, as used by ansible.cfg
+        return os.path.join(self.data_dir, '.vagrant', 'provisioners',
+                            'ansible', 'inventory')
+
+    def ssh_options(self):
+        return [
+            '-i', constants.VAGRANT_INSECURE_KEY,
+            '-l', 'root',
+            '-o', 'IdentitiesOnly=yes',
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'LogLevel=ERROR',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}/%C'.format(self.control_dir),
+            '-o', 'ControlPersist={}'.format(
+                constants.DIRECT_SSH_PERSIST),
+        ]
+
+    def ssh_command(self, cmd, machine=None):
+        """Command running cmd in the machine, the primary one by default"""
+        machine = machine or self.primary
+        return ['ssh'] + self.ssh_options() + [machine.address, cmd]
+
+    def write_inventory(self, machines=None, path=None):
+        """Write the inventory of the machines, all by default"""
+        path = path or self.inventory_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write('# Generated by the direct libvirt driver\n')
+            for machine in machines or self.machines:
+                fh.write(
+                    "{name} ansible_host={address} ansible_port=22 "
+                    "ansible_user='root' "
+                    "ansible_ssh_private_key_file='{key}'\n".format(
+                        name=machine.name, address=machine.address,
+                        key=constants.VAGRANT_INSECURE_KEY))
+        return path
+
+    def define(self, machine):
+        disk = create_overlay(self.volume(machine), self.base_image,
+                              machine.pool)
+        with tempfile.NamedTemporaryFile('w', suffix='.xml') as xml:
+            xml.write(DOMAIN_XML.format(
+                name=self.domain(machine), memory=machine.memory,
+                cpus=machine.cpus, disk=disk,
+                network=constants.DIRECT_NETWORK,
+                shared_dir=self.data_dir))
+            xml.flush()
+            virsh('define', xml.name)
+
+    def wait_for_address(self, machine, deadline):
+        while time.time() < deadline:
+            addresses = domain_addresses(self.domain(machine))
+            if addresses:
+                return addresses[0]
+            time.sleep(1)
+        raise TaskException(self.domain(machine), 'got no IP address')
+
+    def wait_for_ssh(self, machine, deadline):
+        while time.time() < deadline:
+            res = subprocess.run(
+                self.ssh_command('true', machine),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=constants.VIRSH_TIMEOUT)
+            if res.returncode == 0:
+                return
+            time.sleep(1)
+        raise TaskException(self.domain(machine), 'SSH is not available')
+
+    def start(self):
+        """Define and start the domains of all machines"""
+        os.makedirs(self.control_dir, exist_ok=True)
+        for machine in self.machines:
+            self.define(machine)
+            virsh('start', self.domain(machine))
+
+    def wait_ready(self, machine, deadline):
+        """Wait until the machine answers on SSH and mount /vagrant in it"""
+        machine.address = self.wait_for_address(machine, deadline)
+        self.wait_for_ssh(machine, deadline)
+        subprocess.run(
+            self.ssh_command('mkdir -p /vagrant && '
+                             'mount -t virtiofs vagrant /vagrant', machine),
+            check=True, timeout=constants.VIRSH_TIMEOUT)
+
+    def phased_provisioner(self):
+        """
+        Return the machine whose playbook is split into the 'host' plays,
+        which may run on every host as soon as it's up, and the 'topology'
+        plays needing all hosts, None if there is no such machine
+        """
+        for machine in self.machines:
+            if machine.playbook is None:
+                continue
+            try:
+                with open(os.path.join(self.data_dir,
+                                       machine.playbook)) as fh:
+                    plays = yaml.safe_load(fh) or []
+            except (OSError, IOError, yaml.YAMLError):
+                continue
+            tags = set()
+            for play in plays:
+                play_tags = play.get('tags', []) if isinstance(
+                    play, dict) else []
+                if isinstance(play_tags, str):
+                    play_tags = [play_tags]
+                tags.update(play_tags)
+            if {'host', 'topology'} <= tags:
+                return machine
+        return None
+
+    def playbook_command(self, machine, limit=None, tags=None,
+                         inventory=None):
+        """ansible-playbook command of the provisioner of the machine"""
+        cmd = ['ansible-playbook',
+               '--inventory-file={}'.format(inventory or self.inventory_path),
+               '--limit={}'.format(limit or machine.limit or machine.name)]
+        if tags:
+            cmd.append('--tags={}'.format(tags))
+        if machine.extra_vars:
+            cmd.append('--extra-vars=@{}'.format(machine.extra_vars))
+        cmd.append(machine.playbook)
+        return cmd
+
+    def provision_commands(self, exclude=None):
+        """ansible-playbook commands of the provisioners of the machines"""
+        return [self.playbook_command(machine) for machine in self.machines
+                if machine.playbook is not None and machine is not exclude]
+
+    def reboot(self):
+        for machine in self.machines:
+            virsh('reboot', self.domain(machine))
+        # the old connections are dead
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        os.makedirs(self.control_dir, exist_ok=True)
+        # give the VMs time to go down before waiting for SSH
+        time.sleep(constants.DIRECT_REBOOT_DELAY)
+        deadline = time.time() + constants.DIRECT_BOOT_TIMEOUT
+        for machine in self.machines:
+            self.wait_for_ssh(machine, deadline)
+            subprocess.run(
+                self.ssh_command('mount -t virtiofs vagrant /vagrant',
+                                 machine),
+                timeout=constants.VIRSH_TIMEOUT)
+
+    def destroy(self):
+        for machine in self.machines:
+            if machine.address is not None:
+                subprocess.run(
+                    ['ssh', '-o', 'ControlPath={}/%C'.format(
+                        self.control_dir), '-O', 'exit', machine.address],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    timeout=constants.VIRSH_TIMEOUT)
+        DOMAIN_REAPER.reap(self.domain_prefix, cleanup=self.remove_disks)
+
+    def remove_disks(self):
+        """Remove disks left behind by domains which were never defined"""
+        for machine in self.machines:
+            subprocess.run(['virsh', 'vol-delete', '--pool', machine.pool,
+                            self.volume(machine)],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL,
+                           timeout=constants.VIRSH_TIMEOUT)
+
+
+class DirectUp(FallibleTask):
+    def __init__(self, driver, **kwargs):
+        super(DirectUp, self).__init__(**kwargs)
+        self.driver = driver
+
+    def _run(self):
+        logging.info('Starting {count} machines through libvirt'.format(
+            count=len(self.driver.machines)))
+        try:
+            self.driver.start()
+        except (subprocess.SubprocessError, OSError) as exc:
+            raise TaskException(self, str(exc))
+
+
+class DirectProvision(FallibleTask):
+    """
+    Wait for the machines started by DirectUp and provision them, every
+    machine on its own as soon as it's up where the playbook allows it
+    """
+    def __init__(self, driver, **kwargs):
+        super(DirectProvision, self).__init__(**kwargs)
+        self.driver = driver
+
+    def run_playbook(self, cmd):
+        self.execute_subtask(
+            PopenTask(cmd, env={'ANSIBLE_FORCE_COLOR': 'false'},
+                      classifier=OutputClassifier(), timeout=None))
+
+    def prepare(self, machine, provisioner, deadline):
+        try:
+            self.driver.wait_ready(machine, deadline)
+        except (subprocess.SubprocessError, OSError) as exc:
+            raise TaskException(self, str(exc))
+        if provisioner is None:
+            return
+        logging.info('{name} is up, provisioning it'.format(
+            name=machine.name))
+        inventory = self.driver.write_inventory(
+            [machine], '{}.{}'.format(self.driver.inventory_path,
+                                      machine.name))
+        self.run_playbook(self.driver.playbook_command(
+            provisioner, limit=machine.name, tags='host',
+            inventory=inventory))
+
+    def _run(self):
+        driver = self.driver
+        provisioner = driver.phased_provisioner()
+        deadline = time.time() + constants.DIRECT_BOOT_TIMEOUT
+        with ThreadPoolExecutor(len(driver.machines)) as executor:
+            futures = [
+                executor.submit(self.prepare, machine, provisioner, deadline)
+                for machine in driver.machines]
+        errors = [future.exception() for future in futures
+                  if future.exception() is not None]
+        if errors:
+            raise errors[0]
+        driver.write_inventory()
+
+        if provisioner is not None:
+            self.run_playbook(driver.playbook_command(
+                provisioner, tags='topology'))
+        for cmd in driver.provision_commands(exclude=provisioner):
+            self.run_playbook(cmd)
+
+
+class DirectReload(FallibleTask):
+    def __init__(self, driver, **kwargs):
+        super(DirectReload, self).__init__(**kwargs)
+        self.driver = driver
+
+    def _run(self):
+        logging.info('Rebooting machines.')
+        try:
+            self.driver.reboot()
+        except (subprocess.SubprocessError, OSError) as exc:
+            raise TaskException(self, str(exc))
+
+
+class DirectDestroy(FallibleTask):
+    def __init__(self, driver, **kwargs):
+        super(DirectDestroy, self).__init__(**kwargs)
+        self.driver = driver
+
+    def _run(self):
+        logging.info('Destroying machines.')
+        self.driver.destroy()
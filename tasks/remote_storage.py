@@ -1,16 +1,21 @@
+import gzip
 import json
 import os
 import re
+import shutil
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto3
+import requests
+from botocore.exceptions import ClientError
 from jinja2 import Template
 
 from .common import PopenTask, TaskException, FallibleTask
 from .constants import (CLOUD_JOBS_DIR, CLOUD_JOBS_URL, CLOUD_URL, CLOUD_DIR,
                         CLOUD_BUCKET, CLOUD_DB, CLOUD_REGION, UUID_RE,
-                        JOBS_DIR, TASKS_DIR)
+                        CLOUD_BUILD_CACHE_DIR, JOBS_DIR, TASKS_DIR)
 
 """
 Previously we were updating test results in Fedora infra where the results were
@@ -104,28 +109,35 @@ def create_local_indeces(uuid, pr_number, pr_author, task_name, returncode,
 
 
 def save_jobdir_metadata(uuid, repo_owner, pr_number, pr_author, task_name,
-                           returncode):
+                           returncode, durations=None):
     """
     Update particular job dir metadata to DynamoDB table.
     """
     dynamodb = boto3.resource('dynamodb', region_name=CLOUD_REGION)
     table = dynamodb.Table(CLOUD_DB)
 
-    table.put_item(
-        Item={
-            'name': uuid,
-            'repo_owner': repo_owner,
-            'pr_number': pr_number,
-            'pr_author': pr_author,
-            'task_name': task_name,
-            'returncode': returncode,
-            'mtime': datetime.now().strftime('%Y-%m-%d %H:%M'),
-        }
-    )
+    item = {
+        'name': uuid,
+        'repo_owner': repo_owner,
+        'pr_number': pr_number,
+        'pr_author': pr_author,
+        'task_name': task_name,
+        'returncode': returncode,
+        'mtime': datetime.now().strftime('%Y-%m-%d %H:%M'),
+    }
+    if durations:
+        item['durations'] = rounded_durations(durations)
+    table.put_item(Item=item)
+
+
+def rounded_durations(durations):
+    """Durations of job phases in whole seconds"""
+    return {phase: int(round(seconds))
+            for phase, seconds in durations.items()}
 
 
 def create_metadata_json(src, uuid, repo_owner, pr_number, pr_author,
-                         task_name, returncode):
+                         task_name, returncode, durations=None):
     """
     Save particular job metadata into job UUID directory for external tools
     usage
@@ -139,30 +151,116 @@ def create_metadata_json(src, uuid, repo_owner, pr_number, pr_author,
         'returncode': returncode,
         'mtime': datetime.now().strftime('%Y-%m-%d %H:%M'),
         }
+    if durations:
+        metadata['durations'] = rounded_durations(durations)
     with open(os.path.join(src, 'metadata.json'), 'w') as file_obj:
         json.dump(metadata, file_obj)
 
 
-class GzipLogFiles(PopenTask):
-    def __init__(self, directory, **kwargs):
-        super(GzipLogFiles, self).__init__(self, **kwargs)
+def get_build_cache_entry(key):
+    """
+    Get the build cache entry (UUID of the build job) stored for the key,
+    None if there is no such build.
+    """
+    s3 = boto3.client('s3', region_name=CLOUD_REGION)
+    try:
+        obj = s3.get_object(
+            Bucket=CLOUD_BUCKET,
+            Key='{prefix}{key}.json'.format(prefix=CLOUD_BUILD_CACHE_DIR,
+                                            key=key))
+    except ClientError as exc:
+        if exc.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    return json.loads(obj['Body'].read().decode())
+
+
+def save_build_cache_entry(key, uuid):
+    """
+    Store the build job UUID in the build cache, so other runners can reuse
+    the build.
+    """
+    s3 = boto3.client('s3', region_name=CLOUD_REGION)
+    entry = {
+        'uuid': uuid,
+        'mtime': datetime.now().strftime('%Y-%m-%d %H:%M'),
+    }
+    s3.put_object(
+        Bucket=CLOUD_BUCKET,
+        Key='{prefix}{key}.json'.format(prefix=CLOUD_BUILD_CACHE_DIR, key=key),
+        Body=json.dumps(entry).encode(),
+        ContentType='application/json')
+
+
+def build_repo_available(job_url):
+    """Check the RPM repository of a published build job still exists"""
+    try:
+        res = requests.head(
+            '{job_url}/rpms/repodata/repomd.xml'.format(job_url=job_url),
+            timeout=30)
+    except requests.RequestException:
+        return False
+    return res.status_code == 200
+
+
+# files of a job directory which are left uncompressed
+GZIP_EXCLUDED_DIRS = {'.vagrant', 'assets', 'rpms'}
+GZIP_EXCLUDED_NAMES = {'Vagrantfile', 'ipa-test-config.yaml', 'vars.yml',
+                       'ansible.cfg', 'report.html', 'resources.json'}
+GZIP_EXCLUDED_SUFFIXES = ('.gz', '.png')
+
+
+def log_files(directory):
+    """Yield paths of the files of a job directory to be compressed"""
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if name not in GZIP_EXCLUDED_DIRS]
+        for name in files:
+            if (name in GZIP_EXCLUDED_NAMES or
+                    name.endswith(GZIP_EXCLUDED_SUFFIXES)):
+                continue
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                yield path
+
+
+def gzip_file(path, level):
+    """Replace the file by its gzipped copy, like gzip does"""
+    gz_path = path + '.gz'
+    try:
+        with open(path, 'rb') as src, \
+                gzip.open(gz_path, 'wb', compresslevel=level) as dst:
+            shutil.copyfileobj(src, dst, 2**20)
+        shutil.copystat(path, gz_path)
+    except (OSError, IOError):
+        if os.path.exists(gz_path):
+            os.unlink(gz_path)
+        raise
+    os.unlink(path)
+
+
+class GzipLogFiles(FallibleTask):
+    """
+    Gzip the logs of a job directory. zlib doesn't hold the GIL while
+    compressing, so the files are compressed by a pool of threads.
+    """
+    def __init__(self, directory, level=6, workers=None, **kwargs):
+        super(GzipLogFiles, self).__init__(**kwargs)
         self.directory = directory
-        self.cmd = (
-            'find {directory} '
-            '-type f '
-            '! -path "*/.vagrant/*" '
-            '-a ! -path "*/assets/*" '
-            '-a ! -path "*/rpms/*" '
-            '-a ! -name "*.gz" '
-            '-a ! -name "*.png" '
-            '-a ! -name "Vagrantfile" '
-            '-a ! -name "ipa-test-config.yaml" '
-            '-a ! -name "vars.yml" '
-            '-a ! -name "ansible.cfg" '
-            '-a ! -name "report.html" '
-            '-exec gzip "{{}}" \;'
-        ).format(directory=directory)
-        self.shell = True
+        self.level = level
+        self.workers = workers or os.cpu_count()
+
+    def _run(self):
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = {path: executor.submit(gzip_file, path, self.level)
+                       for path in log_files(self.directory)}
+        errors = {path: future.exception()
+                  for path, future in futures.items()
+                  if future.exception() is not None}
+        if errors:
+            path, exc = next(iter(errors.items()))
+            raise TaskException(
+                self, 'failed to compress {count} files, e.g. {path}: '
+                '{exc}'.format(count=len(errors), path=path, exc=exc))
 
 
 class CloudUpload(FallibleTask):
@@ -170,7 +268,7 @@ class CloudUpload(FallibleTask):
     Upload PRCI job task artifacts to AWS S3 cloud.
     """
     def __init__(self, uuid, repo_owner, pr_number, pr_author, task_name,
-                 returncode, **kwargs):
+                 returncode, durations=None, **kwargs):
         if not re.match(UUID_RE, uuid):
             raise TaskException(self, "Invalid job UUID")
         super(CloudUpload, self).__init__(**kwargs)
@@ -180,6 +278,7 @@ class CloudUpload(FallibleTask):
         self.pr_author = pr_author if not None else ''
         self.task_name = task_name if not None else ''
         self.returncode = str(returncode) if not None else ''
+        self.durations = durations
 
     def _run(self):
         # make sure we don't leak fqdn
@@ -189,7 +288,7 @@ class CloudUpload(FallibleTask):
 
         create_metadata_json(src, self.uuid, self.repo_owner,
                              self.pr_number, self.pr_author,
-                             self.task_name, self.returncode)
+                             self.task_name, self.returncode, self.durations)
 
         create_local_indeces(
             uuid=self.uuid,
@@ -222,7 +321,7 @@ class CreateRootIndex(FallibleTask):
     """
 
     def __init__(self, uuid, repo_owner, pr_number, pr_author, task_name,
-                 returncode, **kwargs):
+                 returncode, durations=None, **kwargs):
         if not re.match(UUID_RE, uuid):
             raise TaskException(self, "Invalid job UUID")
         super(CreateRootIndex, self).__init__(**kwargs)
@@ -232,8 +331,9 @@ class CreateRootIndex(FallibleTask):
         self.pr_author = pr_author if not None else ''
         self.task_name = task_name if not None else ''
         self.returncode = str(returncode) if not None else ''
+        self.durations = durations
 
     def _run(self):
         save_jobdir_metadata(self.uuid, self.repo_owner,
                              self.pr_number, self.pr_author,
-                             self.task_name, self.returncode)
+                             self.task_name, self.returncode, self.durations)
@@ -0,0 +1,181 @@
+"""
+Every VM of a test job installs the RPMs of the build the job tests. Instead of
+downloading them from the cloud storage in every VM of every job, the build
+repository is mirrored once per runner into a directory served to the VMs
+(see the runner role) and the VMs use the mirror.
+
+Mirrors are keyed by the UUID of the build job, which never changes its
+content, so a complete mirror can be used without any revalidation.
+"""
+
+import fcntl
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import constants
+from .common import FallibleTask, TaskException
+
+
+REPO_NS = {'repo': 'http://linux.duke.edu/metadata/repo'}
+COMMON_NS = {'common': 'http://linux.duke.edu/metadata/common'}
+
+
+def build_uuid(build_url):
+    """Return the UUID of the build job the URL points to"""
+    match = re.search('({uuid})/?$'.format(uuid=constants.UUID_RE),
+                      build_url)
+    if match is None:
+        raise ValueError('no build job UUID in {}'.format(build_url))
+    return match.group(1)
+
+
+def download(url, path):
+    """Download url to path, return sha256 of the content"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    checksum = hashlib.sha256()
+    with requests.get(url, stream=True,
+                      timeout=constants.BUILD_REPO_MIRROR_TIMEOUT) as res:
+        res.raise_for_status()
+        with open(path, 'wb') as fh:
+            for chunk in res.iter_content(chunk_size=1024 * 1024):
+                checksum.update(chunk)
+                fh.write(chunk)
+    return checksum.hexdigest()
+
+
+def repodata_files(repomd_path):
+    """List the repodata files and the primary metadata referenced by repomd"""
+    root = ET.parse(repomd_path).getroot()
+    files = []
+    primary = None
+    for data in root.findall('repo:data', REPO_NS):
+        href = data.find('repo:location', REPO_NS).get('href')
+        files.append(href)
+        if data.get('type') == 'primary':
+            primary = href
+    if primary is None:
+        raise ValueError('repomd.xml has no primary metadata')
+    return files, primary
+
+
+def repo_packages(primary_path):
+    """List (location, sha256 or None) of the packages of the repository"""
+    opener = gzip.open if primary_path.endswith('.gz') else open
+    with opener(primary_path, 'rb') as fh:
+        root = ET.parse(fh).getroot()
+    packages = []
+    for package in root.findall('common:package', COMMON_NS):
+        href = package.find('common:location', COMMON_NS).get('href')
+        checksum = package.find('common:checksum', COMMON_NS)
+        sha256 = None
+        if checksum is not None and checksum.get('type') == 'sha256':
+            sha256 = checksum.text
+        packages.append((href, sha256))
+    return packages
+
+
+class MirrorBuildRepo(FallibleTask):
+    """
+    Mirror the RPM repository of a build job into mirror_dir/<build UUID>.
+
+    Jobs running in parallel on the runner may want the same build, so the
+    mirror is filled under a lock into a temporary directory which is renamed
+    into place when complete. The repository metadata is taken as is, only
+    its package list is used to know what to download.
+    """
+    def __init__(self, build_url, mirror_dir, **kwargs):
+        super(MirrorBuildRepo, self).__init__(**kwargs)
+        self.build_url = build_url.rstrip('/') + '/'
+        self.mirror_dir = mirror_dir
+        self.uuid = build_uuid(build_url)
+
+    @property
+    def path(self):
+        return os.path.join(self.mirror_dir, self.uuid)
+
+    def is_complete(self):
+        return os.path.exists(
+            os.path.join(self.path, 'rpms', 'repodata', 'repomd.xml'))
+
+    def _run(self):
+        os.makedirs(self.mirror_dir, exist_ok=True)
+        lock_path = os.path.join(self.mirror_dir,
+                                 '.{uuid}.lock'.format(uuid=self.uuid))
+        with open(lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.is_complete():
+                logging.info('Using mirrored build repo {uuid}'.format(
+                    uuid=self.uuid))
+            else:
+                self.fill()
+                self.prune()
+        os.utime(self.path)
+
+    def fill(self):
+        start = time.time()
+        tmp_dir = tempfile.mkdtemp(prefix='.{}-'.format(self.uuid),
+                                   dir=self.mirror_dir)
+        try:
+            repo_url = self.build_url + 'rpms/'
+            repo_dir = os.path.join(tmp_dir, 'rpms')
+            repomd = os.path.join(repo_dir, 'repodata', 'repomd.xml')
+            download(repo_url + 'repodata/repomd.xml', repomd)
+            metadata, primary = repodata_files(repomd)
+            for href in metadata:
+                download(repo_url + href, os.path.join(repo_dir, href))
+            packages = repo_packages(os.path.join(repo_dir, primary))
+
+            def fetch(package):
+                href, sha256 = package
+                checksum = download(repo_url + href,
+                                    os.path.join(repo_dir, href))
+                if sha256 is not None and checksum != sha256:
+                    raise ValueError('checksum mismatch of {}'.format(href))
+
+            with ThreadPoolExecutor(
+                    constants.BUILD_REPO_MIRROR_WORKERS) as executor:
+                list(executor.map(fetch, packages))
+
+            try:
+                download(repo_url + constants.FREEIPA_PRCI_REPOFILE,
+                         os.path.join(repo_dir,
+                                      constants.FREEIPA_PRCI_REPOFILE))
+            except requests.HTTPError:
+                pass  # not needed by the VMs, the mirror is used as baseurl
+
+            os.chmod(tmp_dir, 0o755)
+            os.rename(tmp_dir, self.path)
+        except (requests.RequestException, ValueError, OSError,
+                ET.ParseError) as exc:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logging.debug(exc, exc_info=True)
+            raise TaskException(self, 'failed to mirror build repo: {}'.format(
+                exc))
+        logging.info('Mirrored build repo {uuid} ({count} packages) in '
+                     '{seconds}s'.format(uuid=self.uuid, count=len(packages),
+                                         seconds=int(time.time() - start)))
+
+    def prune(self):
+        """Remove mirrors which weren't used for a while"""
+        limit = time.time() - constants.BUILD_REPO_MIRROR_MAX_AGE
+        for entry in os.scandir(self.mirror_dir):
+            if (entry.is_dir() and re.match(constants.UUID_RE, entry.name)
+                    and entry.stat().st_mtime < limit):
+                logging.info('Removing unused build repo mirror {}'.format(
+                    entry.name))
+                shutil.rmtree(entry.path, ignore_errors=True)
+                try:
+                    os.unlink(os.path.join(
+                        self.mirror_dir, '.{}.lock'.format(entry.name)))
+                except OSError:
+                    pass
@@ -0,0 +1,164 @@
+"""
+Sharded execution of a test suite on several instances of its topology.
+
+The job's own VMs run the first shard, every other shard gets a copy of the
+topology in a vagrant project next to the job directory (jobs/<uuid>_shardN,
+so its libvirt domains are prefixed with the job's UUID too and are covered
+by the job's cleanup). The test node IDs are collected once, split into
+shards of about the same duration, as known from the previous runs on the
+runner, and the results of the shards are merged into the job's junit.xml and
+report.html.
+"""
+
+import fcntl
+import heapq
+import json
+import logging
+import os
+import shutil
+import xml.etree.ElementTree as ET
+
+import tasks
+
+from . import constants, junit
+from .common import PopenTask, OutputClassifier, TaskException
+from .libvirt import ApplyTopologyLimits
+
+
+def parse_collected(output):
+    """Return the test node IDs from output of pytest --collect-only -q"""
+    return sorted(line.strip() for line in output.splitlines()
+                  if '::' in line)
+
+
+def split_tests(node_ids, count, durations):
+    """
+    Split node IDs into count shards of about the same total duration
+
+    Tests are assigned longest first, each to the shard with the lowest
+    total so far. Tests without known duration count as the median of the
+    known ones.
+    """
+    known = sorted(durations[node_id] for node_id in node_ids
+                   if node_id in durations)
+    default = known[(len(known) - 1) // 2] if known else 1.0
+
+    def duration(node_id):
+        return durations.get(node_id, default)
+
+    shards = [[] for _i in range(count)]
+    heap = [(0.0, index) for index in range(count)]
+    for node_id in sorted(node_ids, key=lambda n: (-duration(n), n)):
+        total, index = heapq.heappop(heap)
+        shards[index].append(node_id)
+        heapq.heappush(heap, (total + duration(node_id), index))
+    return [sorted(shard) for shard in shards]
+
+
+def write_report_index(shards, totals, dest):
+    """Write report.html linking the HTML reports of the shards"""
+    rows = ''.join(
+        '<li><a href="shard-{index}/report.html">shard {index}</a> '
+        '({count} tests)</li>\n'.format(index=index, count=len(node_ids))
+        for index, node_ids in enumerate(shards) if node_ids)
+    with open(dest, 'w') as fh:
+        fh.write(
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+            '<title>Test report</title></head><body>\n'
+            '<h1>Test report</h1>\n'
+            '<p>{tests} tests, {failures} failures, {errors} errors, '
+            '{skipped} skipped in {count} shards</p>\n'
+            '<ul>\n{rows}</ul>\n</body></html>\n'.format(
+                count=len(shards), rows=rows, **totals))
+
+
+class TestDurations(object):
+    """Durations of tests run on the runner, learned from junit.xml files"""
+    def __init__(self, path=constants.TEST_DURATIONS_FILE):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (OSError, IOError, ValueError):
+            return {}
+
+    def update(self, junit_path):
+        try:
+            cases = dict(junit.cases(junit_path))
+        except (OSError, IOError, ET.ParseError) as exc:
+            logging.warning('Failed to read test durations: {}'.format(exc))
+            return
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            durations = self.load()
+            durations.update(cases)
+            tmp_path = '{}.{}'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as fh:
+                json.dump(durations, fh)
+            os.rename(tmp_path, self.path)
+
+
+class Shard(object):
+    """Additional instance of a job's topology running one of its shards"""
+    def __init__(self, job_uuid, index):
+        self.index = index
+        self.name = '{uuid}_shard{index}'.format(uuid=job_uuid, index=index)
+        self.task = None
+        self.terminated = False
+
+    @property
+    def path(self):
+        return os.path.join(constants.JOBS_DIR, self.name)
+
+    @property
+    def env(self):
+        return {'VAGRANT_CWD': self.path}
+
+    @property
+    def domain_prefix(self):
+        return '{name}_'.format(name=self.name)
+
+    def prepare(self, data_dir):
+        """Create the vagrant project from the job's one"""
+        os.makedirs(self.path)
+        for name in ['ansible.cfg', 'Vagrantfile', 'vars.yml']:
+            shutil.copy(os.path.join(data_dir, name), self.path)
+
+    def bring_up(self, job):
+        for cmd in (['vagrant', 'up', '--no-provision', '--parallel'],
+                    ['vagrant', 'provision']):
+            if self.terminated:
+                raise TaskException(job, 'shard {index} terminated'.format(
+                    index=self.index))
+            self.task = PopenTask(cmd, env=self.env,
+                                  classifier=OutputClassifier(), timeout=None)
+            job.execute_subtask(self.task)
+            if cmd[1] == 'up' and tasks.ENFORCE_TOPOLOGY_LIMITS:
+                # same limits as the job's own VMs, see __setup_provision
+                job.execute_subtask(
+                    ApplyTopologyLimits(
+                        domain_prefix=self.domain_prefix,
+                        cpu=job.topology_cpu,
+                        memory=job.topology_memory,
+                        hard_memory_limit=tasks.TOPOLOGY_MEMORY_HARD_LIMIT,
+                        raise_on_err=False))
+
+    def terminate(self):
+        """Stop bringing up the shard, e.g. when the job failed"""
+        self.terminated = True
+        if self.task is not None:
+            self.task.terminate()
+
+    def collect_results(self, data_dir):
+        """Copy the shard's test results into the job directory"""
+        results = 'shard-{index}'.format(index=self.index)
+        shutil.copytree(os.path.join(self.path, results),
+                        os.path.join(data_dir, results))
+
+    def destroy(self):
+        if os.path.exists(os.path.join(self.path, 'Vagrantfile')):
+            PopenTask(['vagrant', 'destroy', '--force'], env=self.env,
+                      raise_on_err=False)()
+        shutil.rmtree(self.path, ignore_errors=True)
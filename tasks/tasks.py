@@ -1,24 +1,61 @@
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
 import socket
+import sqlite3
+import time
 import urllib
 import uuid
 import subprocess
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import tasks
 
 from .ansible import AnsiblePlaybook
-from .common import (FallibleTask, TaskException, PopenTask,
-                     logging_init_file_handler, create_file_from_template)
-from . import constants
-from .remote_storage import GzipLogFiles, CloudUpload, CreateRootIndex
-from .vagrant import with_vagrant
+from .box_eviction import BOX_USAGE
+from .cgroup import JobCgroup
+from .durations import duration_key
+from .libvirt_driver import LibvirtDriver
+from .common import (FallibleTask, TaskException, PopenTask, OutputClassifier,
+                     DependencyException, PopenException,
+                     logging_init_file_handler, create_file_from_template,
+                     kill_vagrant_processes, kill_vagrant_vms)
+from . import constants, junit
+from .repo_mirror import MirrorBuildRepo
+from .sharding import (Shard, TestDurations, parse_collected, split_tests,
+                       write_report_index)
+from .remote_storage import (GzipLogFiles, CloudUpload, CreateRootIndex,
+                             get_build_cache_entry, save_build_cache_entry,
+                             build_repo_available)
+from .tracing import Tracer
+from .vagrant import with_vagrant, VagrantBox, VagrantCleanup
 
 
 class JobTask(FallibleTask):
+    # provisioned VMs can be saved and restored, see checkpoint.py
+    checkpointable = False
+    # instances of the topology the job runs on, see sharding.py
+    shards = 1
+
     def __init__(self, template, no_destroy=False, publish_artifacts=True,
                  link_image=True, pr_number=None, pr_author=None,
-                 task_name=None, repo_owner=None, **kwargs):
+                 task_name=None, repo_owner=None, trace=False,
+                 topology=None, git_tree=None, resolve_args=None, **kwargs):
+        """
+        resolve_args: callable waiting for the tasks the job depends on and
+                      returning arguments of the job which depend on their
+                      results, None when any of them failed; used by jobs
+                      started before their dependencies finished
+        """
         super(JobTask, self).__init__(**kwargs)
+        self.duration_key = duration_key(task_name, template, topology)
         self.template_name = template['name']
         self.template_version = template['version']
         self.publish_artifacts = publish_artifacts
@@ -33,19 +70,69 @@ class JobTask(FallibleTask):
         self.pr_author = pr_author
         self.task_name = task_name
         self.repo_owner = repo_owner
+        self.git_tree = git_tree
+        self.resolve_args = resolve_args
+        # set on termination to stop waiting for the dependencies
+        self.terminated = threading.Event()
+        if resolve_args is not None and self.timeout:
+            # the job also waits for its dependencies
+            self.timeout += constants.BUILD_TIMEOUT
+        if trace:
+            self.tracer = Tracer()
+        if not topology:
+            topology = {}
+        self.topology_cpu = topology.get('cpu')
+        self.topology_memory = topology.get('memory')
+        # libvirt pool of the VMs' disks, if they are thrown away on a
+        # scratch pool
+        self.scratch_pool = (tasks.SCRATCH_POOL
+                             if topology.get('scratch_disk') else None)
+        self.warm = False
+        self.restored = False
+        # set once with_vagrant is done with the VMs (destroyed them)
+        self.vms_destroyed = False
+        # libvirt_driver.LibvirtDriver if the VMs aren't vagrant's
+        self.driver = None
 
     @property
     def vagrantfile(self):
         return constants.VAGRANTFILE_TEMPLATE.format(
             vagrantfile_name=self.action_name)
 
+    @property
+    def checkpoint_key(self):
+        """
+        Key of the checkpoint of the job's provisioned VMs, None if the job
+        doesn't use checkpoints
+        """
+        if not (tasks.CHECKPOINTS and self.checkpointable and self.git_tree
+                and self.task_name and self.driver is None):
+            return None
+        key = [self.git_tree, self.task_name, self.template_name,
+               self.template_version]
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    @property
+    def full_run(self):
+        """
+        False if the job took a shortcut (e.g. restored a checkpoint), so its
+        duration says little about how long the task takes
+        """
+        return not self.restored
+
     @property
     def data_dir(self):
         return os.path.join(constants.JOBS_DIR, self.uuid)
 
+    @property
+    def domain_prefix(self):
+        # vagrant-libvirt prefixes domain names with the project directory
+        return '{uuid}_'.format(uuid=self.uuid)
+
     def compress_logs(self):
         self.execute_subtask(
-            GzipLogFiles(self.data_dir, raise_on_err=False))
+            GzipLogFiles(self.data_dir, level=tasks.LOG_COMPRESSION_LEVEL,
+                         raise_on_err=False))
 
     def write_hostname_to_file(self):
         try:
@@ -67,10 +154,45 @@ class JobTask(FallibleTask):
             logging.warning("Failed to write pr-ci-version file")
             logging.debug(exc, exc_info=True)
 
+    def write_trace(self):
+        """
+        Dump the trace of the job so far, so it's published with the other
+        artifacts. Spans still running (e.g. the upload) are left open.
+        """
+        if self.tracer is None:
+            return
+        try:
+            self.tracer.dump(os.path.join(self.data_dir, constants.TRACE_FILE))
+        except Exception as exc:
+            logging.warning("Failed to write trace file")
+            logging.debug(exc, exc_info=True)
+
+    def claim_warm_vms(self):
+        """
+        Take over booted VMs from the warm pool, if it has ones for the
+        job's template and Vagrantfile
+        """
+        # the pool doesn't account for the scratch space its VMs would take
+        if tasks.WARM_POOL is None or self.scratch_pool:
+            return
+        pool_uuid = tasks.WARM_POOL.claim(
+            (self.template_name, self.template_version, self.vagrantfile),
+            self.topology_cpu, self.topology_memory)
+        if pool_uuid is not None:
+            # the VMs are named after and share the pool entry's directory
+            self.uuid = pool_uuid
+            self.warm = True
+
     def _before(self):
+        try:
+            self.claim_warm_vms()
+        finally:
+            if tasks.WARM_POOL is not None:
+                tasks.WARM_POOL.end_claim()
+
         # Create job dir
         try:
-            os.makedirs(self.data_dir)
+            os.makedirs(self.data_dir, exist_ok=self.warm)
         except (OSError, IOError) as exc:
             msg = "Failed to create job directory"
             logging.critical(msg)
@@ -82,6 +204,11 @@ class JobTask(FallibleTask):
         logging_init_file_handler()
 
         logging.info("Initializing job {uuid}".format(uuid=self.uuid))
+        if self.warm:
+            logging.info("Using VMs booted by the warm pool")
+
+        # Run all processes spawned by the job in its own cgroup
+        self.cgroup = JobCgroup.create(self.uuid)
 
         # Create a hostname file for debugging purposes
         self.write_hostname_to_file()
@@ -96,15 +223,72 @@ class JobTask(FallibleTask):
                 self.vagrantfile,
                 os.path.join(self.data_dir, 'Vagrantfile'),
                 dict(vagrant_template_name=self.template_name,
-                     vagrant_template_version=self.template_version))
+                     vagrant_template_version=self.template_version,
+                     scratch_pool=self.scratch_pool))
         except (OSError, IOError) as exc:
             msg = "Failed to prepare job"
             logging.critical(msg)
             logging.debug(exc, exc_info=True)
             raise TaskException(self, msg)
 
+        if tasks.DIRECT_LIBVIRT and not self.warm:
+            self.driver = LibvirtDriver.from_vagrantfile(
+                os.path.join(self.data_dir, 'Vagrantfile'),
+                self.domain_prefix, self.data_dir,
+                VagrantBox(self.template_name,
+                           self.template_version).libvirt_path)
+            if self.driver is not None:
+                logging.info("Using the direct libvirt driver")
+
+    def ssh_command(self, cmd, env=None):
+        """
+        Command running cmd in the primary VM of the job, or of the vagrant
+        project given by env
+        """
+        if self.driver is not None and env is None:
+            return self.driver.ssh_command(cmd)
+        return ['vagrant', 'ssh', '-c', cmd]
+
+    def before_provision(self):
+        """Called by with_vagrant when the VMs are up, before provisioning"""
+        pass
+
+    def after_provision(self):
+        """Called by with_vagrant once the VMs are provisioned"""
+        pass
+
+    def release_cgroup(self):
+        """
+        Kill processes the job leaked, log its resource usage and remove
+        its cgroup
+        """
+        cgroup, self.cgroup = self.cgroup, None
+        if cgroup is None:
+            return
+        leaked = cgroup.pids()
+        if leaked:
+            logging.warning('Killing {count} processes leaked by the job: '
+                            '{pids}'.format(count=len(leaked), pids=leaked))
+            cgroup.kill()
+        logging.info('Job resource usage: {stats}'.format(
+            stats=cgroup.stats()))
+        cgroup.remove()
+
+    def destroy_unused_warm_vms(self):
+        """
+        Destroy warm VMs the job claimed but never got to use, e.g. as it
+        failed before bringing up its VMs
+        """
+        if self.warm and not self.vms_destroyed and not self.no_destroy:
+            self.execute_subtask(
+                VagrantCleanup(domain_prefix=self.domain_prefix,
+                               data_dir=self.data_dir, raise_on_err=False))
+
     def _after(self):
+        self.destroy_unused_warm_vms()
+        self.release_cgroup()
         self.compress_logs()
+        self.write_trace()
         if self.publish_artifacts:
             self.upload_artifacts()
             # list only "freeipa" and "freeipa-pr-ci2" repos PRs in root index
@@ -122,6 +306,7 @@ class JobTask(FallibleTask):
                             pr_author=self.pr_author,
                             task_name=self.task_name,
                             returncode=self.returncode,
+                            durations=self.phase_durations,
                             timeout=5*60))
         except Exception as exc:
             logging.debug(exc, exc_info=True)
@@ -147,12 +332,35 @@ class JobTask(FallibleTask):
                                 pr_author=self.pr_author,
                                 task_name=self.task_name,
                                 returncode=self.returncode,
+                                durations=self.phase_durations,
                                 timeout=30))
         except Exception as exc:
             logging.error('Failed to create jobs root index. This should not '
                           'affect base PRCI functionality')
             logging.debug(exc, exc_info=True)
 
+    def __call__(self):
+        start = time.time()
+        # the job's box must not be evicted for other jobs while it runs
+        BOX_USAGE.hold(self.template_name, self.template_version)
+        try:
+            super(JobTask, self).__call__()
+        finally:
+            BOX_USAGE.release(self.template_name, self.template_version)
+        self.record_durations(time.time() - start)
+
+    def record_durations(self, total):
+        # only successful full runs tell how long the task takes
+        if (tasks.JOB_DURATIONS is None or self.returncode != 0
+                or not self.full_run):
+            return
+        try:
+            tasks.JOB_DURATIONS.record(self.duration_key, total,
+                                       self.phase_durations, self.returncode)
+        except sqlite3.Error as exc:
+            logging.warning('Failed to record job durations: {exc}'.format(
+                exc=exc))
+
     def terminate(self):
         logging.critical(
             "Terminating execution, runtime exceeded {seconds}s".format(
@@ -163,24 +371,156 @@ class JobTask(FallibleTask):
         if stat.f_bavail == 0:
             logging.critical('No free disk space')
 
+        self.terminated.set()
         super(JobTask, self).terminate()
 
+        # Make sure nothing spawned by this job survives, without touching
+        # processes and VMs of other jobs
+        if self.cgroup is not None:
+            kill_vagrant_processes(self.cgroup)
+        if not self.no_destroy:
+            kill_vagrant_vms(self.domain_prefix)
+
 
 class Build(JobTask):
     action_name = 'build'
 
     def __init__(self, template, git_refspec=None, git_version=None, git_repo=None,
                  timeout=constants.BUILD_TIMEOUT, topology=None, copr=None,
-                 enable_testing_repo=False, **kwargs):
-        super(Build, self).__init__(template, timeout=timeout, **kwargs)
+                 enable_testing_repo=False, build_cache=True, **kwargs):
+        super(Build, self).__init__(template, timeout=timeout,
+                                    topology=topology, **kwargs)
         self.git_refspec = git_refspec
         self.git_version = git_version
         self.git_repo = git_repo
         self.copr = copr
         self.enable_testing_repo = enable_testing_repo
+        self.build_cache = build_cache
+        self.cached_url = None
+        # None until the build cache is looked up
+        self.build_cache_hit = None
+        self.mock_cache_path = None
+
+    @property
+    def build_cache_key(self):
+        """
+        Key of the build in the build cache, None if the build can't be
+        cached. The git tree sha identifies the sources regardless of the
+        commit (re-runs, rebased nightly PRs, forks).
+        """
+        # git_version may build something else than the PR's tree
+        if not self.build_cache or not self.git_tree or self.git_version:
+            return None
+        key_data = json.dumps([
+            constants.BUILD_CACHE_VERSION,
+            self.git_tree,
+            self.template_name,
+            self.template_version,
+            self.copr,
+            bool(self.enable_testing_repo),
+        ])
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    @property
+    def full_run(self):
+        return (super(Build, self).full_run
+                and not self.build_cache_hit)
+
+    def claim_warm_vms(self):
+        # a cached build needs no VMs, so look it up before taking any
+        if tasks.WARM_POOL is not None:
+            self.build_cache_hit = self.lookup_build_cache()
+            if self.build_cache_hit:
+                return
+        super(Build, self).claim_warm_vms()
 
-    @with_vagrant
     def _run(self):
+        if self.build_cache_hit is None:
+            self.build_cache_hit = self.lookup_build_cache()
+        if self.build_cache_hit:
+            logging.info('>>>>>> BUILD REUSED <<<<<<')
+            self.returncode = 0
+            return
+        self.prepare_mock_cache()
+        self.build_rpms()
+
+    def prepare_mock_cache(self):
+        """
+        Prepare the runner directory with mock caches for the template
+        version and build options, and drop the caches of other versions of
+        the template, which will not be used anymore.
+        """
+        if not tasks.MOCK_CACHE_DIR:
+            return
+        variant = []
+        if self.copr:
+            variant.append(re.sub(r'[^\w.-]', '_', self.copr))
+        if self.enable_testing_repo:
+            variant.append('updates-testing')
+        template_dir = os.path.join(
+            tasks.MOCK_CACHE_DIR,
+            VagrantBox(self.template_name, self.template_version).escaped_name)
+        try:
+            for version in os.listdir(template_dir):
+                if version != self.template_version:
+                    logging.info(
+                        'Removing mock cache of {name} {version}'.format(
+                            name=self.template_name, version=version))
+                    shutil.rmtree(os.path.join(template_dir, version))
+        except FileNotFoundError:
+            pass
+
+        path = os.path.join(template_dir, self.template_version,
+                            '-'.join(variant) or 'default')
+        try:
+            os.makedirs(path, exist_ok=True)
+        except (OSError, IOError) as exc:
+            logging.warning('Failed to create mock cache, building without it')
+            logging.debug(exc, exc_info=True)
+            return
+        self.mock_cache_path = path
+
+    def lookup_build_cache(self):
+        """
+        Look for a published build of the same sources with the same
+        options. On hit, the job result points to the cached build.
+        """
+        key = self.build_cache_key
+        if key is None:
+            return False
+        try:
+            entry = get_build_cache_entry(key)
+        except Exception as exc:
+            logging.warning('Failed to look up build cache')
+            logging.debug(exc, exc_info=True)
+            return False
+        if entry is None:
+            logging.info('Build cache miss for {key}'.format(key=key))
+            return False
+
+        url = urllib.parse.urljoin(constants.CLOUD_JOBS_URL, entry['uuid'])
+        if not build_repo_available(url):
+            logging.info('Cached build {url} is no longer available'.format(
+                url=url))
+            return False
+
+        logging.info('Build cache hit for {key}: {url}'.format(
+            key=key, url=url))
+        self.cached_url = url
+        return True
+
+    def save_build_cache(self):
+        key = self.build_cache_key
+        if key is None:
+            return
+        try:
+            save_build_cache_entry(key, self.uuid)
+        except Exception as exc:
+            logging.warning('Failed to save build to build cache')
+            logging.debug(exc, exc_info=True)
+
+    @with_vagrant
+    def build_rpms(self):
         try:
             self.build()
             logging.info('>>>>>> BUILD PASSED <<<<<<')
@@ -192,10 +532,13 @@ class Build(JobTask):
             self.collect_build_artifacts()
 
     def _after(self):
+        self.release_cgroup()
         self.compress_logs()
+        self.write_trace()
         if self.publish_artifacts:
             try:
-                self.create_yum_repo()
+                if self.cached_url is None:
+                    self.create_yum_repo()
             except TaskException:
                 logging.error('Failed to create repo')
                 self.returncode = 1
@@ -206,6 +549,13 @@ class Build(JobTask):
                 if self.repo_owner == 'freeipa':
                     self.create_root_index()
 
+            # Tests use packages of the cached build, the job itself only
+            # carries the logs
+            if self.cached_url is not None:
+                self.remote_url = self.cached_url
+            elif self.returncode == 0:
+                self.save_build_cache()
+
         if self.returncode == 0:
             self.description = constants.BUILD_PASSED_DESCRIPTION
         else:
@@ -220,7 +570,9 @@ class Build(JobTask):
                     'git_version': self.git_version,
                     'git_repo': self.git_repo,
                     'copr': self.copr,
-                    'enable_testing_repo': self.enable_testing_repo},
+                    'enable_testing_repo': self.enable_testing_repo,
+                    'mock_cache_dir': self.mock_cache_path},
+                classifier=OutputClassifier(),
                 timeout=None))
 
     def collect_build_artifacts(self):
@@ -248,13 +600,28 @@ class Build(JobTask):
 class RunPytest(JobTask):
     action_name = 'run_pytest'
     run_tests_cmd = 'ipa-run-tests'
+    # VMs can be brought up while the build is still running
+    prestageable = True
+    checkpointable = True
+    # tests can be split between instances of the topology, see sharding.py
+    shardable = True
+    # re-runs can run only the tests failed in the previous run
+    rerunnable = True
 
     def __init__(self, template, build_url, test_suite, topology=None,
                  timeout=constants.RUN_PYTEST_TIMEOUT, update_packages=False,
                  xmlrpc=False, selinux_enforcing=False, fips=False, copr=None,
-                 enable_testing_repo=False, trusted_domain=False, **kwargs):
-        super(RunPytest, self).__init__(template, timeout=timeout, **kwargs)
-        self.build_url = build_url + '/'
+                 enable_testing_repo=False, trusted_domain=False, shards=1,
+                 previous_url=None, **kwargs):
+        """
+        shards: number of instances of the topology the tests are split
+                between, see sharding.py
+        previous_url: URL of the previous run of the task; when its
+                      junit.xml lists failed tests, only they are run
+        """
+        super(RunPytest, self).__init__(template, timeout=timeout,
+                                        topology=topology, **kwargs)
+        self.build_url = None if build_url is None else build_url + '/'
         self.test_suite = test_suite
         self.update_packages = update_packages
         self.selinux_enforcing = selinux_enforcing
@@ -263,6 +630,15 @@ class RunPytest(JobTask):
         self.copr = copr
         self.enable_testing_repo = enable_testing_repo
         self.trusted_domain = trusted_domain
+        self.repofile_url = None
+        self.shards = shards if self.shardable else 1
+        self.extra_shards = []
+        self.shard_futures = []
+        self.shard_executor = None
+        self.previous_url = previous_url if self.rerunnable else None
+        self.rerun_tests = []
+        # (vagrant env, output dir) of the commands run with execute_staged
+        self.staged_runs = []
         if not topology:
             topology = {'name': constants.DEFAULT_TOPOLOGY}
 
@@ -273,10 +649,116 @@ class RunPytest(JobTask):
         return constants.VAGRANTFILE_TEMPLATE.format(
             vagrantfile_name=self.topology_name)
 
+    @property
+    def full_run(self):
+        # re-running only the previously failed tests
+        return (super(RunPytest, self).full_run
+                and not self.rerun_tests)
+
+    @property
+    def checkpoint_key(self):
+        # VMs of the other shards are not saved
+        if self.shards > 1:
+            return None
+        return super(RunPytest, self).checkpoint_key
+
     def _before(self):
         super(RunPytest, self)._before()
+        self.fetch_previous_failures()
+
+        # When prestaged, the build is not done yet
+        if self.build_url is not None:
+            self.prepare_test_config()
+
+    def before_provision(self):
+        if self.build_url is None:
+            logging.info('Waiting for the build to finish')
+            args = self.resolve_args(
+                deadline=time.time() + constants.BUILD_TIMEOUT,
+                cancelled=self.terminated)
+            if args is None:
+                logging.error('Build failed, not running tests')
+                raise DependencyException(self)
+            self.trace_event('build finished')
+            self.build_url = args['build_url'] + '/'
+            self.prepare_test_config()
+
+        if self.shards > 1:
+            self.start_shards()
+
+    def fetch_previous_failures(self):
+        """
+        Get junit.xml of the previous run of the task, so only the tests
+        which failed in it are run
+        """
+        if self.previous_url is None:
+            return
+        path = os.path.join(self.data_dir, constants.PREVIOUS_JUNIT_FILE)
+        url = urllib.parse.urljoin(self.previous_url.rstrip('/') + '/',
+                                   'junit.xml.gz')
+        try:
+            res = requests.get(url, timeout=constants.PREVIOUS_JUNIT_TIMEOUT)
+            res.raise_for_status()
+            with open(path, 'wb') as fh:
+                fh.write(res.content)
+            self.rerun_tests = junit.failed_tests(path)
+        except (requests.RequestException, OSError, IOError,
+                ET.ParseError) as exc:
+            logging.warning('Failed to get results of the previous run, '
+                            'running all tests: {exc}'.format(exc=exc))
+            return
+        if self.rerun_tests:
+            logging.info('Running {count} tests failed in {url}'.format(
+                count=len(self.rerun_tests), url=self.previous_url))
+            # not worth more topologies
+            self.shards = 1
+
+    def start_shards(self):
+        """
+        Bring up and provision the topologies of the other shards, while the
+        job's own VMs are provisioned
+        """
+        self.shard_executor = ThreadPoolExecutor(self.shards - 1)
+        for index in range(1, self.shards):
+            shard = Shard(self.uuid, index)
+            self.extra_shards.append(shard)
+            try:
+                shard.prepare(self.data_dir)
+            except (OSError, IOError) as exc:
+                msg = "Failed to prepare shard {index}".format(index=index)
+                logging.critical(msg)
+                logging.debug(exc, exc_info=True)
+                raise TaskException(self, msg)
+            self.shard_futures.append(
+                self.shard_executor.submit(shard.bring_up, self))
+
+    def after_provision(self):
+        # the other shards are part of the job's provisioning
+        for shard, future in zip(self.extra_shards, self.shard_futures):
+            try:
+                future.result()
+            except TaskException as exc:
+                msg = "Failed to bring up shard {index}".format(
+                    index=shard.index)
+                logging.critical('{msg}: {exc}'.format(msg=msg, exc=exc))
+                raise TaskException(self, msg)
+
+    def destroy_shards(self):
+        if self.shard_executor is not None:
+            for shard in self.extra_shards:
+                shard.terminate()
+            self.shard_executor.shutdown(wait=True)
+        if not self.no_destroy:
+            for shard in self.extra_shards:
+                shard.destroy()
+
+    def _after(self):
+        self.destroy_shards()
+        super(RunPytest, self)._after()
+
+    def prepare_test_config(self):
+        self.repofile_url = self.mirror_build_repo()
 
-        # Prepare test config files
         try:
             create_file_from_template(
                 constants.ANSIBLE_VARS_TEMPLATE.format(
@@ -284,14 +766,13 @@ class RunPytest(JobTask):
                 ),
                 os.path.join(self.data_dir, 'vars.yml'),
                 {
-                    "repofile_url": urllib.parse.urljoin(
-                        self.build_url, 'rpms/freeipa-prci.repo'
-                    ),
+                    "repofile_url": self.repofile_url,
                     "update_packages": self.update_packages,
                     "selinux_enforcing": self.selinux_enforcing,
                     "fips": self.fips,
                     "copr": self.copr,
                     "enable_testing_repo": self.enable_testing_repo,
+                    "package_cache_url": tasks.PACKAGE_CACHE_URL,
                     "trusted_domain": self.trusted_domain,
                 },
             )
@@ -301,14 +782,36 @@ class RunPytest(JobTask):
             logging.critical(msg)
             raise exc
 
+    def mirror_build_repo(self):
+        """
+        Return URL of the build repo file for the VMs, the runner-local mirror
+        of the build repo if available, the cloud storage otherwise
+        """
+        repofile_url = urllib.parse.urljoin(
+            self.build_url, 'rpms/freeipa-prci.repo')
+        if not tasks.BUILD_REPO_MIRROR_DIR or not tasks.BUILD_REPO_MIRROR_URL:
+            return repofile_url
+
+        try:
+            mirror = MirrorBuildRepo(self.build_url,
+                                     tasks.BUILD_REPO_MIRROR_DIR,
+                                     timeout=constants.BUILD_TIMEOUT)
+            self.execute_subtask(mirror)
+        except (TaskException, ValueError) as exc:
+            logging.warning('Build repo mirror unavailable, using cloud '
+                            'storage: {exc}'.format(exc=exc))
+            return repofile_url
+        return urllib.parse.urljoin(
+            tasks.BUILD_REPO_MIRROR_URL,
+            '{uuid}/rpms/freeipa-prci.repo'.format(uuid=mirror.uuid))
+
     @with_vagrant
     def _run(self):
         if self.fips:
             try:
                 self.execute_subtask(
                     PopenTask(
-                        ['vagrant', 'ssh', '-c',
-                         'fips-mode-setup --is-enabled'],
+                        self.ssh_command('fips-mode-setup --is-enabled'),
                         raise_on_err=True
                     )
                 )
@@ -325,23 +828,221 @@ class RunPytest(JobTask):
             self.returncode = exc.task.returncode
             self._handle_test_exception(exc)
 
+        if not self.rerun_tests:
+            # a re-run updates them before merging the previous results
+            self.update_test_durations()
+
+    def update_test_durations(self):
+        """Learn durations of the tests run by this job from its junit.xml"""
+        junit_path = os.path.join(self.data_dir, 'junit.xml')
+        if os.path.exists(junit_path):
+            TestDurations().update(junit_path)
+
+    @property
+    def results_dir(self):
+        """Directory in the guest the tests write their results to"""
+        if self.driver is not None:
+            # virtiofs is fast enough to write to /vagrant directly
+            return None
+        return constants.GUEST_RESULTS_DIR
+
+    def copy_results_cmd(self, output_dir):
+        return (
+            'mkdir -p {output_dir} && '
+            'tar -C {results_dir} -cf - . | tar -C {output_dir} -xf -'
+            ).format(results_dir=self.results_dir, output_dir=output_dir)
+
+    def staged_cmd(self, cmd, output_dir):
+        """
+        Run cmd writing its results to results_dir, then copy them to
+        output_dir in one go, keeping the exit code of cmd
+        """
+        if self.results_dir is None:
+            return cmd
+        return (
+            'rm -rf {results_dir} && mkdir -p {results_dir} && '
+            '( {cmd} ); rc=$?; {copy}; exit $rc'
+            ).format(results_dir=self.results_dir, cmd=cmd,
+                     copy=self.copy_results_cmd(output_dir))
+
+    def pytest_cmd(self, tests, output_dir='/vagrant/'):
+        return self.staged_cmd((
+            'IPATEST_YAML_CONFIG=/vagrant/ipa-test-config.yaml '
+            '{run_tests_cmd} {tests} '
+            '--verbose --logging-level=debug --logfile-dir={results_dir} '
+            '--html={results_dir}report.html '
+            '--junit-xml={results_dir}junit.xml'
+            ).format(
+                run_tests_cmd=self.run_tests_cmd,
+                tests=tests,
+                results_dir=self.results_dir or output_dir), output_dir)
+
+    def execute_staged(self, cmd, output_dir='/vagrant/', env=None):
+        """
+        Run cmd built by staged_cmd in the primary VM of the job, or of the
+        vagrant project given by env; the results it staged so far are
+        copied to output_dir when the job is terminated
+        """
+        if self.results_dir is not None:
+            self.staged_runs.append((env, output_dir))
+        self.execute_subtask(
+            PopenTask(self.ssh_command(cmd, env), env=env, timeout=None))
+
+    def terminate(self):
+        # keep the results of the tests which did run
+        for env, output_dir in self.staged_runs:
+            try:
+                subprocess.run(
+                    self.ssh_command(self.copy_results_cmd(output_dir), env),
+                    env=dict(os.environ, **env) if env else None,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    timeout=constants.RESULTS_COPY_TIMEOUT)
+            except (subprocess.SubprocessError, OSError) as exc:
+                logging.warning('Failed to copy test results: {exc}'.format(
+                    exc=exc))
+        if self.staged_runs:
+            # results of the other shards are published with the job's
+            for shard in self.extra_shards:
+                try:
+                    shard.collect_results(self.data_dir)
+                except (OSError, IOError) as exc:
+                    logging.warning('Failed to collect results of shard '
+                                    '{index}: {exc}'.format(
+                                        index=shard.index, exc=exc))
+        super(RunPytest, self).terminate()
+
+    def kinit(self, env=None):
+        self.execute_subtask(
+            PopenTask(
+                self.ssh_command("echo Secret.123 | kinit admin", env),
+                env=env, timeout=None))
+
     def execute_tests(self):
+        if self.rerun_tests:
+            return self.execute_failed_tests()
+        if self.shards > 1:
+            return self.execute_shards()
         if self.xmlrpc:
-            self.execute_subtask(
-                PopenTask(
-                    ['vagrant', 'ssh', '-c', "echo Secret.123 | kinit admin"],
-                    timeout=None))
+            self.kinit()
+        self.execute_staged(self.pytest_cmd(self.test_suite))
+
+    def execute_failed_tests(self):
+        """
+        Run the tests failed in the previous run and put their results into
+        its junit.xml
+        """
+        with open(os.path.join(self.data_dir, constants.RERUN_TESTS_FILE),
+                  'w') as fh:
+            fh.write(''.join(node_id + '\n' for node_id in self.rerun_tests))
+        if self.xmlrpc:
+            self.kinit()
+        try:
+            self.execute_staged((
+                'mapfile -t tests < /vagrant/{tests} && {cmd}'
+                ).format(
+                    tests=constants.RERUN_TESTS_FILE,
+                    cmd=self.pytest_cmd('"${tests[@]}"')))
+        except PopenException as exc:
+            if exc.task.returncode == constants.PYTEST_USAGE_ERROR:
+                # e.g. a test was renamed, node IDs are stale
+                logging.warning('Failed to select the failed tests, running '
+                                'all tests')
+                self.rerun_tests = []
+                return self.execute_tests()
+            self.merge_previous_results()
+            raise
+        self.merge_previous_results()
+
+    def merge_previous_results(self):
+        # only the re-run tests ran now
+        self.update_test_durations()
+        path = os.path.join(self.data_dir, 'junit.xml')
+        try:
+            junit.replace_results(
+                os.path.join(self.data_dir, constants.PREVIOUS_JUNIT_FILE),
+                path, path)
+        except (OSError, IOError, ET.ParseError) as exc:
+            logging.warning('Failed to merge results of the previous run: '
+                            '{exc}'.format(exc=exc))
+
+    def execute_shards(self):
+        """
+        Split the collected tests between the shards by their durations in
+        previous runs and run them in parallel
+        """
         self.execute_subtask(
-            PopenTask(['vagrant', 'ssh', '-c', (
+            PopenTask(self.ssh_command((
                 'IPATEST_YAML_CONFIG=/vagrant/ipa-test-config.yaml '
-                '{run_tests_cmd} {test_suite} '
-                '--verbose --logging-level=debug --logfile-dir=/vagrant/ '
-                '--html=/vagrant/report.html '
-                '--junit-xml=/vagrant/junit.xml'
+                '{run_tests_cmd} {test_suite} --collect-only -q '
+                '> /vagrant/{collected}'
                 ).format(
                     run_tests_cmd=self.run_tests_cmd,
-                    test_suite=self.test_suite)],
+                    test_suite=self.test_suite,
+                    collected=constants.COLLECTED_TESTS_FILE)),
                 timeout=None))
+        with open(os.path.join(self.data_dir,
+                               constants.COLLECTED_TESTS_FILE)) as fh:
+            node_ids = parse_collected(fh.read())
+        shards = split_tests(node_ids, self.shards, TestDurations().load())
+        logging.info('Split {count} tests into shards of {sizes}'.format(
+            count=len(node_ids), sizes=[len(shard) for shard in shards]))
+
+        # the job's own VMs run the first shard
+        projects = [(None, self.data_dir)] + [
+            (shard.env, shard.path) for shard in self.extra_shards]
+
+        def run_shard(index):
+            env, path = projects[index]
+            with open(os.path.join(path, constants.SHARD_TESTS_FILE),
+                      'w') as fh:
+                fh.write(''.join(node_id + '\n'
+                                 for node_id in shards[index]))
+            if self.xmlrpc:
+                self.kinit(env)
+            output_dir = '/vagrant/shard-{index}/'.format(index=index)
+            self.execute_staged((
+                'mkdir -p {output_dir} && '
+                'mapfile -t tests < /vagrant/{tests} && {cmd}'
+                ).format(
+                    output_dir=output_dir,
+                    tests=constants.SHARD_TESTS_FILE,
+                    cmd=self.pytest_cmd('"${tests[@]}"', output_dir)),
+                output_dir, env)
+
+        # a shard without tests would run the whole suite
+        indexes = [index for index, shard in enumerate(shards) if shard]
+        with ThreadPoolExecutor(self.shards) as executor:
+            futures = [executor.submit(run_shard, index) for index in indexes]
+        self.merge_shards(shards, indexes)
+
+        errors = [future.exception() for future in futures
+                  if future.exception() is not None]
+        if errors:
+            raise max(errors, key=lambda exc: getattr(
+                getattr(exc, 'task', None), 'returncode', None) or 0)
+
+    def merge_shards(self, shards, indexes):
+        """Merge results of the shards into junit.xml and report.html"""
+        for shard in self.extra_shards:
+            if shard.index not in indexes:
+                continue
+            try:
+                shard.collect_results(self.data_dir)
+            except (OSError, IOError) as exc:
+                logging.warning('Failed to collect results of shard {index}: '
+                                '{exc}'.format(index=shard.index, exc=exc))
+        junit_files = [
+            os.path.join(self.data_dir, 'shard-{}'.format(index), 'junit.xml')
+            for index in indexes]
+        junit_files = [path for path in junit_files if os.path.exists(path)]
+        try:
+            totals = junit.merge(
+                junit_files, os.path.join(self.data_dir, 'junit.xml'))
+            write_report_index(
+                shards, totals, os.path.join(self.data_dir, 'report.html'))
+        except (OSError, IOError, ET.ParseError) as exc:
+            logging.warning('Failed to merge results of the shards: '
+                            '{exc}'.format(exc=exc))
 
     def _handle_test_exception(self, exc):
         if self.returncode == 1:
@@ -361,6 +1062,8 @@ class RunPytest3(RunPytest):
 
 class RunWebuiTests(RunPytest):
     action_name = 'webui'
+    shardable = False
+    rerunnable = False
 
     def __init__(self, template, build_url, test_suite, caless=False, fips=False,
                  copr=None, enable_testing_repo=False, **kwargs):
@@ -375,23 +1078,22 @@ class RunWebuiTests(RunPytest):
         return constants.VAGRANTFILE_TEMPLATE.format(
             vagrantfile_name='ipaserver')
 
-    def _before(self):
-        super(RunWebuiTests, self)._before()
+    def prepare_test_config(self):
+        self.repofile_url = self.mirror_build_repo()
 
-        # Prepare test config files
         try:
             create_file_from_template(
                 constants.ANSIBLE_VARS_TEMPLATE.format(
                     action_name=self.action_name),
                 os.path.join(self.data_dir, 'vars.yml'),
-                dict(repofile_url=urllib.parse.urljoin(
-                    self.build_url, 'rpms/freeipa-prci.repo'),
+                dict(repofile_url=self.repofile_url,
                     update_packages=self.update_packages,
                     selinux_enforcing=self.selinux_enforcing,
                     fips=self.fips,
                     caless=self.caless,
                     copr=self.copr,
-                    enable_testing_repo=self.enable_testing_repo))
+                    enable_testing_repo=self.enable_testing_repo,
+                    package_cache_url=tasks.PACKAGE_CACHE_URL))
         except (OSError, IOError) as exc:
             msg = "Failed to prepare test config files"
             logging.debug(exc, exc_info=True)
@@ -399,14 +1101,14 @@ class RunWebuiTests(RunPytest):
             raise exc
 
     def execute_tests(self):
-        self.execute_subtask(
-            PopenTask(['vagrant', 'ssh', '-c', (
-                'ipa-run-webui-tests {test_suite} '
-                '--verbose --logging-level=debug --logfile-dir=/vagrant/ '
-                '--html=/vagrant/report.html '
-                '--junit-xml=/vagrant/junit.xml'
-                ).format(test_suite=self.test_suite)],
-                timeout=None))
+        self.execute_staged(self.staged_cmd((
+            'ipa-run-webui-tests {test_suite} '
+            '--verbose --logging-level=debug --logfile-dir={results_dir} '
+            '--html={results_dir}report.html '
+            '--junit-xml={results_dir}junit.xml'
+            ).format(test_suite=self.test_suite,
+                     results_dir=self.results_dir or '/vagrant/'),
+            '/vagrant/'))
 
     def _handle_test_exception(self, exc):
         logging.error(
@@ -416,5 +1118,9 @@ class RunWebuiTests(RunPytest):
 
 class RunADTests(RunPytest):
     action_name = 'ad'
+    # Windows VMs can't be paused consistently
+    checkpointable = False
+    shardable = False
+    rerunnable = False
 
 
@@ -1,9 +1,33 @@
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import http.server
+import json
 import os
+import subprocess
+import threading
+import time
+import jinja2
 import pytest
 
+import tasks
 from .ansible import AnsiblePlaybook
-from .common import PopenTask, TimeoutException, TaskException
-from .vagrant import VagrantBoxDownload
+from .box_inventory import BoxInventory, scan_boxes
+from . import (box_eviction, box_prefetch, checkpoint, constants, durations,
+               junit, libvirt, sharding, warm_pool)
+from .cgroup import JobCgroup
+from .libvirt_driver import LibvirtDriver, parse_vagrantfile
+from .common import (PopenTask, TimeoutException, TaskException,
+                     FatalOutputException, OutputClassifier,
+                     DependencyException,
+                     create_file_from_template)
+from .remote_storage import GzipLogFiles
+from .repo_mirror import MirrorBuildRepo
+from .tasks import Build, RunPytest, RunWebuiTests
+from .tracing import Tracer
+from .vagrant import VagrantBox, VagrantBoxDownload
+from .warm_pool import WarmPool
 
 
 def test_timeout():
@@ -50,6 +74,798 @@ def test_popen():
     assert task.returncode == 2
 
 
+def test_output_classifier():
+    classifier = OutputClassifier()
+    assert classifier.classify('all good') is None
+    assert classifier.classify(
+        'cp: error writing: No space left on device') == 'disk-full'
+    assert classifier.classify(
+        'fatal: [replica0]: UNREACHABLE! => {"changed": false}'
+    ) == 'unreachable'
+    assert classifier.classify(
+        'Error: Failed to download metadata for repo \'updates\''
+    ) == 'dnf-mirror'
+
+
+def test_popen_fatal_output():
+    task = PopenTask(
+        'echo starting; echo "No space left on device"; sleep 30',
+        shell=True, classifier=OutputClassifier(), timeout=10)
+    start = time.time()
+    with pytest.raises(FatalOutputException) as exc_info:
+        task()
+    assert time.time() - start < 10
+    assert exc_info.value.reason == 'disk-full'
+    assert task.returncode != 0
+
+
+def test_job_cgroup(tmpdir):
+    tmpdir.join('cgroup.procs').write('12\n34\n')
+    tmpdir.mkdir('nested').join('cgroup.procs').write('56\n')
+    tmpdir.join('cpu.stat').write('usage_usec 2500000\nuser_usec 2000000\n')
+    tmpdir.join('memory.peak').write(str(512 * 1024 ** 2))
+
+    cgroup = JobCgroup(str(tmpdir))
+    assert sorted(cgroup.pids()) == [12, 34, 56]
+    assert cgroup.stats() == {'cpu': 2.5, 'memory': 512.0}
+
+
+def test_apply_topology_limits(monkeypatch):
+    domains = {'uuid_controller': (1, 1250.0), 'uuid_master': (1, 2750.0),
+               'uuid_replica0': (2, 2750.0)}
+    monkeypatch.setattr(libvirt, 'job_domains', lambda prefix: list(domains))
+    monkeypatch.setattr(libvirt, 'domain_info', domains.get)
+
+    commands = []
+    task = libvirt.ApplyTopologyLimits('uuid_', cpu=2, memory=6000)
+    monkeypatch.setattr(task, 'execute_subtask',
+                        lambda subtask: commands.append(subtask.cmd))
+    task()
+
+    assert ['virsh', 'schedinfo', 'uuid_replica0', '--live',
+            '--set', 'global_quota=100000'] in commands
+    share = 6000 * 2750 / 6750.0
+    assert ['virsh', 'memtune', 'uuid_master', '--live',
+            '--soft-limit', str(int(share * 1024)),
+            '--hard-limit', str(int((share + 512) * 1024))] in commands
+
+    commands = []
+    task = libvirt.ApplyTopologyLimits('uuid_', memory=6000,
+                                       hard_memory_limit=False)
+    monkeypatch.setattr(task, 'execute_subtask',
+                        lambda subtask: commands.append(subtask.cmd))
+    task()
+    assert ['virsh', 'memtune', 'uuid_master', '--live',
+            '--soft-limit', str(int(share * 1024))] in commands
+
+
+def test_domain_reaper(monkeypatch):
+    domains = ['uuid_controller', 'uuid_master', 'other_master']
+    monkeypatch.setattr(libvirt, 'job_domains', lambda prefix: [
+        domain for domain in domains if domain.startswith(prefix)])
+    stopped, removed = [], []
+    monkeypatch.setattr(libvirt, 'stop_domain', stopped.append)
+    release = threading.Event()
+
+    def undefine(domain):
+        release.wait(5)
+        removed.append(domain)
+    monkeypatch.setattr(libvirt, 'undefine_domain', undefine)
+
+    cleaned = threading.Event()
+    reaper = libvirt.DomainReaper()
+    reaper.reap('uuid_', cleanup=cleaned.set)
+    # domains are stopped right away, their disks removed in the background
+    assert sorted(stopped) == ['uuid_controller', 'uuid_master']
+    assert removed == [] and not cleaned.is_set()
+    release.set()
+    reaper.wait()
+    assert sorted(removed) == ['uuid_controller', 'uuid_master']
+    assert cleaned.is_set()
+
+
+def test_build_cache_key():
+    template = {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'}
+
+    def key(**kwargs):
+        return Build(template, **kwargs).build_cache_key
+
+    assert key() is None
+    assert key(git_tree='abc', build_cache=False) is None
+    assert key(git_tree='abc', git_version='master') is None
+
+    assert key(git_tree='abc') == key(git_tree='abc')
+    assert key(git_tree='abc') != key(git_tree='abd')
+    assert key(git_tree='abc') != key(git_tree='abc', copr='@pki/master')
+    assert key(git_tree='abc') != key(git_tree='abc',
+                                      enable_testing_repo=True)
+    assert key(git_tree='abc') != Build(
+        dict(template, version='0.0.2'), git_tree='abc').build_cache_key
+
+
+def test_build_cache_hit_claims_no_warm_vms(monkeypatch):
+    claimed = []
+    monkeypatch.setattr(tasks, 'WARM_POOL', type(
+        'Pool', (), {'claim': lambda self, *args: claimed.append(args)})())
+    build = Build({'name': 'freeipa/ci-master-f40', 'version': '0.0.1'},
+                  git_tree='abc')
+    monkeypatch.setattr(build, 'lookup_build_cache', lambda: True)
+    build.claim_warm_vms()
+    assert claimed == [] and build.build_cache_hit and not build.warm
+
+    monkeypatch.setattr(build, 'lookup_build_cache', lambda: False)
+    build.claim_warm_vms()
+    assert len(claimed) == 1 and build.build_cache_hit is False
+
+
+def test_scratch_topology_claims_no_warm_vms(monkeypatch):
+    claimed = []
+    monkeypatch.setattr(tasks, 'WARM_POOL', type(
+        'Pool', (), {'claim': lambda self, *args: claimed.append(args)})())
+    monkeypatch.setattr(tasks, 'SCRATCH_POOL', 'scratch')
+    template = {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'}
+    build_url = 'http://cloud/jobs/01234567-89ab-cdef-0123-456789abcdef'
+    job = RunPytest(template, build_url, 'test_integration',
+                    topology={'name': 'master_1repl', 'cpu': 4,
+                              'memory': 6750, 'scratch_disk': 20000})
+    job.claim_warm_vms()
+    assert claimed == [] and not job.warm
+
+
+def test_prepare_mock_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(tasks, 'MOCK_CACHE_DIR', str(tmpdir))
+    template_dir = tmpdir.mkdir('freeipa-VAGRANTSLASH-ci-master-f40')
+    template_dir.mkdir('0.0.1').mkdir('default')
+
+    build = Build({'name': 'freeipa/ci-master-f40', 'version': '0.0.2'},
+                  copr='@pki/master', enable_testing_repo=True)
+    build.prepare_mock_cache()
+
+    assert build.mock_cache_path == str(
+        template_dir.join('0.0.2', '_pki_master-updates-testing'))
+    assert os.path.isdir(build.mock_cache_path)
+    # caches of other template versions are dropped
+    assert template_dir.listdir() == [template_dir.join('0.0.2')]
+
+
+REPOMD = """<?xml version="1.0"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary"><location href="repodata/primary.xml.gz"/></data>
+</repomd>
+"""
+
+PRIMARY = """<?xml version="1.0"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common" packages="1">
+  <package type="rpm">
+    <checksum type="sha256" pkgid="YES">{sha256}</checksum>
+    <location href="x86_64/freeipa-server-1.rpm"/>
+  </package>
+</metadata>
+"""
+
+
+def test_mirror_build_repo(tmpdir):
+    build_uuid = '01234567-89ab-cdef-0123-456789abcdef'
+    rpms = tmpdir.join('cloud', build_uuid, 'rpms')
+    rpm = b'not really an rpm'
+    rpms.join('x86_64', 'freeipa-server-1.rpm').write_binary(
+        rpm, ensure=True)
+    rpms.join('repodata', 'repomd.xml').write(REPOMD, ensure=True)
+    with gzip.open(str(rpms.join('repodata', 'primary.xml.gz')), 'wt') as fh:
+        fh.write(PRIMARY.format(sha256=hashlib.sha256(rpm).hexdigest()))
+
+    # local HTTP server standing in for the cloud storage
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler,
+                                directory=str(tmpdir.join('cloud')))
+    server = http.server.HTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    build_url = 'http://127.0.0.1:{}/{}'.format(server.server_port,
+                                                build_uuid)
+    mirror_dir = str(tmpdir.join('mirror'))
+    try:
+        MirrorBuildRepo(build_url, mirror_dir)()
+        # failed mirroring leaves nothing behind
+        with pytest.raises(TaskException):
+            MirrorBuildRepo(build_url.replace(
+                build_uuid, 'fedcba98-7654-3210-fedc-ba9876543210'),
+                mirror_dir)()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    mirror = tmpdir.join('mirror', build_uuid, 'rpms')
+    assert mirror.join('x86_64', 'freeipa-server-1.rpm').read_binary() == rpm
+    assert mirror.join('repodata', 'primary.xml.gz').check()
+    assert [p.basename for p in tmpdir.join('mirror').listdir(
+        lambda p: p.isdir())] == [build_uuid]
+
+    # complete mirror is used without contacting the cloud storage
+    MirrorBuildRepo(build_url, mirror_dir)()
+
+
+def test_vars_package_cache(tmpdir):
+    data = dict(repofile_url='http://repo/rpms/freeipa-prci.repo',
+                update_packages=True, selinux_enforcing=False, copr=None)
+    for package_cache_url in (None, 'http://192.168.121.1:8101/'):
+        vars_file = tmpdir.join('vars.yml')
+        create_file_from_template(
+            'run_pytest.vars.yml', str(vars_file),
+            dict(data, package_cache_url=package_cache_url))
+        assert (('package_cache_url: {}'.format(package_cache_url)
+                 in vars_file.read()) == bool(package_cache_url))
+
+
+def test_prestaged_run_pytest(tmpdir, monkeypatch):
+    monkeypatch.setattr(RunPytest, 'data_dir', str(tmpdir))
+    template = {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'}
+
+    job = RunPytest(template, None, 'test_integration',
+                    resolve_args=lambda **kwargs: None)
+    assert job.timeout == (constants.RUN_PYTEST_TIMEOUT +
+                           constants.BUILD_TIMEOUT)
+    with pytest.raises(DependencyException):
+        job.before_provision()
+
+    build_url = 'http://cloud/jobs/01234567-89ab-cdef-0123-456789abcdef'
+    job = RunPytest(template, None, 'test_integration',
+                    resolve_args=lambda **kwargs: {'build_url': build_url})
+    job.before_provision()
+    assert job.build_url == build_url + '/'
+    assert job.repofile_url == build_url + '/rpms/freeipa-prci.repo'
+    assert job.repofile_url in tmpdir.join('vars.yml').read()
+
+
+def test_warm_pool(monkeypatch):
+    def boot(self, entry):
+        entry.ready = True
+
+    destroyed = []
+
+    def destroy(self, entry):
+        destroyed.append(entry.key)
+        self.entries.remove(entry)
+
+    monkeypatch.setattr(WarmPool, 'boot', boot)
+    monkeypatch.setattr(WarmPool, 'destroy', destroy)
+
+    budget = [8, 16000]
+    pool = WarmPool(2, lambda: tuple(budget))
+    template = ('freeipa/ci-master-f40', '0.0.1')
+    master_1repl = template + ('Vagrantfile.master_1repl',)
+    ipaserver = template + ('Vagrantfile.ipaserver',)
+    build = template + ('Vagrantfile.build',)
+
+    # nothing is booted until there is demand
+    pool.refill()
+    assert pool.entries == []
+
+    for key in (master_1repl, master_1repl, ipaserver, build):
+        assert pool.claim(key, 4, 6750) is None
+    for _i in range(3):
+        # entries are booted in the background, one at a time
+        pool.refill()
+        pool.boot_thread.join()
+    # only the 2 most demanded keys are kept warm
+    assert [e.key for e in pool.entries] == [master_1repl, ipaserver]
+
+    entry = pool.entries[0]
+    assert pool.claim(master_1repl, 4, 6750) == entry.uuid
+
+    # running jobs took the resources
+    budget[:] = [2, 4000]
+    pool.fit()
+    assert pool.entries == []
+    assert destroyed == [ipaserver]
+
+
+def test_warm_pool_claim(tmpdir, monkeypatch):
+    def boot(self, entry):
+        entry.ready = True
+
+    torn_down = []
+    monkeypatch.setattr(WarmPool, 'boot', boot)
+    monkeypatch.setattr(constants, 'JOBS_DIR', str(tmpdir))
+    monkeypatch.setattr(warm_pool.shutil, 'rmtree',
+                        lambda path, **kwargs: torn_down.append(path))
+
+    budget = [8, 8000]
+    pool = WarmPool(2, lambda: tuple(budget))
+    key = ('freeipa/ci-master-f40', '0.0.1', 'Vagrantfile.master_1repl')
+    assert pool.claim(key, 4, 6750) is None
+    pool.refill()
+    pool.boot_thread.join()
+    entry = pool.entries[0]
+
+    # the job's resources are taken before it claims the entry
+    pool.expect_claim()
+    budget[:] = [4, 1250]
+    pool.fit()
+    assert pool.entries == [entry]
+    assert pool.claim(key, 4, 6750) == entry.uuid
+    pool.end_claim()
+
+    # claimed between fit() picking the idle entries and destroying them
+    budget[:] = [8, 8000]
+    pool.refill()
+    pool.boot_thread.join()
+    entry = pool.entries[0]
+    usage = pool.usage
+
+    def claim_first():
+        pool.claim(key, 4, 6750)
+        return usage()
+
+    monkeypatch.setattr(pool, 'usage', claim_first)
+    budget[:] = [0, 0]
+    pool.fit()
+    assert pool.entries == [] and torn_down == []
+
+
+DOMAIN_XML = """<domain type="kvm">
+  <name>{old}_master</name>
+  <uuid>5b1f3c0e-0000-0000-0000-000000000000</uuid>
+  <devices>
+    <disk type="file" device="disk">
+      <source file="/var/lib/libvirt/images/{old}_master.img"/>
+      <backingStore type="file"><format type="qcow2"/></backingStore>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+    <interface type="network"><mac address="52:54:00:aa:bb:cc"/></interface>
+  </devices>
+</domain>
+"""
+
+
+def test_restore_checkpoint_define_domain(tmpdir, monkeypatch):
+    old = '01234567-89ab-cdef-0123-456789abcdef'
+    new = 'fedcba98-7654-3210-fedc-ba9876543210'
+    monkeypatch.setattr(constants, 'CHECKPOINT_DIR', str(tmpdir))
+    tmpdir.mkdir('key').join('master.xml').write(DOMAIN_XML.format(old=old))
+
+    overlays = []
+    defined = []
+
+    def create_overlay(name, backing):
+        overlays.append((name, backing))
+        return os.path.join('/var/lib/libvirt/images', name)
+    monkeypatch.setattr(checkpoint, 'create_overlay', create_overlay)
+    monkeypatch.setattr(checkpoint, 'virsh',
+                        lambda *args: defined.append(open(args[1]).read()))
+
+    restore = checkpoint.RestoreCheckpoint('key', new + '_', str(tmpdir))
+    restore.define_domain(new + '_master', 'master',
+                          {'vda': 'master-vda.qcow2'})
+
+    image = '/var/lib/libvirt/images/{}_master.img'.format(new)
+    assert overlays == [('{}_master.img'.format(new),
+                         str(tmpdir.join('key', 'master-vda.qcow2')))]
+    xml = defined[0]
+    assert '<name>{}_master</name>'.format(new) in xml
+    assert '<source file="{}" />'.format(image) in xml
+    assert '52:54:00:aa:bb:cc' in xml
+    assert '<uuid>' not in xml and 'backingStore' not in xml
+
+
+def test_checkpoint_key(monkeypatch):
+    template = {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'}
+    build_url = 'http://cloud/jobs/01234567-89ab-cdef-0123-456789abcdef'
+    job = RunPytest(template, build_url, 'test_integration',
+                    task_name='fedora-latest/simple_replication',
+                    git_tree='4b825dc642cb6eb9a060e54bf8d69288fbee4904')
+    assert job.checkpoint_key is None
+
+    monkeypatch.setattr(tasks, 'CHECKPOINTS', True)
+    assert len(job.checkpoint_key) == 64
+    assert Build(template, git_tree=job.git_tree).checkpoint_key is None
+
+
+def test_sharding(tmpdir):
+    output = '\n'.join([
+        'test_integration/test_a.py::TestA::test_1',
+        'test_integration/test_a.py::TestA::test_2',
+        'test_integration/test_b.py::test_3',
+        'test_integration/test_b.py::test_4',
+        '',
+        '4 tests collected in 0.12s',
+    ])
+    node_ids = sharding.parse_collected(output)
+    assert len(node_ids) == 4
+
+    junit_path = str(tmpdir.join('junit.xml'))
+    with open(junit_path, 'w') as fh:
+        fh.write(
+            '<testsuites><testsuite tests="2" failures="1" errors="0" '
+            'skipped="0" time="31">'
+            '<testcase classname="test_integration.test_a.TestA" '
+            'name="test_1" time="30"/>'
+            '<testcase classname="test_integration.test_b" '
+            'name="test_3" time="1"/>'
+            '</testsuite></testsuites>')
+    durations = sharding.TestDurations(str(tmpdir.join('durations.json')))
+    durations.update(junit_path)
+    assert durations.load() == {
+        'test_integration/test_a.py::TestA::test_1': 30.0,
+        'test_integration/test_b.py::test_3': 1.0,
+    }
+
+    # the long test gets a shard for itself, the rest count as the median
+    shards = sharding.split_tests(node_ids, 2, durations.load())
+    assert shards[0] == ['test_integration/test_a.py::TestA::test_1']
+    assert len(shards[1]) == 3
+    assert sharding.split_tests(node_ids[:1], 2, {})[1] == []
+
+    merged = str(tmpdir.join('merged.xml'))
+    totals = junit.merge([junit_path, junit_path], merged)
+    assert totals == {'tests': 4, 'failures': 2, 'errors': 0, 'skipped': 0}
+
+
+def test_gzip_log_files(tmpdir):
+    tmpdir.join('ipa-run-tests.log').write('log\n' * 1000)
+    tmpdir.mkdir('logs').join('master').write('journal\n')
+    for name in ['report.html', 'vars.yml', 'screenshot.png', 'old.log.gz']:
+        tmpdir.join(name).write('')
+    tmpdir.mkdir('.vagrant').join('inventory').write('')
+    tmpdir.mkdir('rpms').join('freeipa.rpm').write('')
+    tmpdir.join('link.log').mksymlinkto(tmpdir.join('report.html'))
+
+    GzipLogFiles(str(tmpdir), level=1, workers=2)()
+    with gzip.open(str(tmpdir.join('ipa-run-tests.log.gz')), 'rt') as fh:
+        assert fh.read() == 'log\n' * 1000
+    assert tmpdir.join('logs', 'master.gz').check()
+    assert not tmpdir.join('ipa-run-tests.log').check()
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        '.vagrant', 'ipa-run-tests.log.gz', 'link.log', 'logs',
+        'old.log.gz', 'report.html', 'rpms', 'screenshot.png', 'vars.yml']
+    assert tmpdir.join('rpms', 'freeipa.rpm').check()
+
+
+def test_staged_results(tmpdir, monkeypatch):
+    template = {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'}
+    job = RunPytest(template, 'http://cloud/jobs/build', 'test_integration')
+    results_dir = str(tmpdir.join('results')) + '/'
+    output_dir = str(tmpdir.join('vagrant')) + '/'
+    monkeypatch.setattr(constants, 'GUEST_RESULTS_DIR', results_dir)
+    cmd = job.staged_cmd(
+        'echo log > {}test.log && exit 3'.format(results_dir), output_dir)
+    res = subprocess.run(['bash', '-c', cmd])
+    assert res.returncode == 3
+    assert tmpdir.join('vagrant', 'test.log').read() == 'log\n'
+
+    # the results are copied only when the staged command is executed
+    assert job.staged_runs == []
+    monkeypatch.setattr(job, 'execute_subtask', lambda subtask: None)
+    env = {'VAGRANT_CWD': str(tmpdir)}
+    job.execute_staged(cmd, output_dir, env)
+    assert job.staged_runs == [(env, output_dir)]
+
+
+def test_sharded_run_pytest(monkeypatch):
+    template = {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'}
+    build_url = 'http://cloud/jobs/01234567-89ab-cdef-0123-456789abcdef'
+    job = RunPytest(template, build_url, 'test_integration', shards=3,
+                    task_name='fedora-latest/simple_replication',
+                    git_tree='4b825dc642cb6eb9a060e54bf8d69288fbee4904')
+    monkeypatch.setattr(tasks, 'CHECKPOINTS', True)
+    assert job.checkpoint_key is None
+    cmd = job.pytest_cmd('"${tests[@]}"', '/vagrant/shard-1/')
+    # results are written to the guest's disk, then copied to the share
+    assert '--junit-xml=/var/tmp/prci-results/junit.xml' in cmd
+    assert cmd.endswith('| tar -C /vagrant/shard-1/ -xf -; exit $rc')
+
+    shard = sharding.Shard(job.uuid, 1)
+    assert shard.name.startswith(job.domain_prefix)
+
+    # the shard's VMs get the limits of the job's own
+    monkeypatch.setattr(tasks, 'ENFORCE_TOPOLOGY_LIMITS', True)
+    subtasks = []
+    monkeypatch.setattr(job, 'execute_subtask', subtasks.append)
+    shard.bring_up(job)
+    limits = [subtask for subtask in subtasks
+              if isinstance(subtask, libvirt.ApplyTopologyLimits)]
+    assert [limit.domain_prefix for limit in limits] == [
+        '{}_shard1_'.format(job.uuid)]
+
+    # a shard failing to come up fails the job's provisioning, not its tests
+    failed = concurrent.futures.Future()
+    failed.set_exception(TaskException(PopenTask(['vagrant', 'up'])))
+    job.extra_shards, job.shard_futures = [shard], [failed]
+    with pytest.raises(TaskException) as excinfo:
+        job.after_provision()
+    assert excinfo.value.task is job
+
+
+def test_rerun_failed_tests(tmpdir):
+    def write_junit(name, cases):
+        path = str(tmpdir.join(name))
+        with open(path, 'w') as fh:
+            fh.write('<testsuites><testsuite>{}</testsuite></testsuites>'
+                     .format(''.join(cases)))
+        return path
+
+    passed = ('<testcase classname="test_xmlrpc.test_user_plugin.TestUser" '
+              'name="test_add" time="2"/>')
+    failed = ('<testcase classname="test_xmlrpc.test_host_plugin" '
+              'name="test_find" time="3"><failure message="x"/></testcase>')
+    fixed = ('<testcase classname="test_xmlrpc.test_host_plugin" '
+             'name="test_find" time="4"/>')
+    previous = write_junit('previous.xml', [passed, failed])
+    assert junit.failed_tests(previous) == [
+        'test_xmlrpc/test_host_plugin.py::test_find']
+
+    rerun = write_junit('rerun.xml', [fixed])
+    merged = str(tmpdir.join('junit.xml'))
+    totals = junit.replace_results(previous, rerun, merged)
+    assert totals == {'tests': 2, 'failures': 0, 'errors': 0, 'skipped': 0}
+    assert dict(junit.cases(merged))[
+        'test_xmlrpc/test_host_plugin.py::test_find'] == 4.0
+
+    template = {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'}
+    build_url = 'http://cloud/jobs/01234567-89ab-cdef-0123-456789abcdef'
+    assert RunPytest(template, build_url, 'test_xmlrpc',
+                     previous_url=build_url).previous_url == build_url
+    assert RunWebuiTests(template, build_url, 'test_webui',
+                         previous_url=build_url).previous_url is None
+
+
+def test_job_durations(tmpdir, monkeypatch):
+    key = durations.duration_key(
+        'fedora-latest/simple_replication',
+        {'name': 'freeipa/ci-master-f40', 'version': '0.0.1'},
+        {'name': 'master_1repl', 'cpu': 4})
+    assert key == ('fedora-latest/simple_replication freeipa/ci-master-f40 '
+                   'master_1repl')
+    assert durations.estimate(key) is None
+
+    store = durations.JobDurations(str(tmpdir.join('durations.sqlite')))
+    monkeypatch.setattr(tasks, 'JOB_DURATIONS', store)
+    monkeypatch.setattr(constants, 'JOB_DURATIONS_HISTORY', 10)
+    for total in range(1, 21):
+        store.record(key, total * 60.0, {'run': total * 50.0}, 0)
+    # failed runs are not estimated from
+    store.record(key, 10.0, {'run': 5.0}, 1)
+    assert durations.estimate(key) is not None
+    # only the last runs are kept
+    assert sorted(store.totals(key)) == [total * 60.0
+                                         for total in range(12, 21)]
+    assert store.estimate(key) == {50: 900.0, 95: 1200.0, 99: 1200.0}
+    assert store.estimate('unknown') is None
+
+
+def test_box_inventory(tmpdir, monkeypatch):
+    stats_file = str(tmpdir.join('vagrant_boxes_stats.yml'))
+    with open(stats_file, 'w') as fh:
+        fh.write("freeipa/ci-master-f39_0.0.3_libvirt: "
+                 "2024-01-01 10:00:00.000000\n")
+    inventory = BoxInventory(str(tmpdir.join('boxes.sqlite')))
+    inventory.import_stats_file(stats_file)
+    assert not os.path.exists(stats_file)
+    old = ('freeipa/ci-master-f39', '0.0.3', 'libvirt')
+    assert inventory.last_used(*old).year == 2024
+
+    new = ('freeipa/ci-master-f40', '0.0.1', 'libvirt')
+    inventory.record_use(*new, size=1024)
+    inventory.record_use(*new)
+    boxes = inventory.boxes()
+    assert boxes[new]['use_count'] == 2
+    assert boxes[new]['size'] == 1024
+    assert boxes[old]['use_count'] == 0
+
+    inventory.pin(*old)
+    assert inventory.pinned(*old) and not inventory.pinned(*new)
+    inventory.remove(*new)
+    assert new not in inventory.boxes()
+
+
+
+def test_box_eviction(tmpdir, monkeypatch):
+    inventory = BoxInventory(str(tmpdir.join('boxes.sqlite')))
+    monkeypatch.setattr(tasks, 'BOX_INVENTORY', inventory)
+    now = time.time()
+
+    class Box(object):
+        def __init__(self, name, version, size):
+            self.name, self.version, self.provider = name, version, 'libvirt'
+            self.total_size = size * 2**30
+            self.images = []
+
+        @property
+        def key(self):
+            return (self.name, self.version, self.provider)
+
+    installed = [
+        Box('freeipa/ci-master-f40', '0.0.2', 4),  # running job
+        Box('freeipa/ci-master-f40', '0.0.1', 4),  # old version, pinned
+        Box('freeipa/ci-ipa-4-11-f39', '0.0.1', 4),  # queued task
+        Box('freeipa/ci-ipa-4-10-f38', '0.0.1', 8),
+        Box('freeipa/ci-ipa-4-9-f36', '0.0.1', 2),
+        Box('freeipa/windows-2019', '0.0.1', 16),
+    ]
+    inventory.pin('freeipa/ci-master-f40', '0.0.1', 'libvirt')
+    with inventory.connect() as conn:
+        # used alike, the big box goes first
+        conn.executemany(
+            'INSERT INTO boxes (name, version, provider, last_used, '
+            'use_count) VALUES (?, ?, ?, ?, ?)',
+            [(box.name, box.version, 'libvirt', now - 3600, 3)
+             for box in installed[3:5]])
+
+    usage = box_eviction.BoxUsage()
+    monkeypatch.setattr(box_eviction, 'BOX_USAGE', usage)
+    usage.hold('freeipa/ci-master-f40', '0.0.2')
+    usage.queue('freeipa/ci-ipa-4-11-f39', '0.0.1')
+    candidates = box_eviction.eviction_candidates(
+        installed, inventory.boxes(), usage.needed(), now)
+    assert [box.name for box in candidates] == [
+        'freeipa/ci-ipa-4-10-f38', 'freeipa/ci-ipa-4-9-f36']
+
+    removed = []
+    monkeypatch.setattr(box_eviction, 'scan_boxes', lambda: installed)
+    monkeypatch.setattr(box_eviction, 'remove_box',
+                        lambda box: removed.append(box.name))
+    # the new box is expected to be as big as the other versions
+    box_eviction.evict_boxes('freeipa/ci-master-f40', '0.0.3',
+                             quota=40 * 2**30, boxes_dir=str(tmpdir))
+    assert removed == ['freeipa/ci-ipa-4-10-f38']
+    removed[:] = []
+    box_eviction.evict_boxes('freeipa/ci-ipa-4-9-f36', '0.0.2',
+                             boxes_dir=str(tmpdir))
+    assert removed == []
+
+
+def test_scan_boxes(tmpdir):
+    boxes_dir = tmpdir.mkdir('boxes')
+    images_dir = tmpdir.mkdir('images')
+    master = boxes_dir.join('freeipa-VAGRANTSLASH-ci-master-f40', '0.0.1',
+                            'libvirt')
+    master.ensure('metadata.json')
+    master.join('box.img').write(b'x' * 8192, 'wb')
+    # newer Vagrant has a directory per architecture
+    ipa = boxes_dir.join('freeipa-VAGRANTSLASH-ci-ipa-4-11-f39', '0.0.2',
+                         'amd64', 'libvirt')
+    ipa.ensure('metadata.json')
+    ipa.join('box.img').write(b'x' * 4096, 'wb')
+    os.link(str(master.join('box.img')), str(images_dir.join(
+        'freeipa-VAGRANTSLASH-ci-master-f40_vagrant_box_image_0.0.1.img')))
+    images_dir.join('freeipa-VAGRANTSLASH-ci-ipa-4-11-f39_vagrant_box_image'
+                    '_0.0.2_box.img').write(b'x' * 4096, 'wb')
+    images_dir.ensure('7e4b1c1a-0000-4000-8000-000000000000.img')
+    boxes_dir.ensure('not-a-box')
+
+    installed = scan_boxes(str(boxes_dir), str(images_dir))
+    assert [box.key for box in installed] == [
+        ('freeipa/ci-ipa-4-11-f39', '0.0.2', 'libvirt'),
+        ('freeipa/ci-master-f40', '0.0.1', 'libvirt')]
+    ipa_box, master_box = installed
+    assert master_box.size >= 8192
+    # hard linked image takes no space of its own, but is listed
+    assert len(master_box.images) == 1
+    assert master_box.total_size == master_box.size
+    assert ipa_box.total_size >= 2 * 4096
+
+    assert scan_boxes(str(tmpdir.join('missing')), str(images_dir)) == []
+
+
+def test_box_prefetch(tmpdir, monkeypatch):
+    box = b'not really a box' * 1024
+    catalog = {'name': 'freeipa/ci-master-f40', 'versions': [{
+        'version': '0.0.1', 'providers': [{
+            'name': 'libvirt', 'url': None, 'checksum_type': 'sha256',
+            'checksum': hashlib.sha256(box).hexdigest()}]}]}
+    server_dir = tmpdir.mkdir('server')
+    server_dir.join('ci-master-f40.box').write_binary(box)
+
+    # local HTTP server standing in for the box catalog
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler,
+                                directory=str(server_dir))
+    server = http.server.HTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server_url = 'http://127.0.0.1:{}'.format(server.server_port)
+    catalog['versions'][0]['providers'][0]['url'] = (
+        server_url + '/ci-master-f40.box')
+    server_dir.join('freeipa', 'ci-master-f40').write(
+        json.dumps(catalog), ensure=True)
+    monkeypatch.setenv('VAGRANT_SERVER_URL', server_url)
+
+    added = []
+    prefetcher = box_prefetch.BoxPrefetcher(
+        2**40, download_dir=str(tmpdir.join('prefetch')))
+    monkeypatch.setattr(prefetcher, 'add',
+                        lambda box, path: added.append(
+                            (box.key, open(path, 'rb').read())))
+    try:
+        # partial download is completed
+        tmpdir.join('prefetch', 'freeipa-VAGRANTSLASH-ci-master-f40_0.0.1_'
+                    'libvirt.box').write_binary(box[:100], ensure=True)
+        prefetcher.prefetch('freeipa/ci-master-f40', '0.0.1')
+        assert added == [(('freeipa/ci-master-f40', '0.0.1', 'libvirt'), box)]
+
+        with pytest.raises(ValueError):
+            prefetcher.prefetch('freeipa/ci-master-f40', '0.0.2')
+
+        # corrupted download is discarded
+        catalog['versions'][0]['providers'][0]['checksum'] = '0' * 64
+        server_dir.join('freeipa', 'ci-master-f40').write(json.dumps(catalog))
+        with pytest.raises(ValueError):
+            prefetcher.prefetch('freeipa/ci-master-f40', '0.0.1')
+        assert tmpdir.join('prefetch').listdir() == []
+
+        # nothing is downloaded over the budget
+        prefetcher.budget = len(box) // 2
+        prefetcher.prefetch('freeipa/ci-master-f40', '0.0.1')
+        assert len(added) == 1 and tmpdir.join('prefetch').listdir() == []
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_box_prefetch_job_download(monkeypatch):
+    monkeypatch.setattr(VagrantBox, 'exists', lambda self: False)
+    prefetcher = box_prefetch.BoxPrefetcher(2**40)
+    key = ('freeipa/ci-master-f40', '0.0.1')
+    prefetcher.want(*key)
+    # a job started downloading the box before the prefetcher picked it
+    prefetcher.begin_download(*key)
+    assert prefetcher.next_box() is None
+    prefetcher.want(*key)
+    assert prefetcher.next_box() is None
+    prefetcher.end_download(*key)
+    prefetcher.want(*key)
+    assert prefetcher.next_box() == key
+
+
+def render_vagrantfile(name, scratch_pool=None):
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(constants.TEMPLATES_DIR))
+    return env.get_template(constants.VAGRANTFILE_TEMPLATE.format(
+        vagrantfile_name=name)).render(
+            vagrant_template_name='freeipa/ci-master-f40',
+            vagrant_template_version='0.0.1',
+            scratch_pool=scratch_pool)
+
+
+def test_libvirt_driver(tmpdir):
+    machines = parse_vagrantfile(render_vagrantfile('master_1repl_1client'))
+    assert [(m.name, m.cpus, m.memory, m.primary) for m in machines] == [
+        ('controller', 1, 1250, True), ('master', 1, 2750, False),
+        ('replica0', 1, 2750, False), ('client0', 1, 1250, False)]
+    build = parse_vagrantfile(render_vagrantfile('build'))
+    assert [(m.name, m.cpus, m.memory, m.primary) for m in build] == [
+        ('builder', 2, 3800, True)]
+    # Windows machines need vagrant
+    assert parse_vagrantfile(render_vagrantfile('ad_master')) is None
+    assert {m.pool for m in machines} == {'default'}
+    ephemeral = parse_vagrantfile(
+        render_vagrantfile('master_1repl_1client', scratch_pool='scratch'))
+    assert {m.pool for m in ephemeral} == {'scratch'}
+
+    # the playbook paths are relative to the job directory
+    tmpdir.join('ansible').mksymlinkto(constants.ANSIBLE_PLAYBOOK_DIR)
+    data_dir = tmpdir.mkdir('jobs').mkdir('job')
+    driver = LibvirtDriver(machines, 'job_', str(data_dir), 'box.img')
+    for index, machine in enumerate(machines):
+        machine.address = '192.168.121.{}'.format(10 + index)
+    driver.write_inventory()
+    inventory = data_dir.join('.vagrant', 'provisioners', 'ansible',
+                              'inventory').read()
+    assert "master ansible_host=192.168.121.11 " in inventory
+    assert driver.provision_commands() == [[
+        'ansible-playbook',
+        '--inventory-file={}'.format(driver.inventory_path),
+        '--limit=all', '--extra-vars=@vars.yml',
+        '../../ansible/provision.yml']]
+    # provision.yml is run pipelined
+    provisioner = driver.phased_provisioner()
+    assert provisioner is machines[0]
+    assert driver.playbook_command(
+        provisioner, limit='master', tags='host', inventory='hosts') == [
+            'ansible-playbook', '--inventory-file=hosts', '--limit=master',
+            '--tags=host', '--extra-vars=@vars.yml',
+            '../../ansible/provision.yml']
+    assert driver.provision_commands(exclude=provisioner) == []
+    cmd = driver.ssh_command('ipa-run-tests')
+    assert cmd[0] == 'ssh' and cmd[-2:] == ['192.168.121.10', 'ipa-run-tests']
+
+
 def test_vagrant_box_download():
     path = os.path.dirname(os.path.realpath(__file__))
     task = VagrantBoxDownload(
@@ -73,3 +889,28 @@ def test_ansible_playbook():
 
     with pytest.raises(TaskException):
         AnsiblePlaybook()
+
+
+def test_tracer(tmpdir):
+    tracer = Tracer()
+    task = PopenTask(['ls', '/tmp/ag34feqfdafasdf'], raise_on_err=False)
+    task.tracer = tracer
+    task()
+
+    events = [(e['ph'], e['name']) for e in tracer.events]
+    assert events == [
+        ('B', 'Process "ls /tmp/ag34feqfdafasdf"'),
+        ('B', 'Process "ls /tmp/ag34feqfdafasdf" _before'),
+        ('E', 'Process "ls /tmp/ag34feqfdafasdf" _before'),
+        ('B', 'Process "ls /tmp/ag34feqfdafasdf" _run'),
+        ('E', 'Process "ls /tmp/ag34feqfdafasdf" _run'),
+        ('B', 'Process "ls /tmp/ag34feqfdafasdf" _after'),
+        ('E', 'Process "ls /tmp/ag34feqfdafasdf" _after'),
+        ('E', 'Process "ls /tmp/ag34feqfdafasdf"'),
+    ]
+    assert tracer.events[-1]['args']['returncode'] == 2
+    assert 'error' in tracer.events[-1]['args']
+
+    trace_file = tmpdir.join('trace.json')
+    tracer.dump(str(trace_file))
+    assert len(json.load(trace_file)['traceEvents']) == 8
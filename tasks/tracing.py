@@ -0,0 +1,75 @@
+"""
+Optional job tracing. Every traced task records its spans in the Trace Event
+Format, so the resulting file can be opened in chrome://tracing or
+https://ui.perfetto.dev to see where the time of a job went.
+
+Spans are recorded as begin/end pairs. That way a trace dumped while the job
+is still running (e.g. right before the artifacts are uploaded) is still
+valid; unfinished spans are simply drawn until the end of the trace.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+    def __init__(self, events=None, lock=None, tid=1):
+        self.events = [] if events is None else events
+        self.lock = threading.Lock() if lock is None else lock
+        self.pid = os.getpid()
+        self.tid = tid
+
+    def lane(self, tid):
+        """
+        Return a tracer sharing the events with this one, whose spans are
+        drawn on a separate track. Use it for subtasks running in parallel.
+        """
+        return Tracer(events=self.events, lock=self.lock, tid=tid)
+
+    def _emit(self, phase, name, cat, args):
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': phase,
+            'ts': int(time.time() * 1e6),
+            'pid': self.pid,
+            'tid': self.tid,
+        }
+        if phase == 'i':
+            event['s'] = 't'
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def begin(self, name, cat='task', **args):
+        self._emit('B', name, cat, args)
+
+    def end(self, name, cat='task', **args):
+        self._emit('E', name, cat, args)
+
+    def instant(self, name, cat='task', **args):
+        self._emit('i', name, cat, args)
+
+    @contextlib.contextmanager
+    def span(self, name, cat='task', **args):
+        """
+        Record a span around the block. The yielded dict can be filled with
+        arguments which are attached to the end of the span.
+        """
+        end_args = {}
+        self.begin(name, cat, **args)
+        try:
+            yield end_args
+        finally:
+            self.end(name, cat, **end_args)
+
+    def dump(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as trace_file:
+            json.dump(
+                {'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
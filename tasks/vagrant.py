@@ -1,33 +1,61 @@
 import logging
 import os
-import re
 import subprocess
 import time
-from datetime import datetime, timedelta
-
-import yaml
 
 import tasks
 
 from . import constants
-from .common import FallibleTask, PopenTask, TaskException, PopenException
+from .box_eviction import evict_boxes
+from .box_inventory import scan_boxes
+from .common import (FallibleTask, PopenTask, TaskException, PopenException,
+                     FatalOutputException, OutputClassifier)
+from .checkpoint import CreateCheckpoint, RestoreCheckpoint
+from .libvirt import (DOMAIN_REAPER, ApplyTopologyLimits,
+                      CollectResourceUsage)
+from .libvirt_driver import (DirectUp, DirectProvision, DirectReload,
+                             DirectDestroy)
 
 
 def with_vagrant(func):
     def wrapper(self, *args, **kwargs):
+        start = time.time()
         try:
             __setup_provision(self)
+            self.after_provision()
         except TaskException as exc:
             logging.critical('vagrant or provisioning failed')
             raise exc
         else:
-            if __check_for_reboot(self):
-                self.execute_subtask(VagrantReload())
+            if __check_for_reboot(self) and not self.restored:
+                if self.driver is not None:
+                    self.execute_subtask(DirectReload(self.driver))
+                else:
+                    self.execute_subtask(VagrantReload())
+            __create_checkpoint(self)
+            self.phase_durations['provision'] = time.time() - start
+            start = time.time()
             func(self, *args, **kwargs)
+            self.phase_durations['tests'] = time.time() - start
         finally:
-            if not self.no_destroy:
+            # the domain prefix covers the VMs of the other shards too
+            self.execute_subtask(
+                CollectResourceUsage(
+                    domain_prefix=self.domain_prefix,
+                    data_dir=self.data_dir,
+                    cpu=self.topology_cpu and self.topology_cpu * self.shards,
+                    memory=(self.topology_memory and
+                            self.topology_memory * self.shards),
+                    raise_on_err=False))
+            if not self.no_destroy and self.driver is not None:
+                self.execute_subtask(
+                    DirectDestroy(self.driver, raise_on_err=False))
+            elif not self.no_destroy:
                 self.execute_subtask(
-                    VagrantCleanup(raise_on_err=False))
+                    VagrantCleanup(domain_prefix=self.domain_prefix,
+                                   data_dir=self.data_dir,
+                                   raise_on_err=False))
+            self.vms_destroyed = True
 
     return wrapper
 
@@ -37,21 +65,54 @@ def __check_for_reboot(task):
     return os.path.exists(os.path.join(task.data_dir, "REBOOT_READY"))
 
 
-def __setup_provision(task):
+def __create_checkpoint(task):
+    if task.checkpoint_key is None or task.restored:
+        return
+    task.execute_subtask(
+        CreateCheckpoint(
+            key=task.checkpoint_key,
+            domain_prefix=task.domain_prefix,
+            data_dir=task.data_dir,
+            timeout=constants.CHECKPOINT_TIMEOUT,
+            raise_on_err=False))
+
+
+def __restore_checkpoint(task):
     """
-    This tries to execute the provision twice due to
-    problems described in issue #20
+    Bring up the machines from a checkpoint of a previous run of the task,
+    return True on success
     """
-    if task.action_name == 'ad':
-        vagrant_up_retries = 2
-        vagrant_provision_retries = 3
-        provision_delay = 120
-    else:
-        vagrant_up_retries = 0
-        vagrant_provision_retries = 1
-        provision_delay = 0
-    retry_delay = 10
-
+    if task.checkpoint_key is None or task.warm:
+        return False
+    restore = RestoreCheckpoint(
+        key=task.checkpoint_key,
+        domain_prefix=task.domain_prefix,
+        data_dir=task.data_dir,
+        timeout=constants.CHECKPOINT_TIMEOUT)
+    if not restore.exists():
+        return False
+
+    try:
+        task.execute_subtask(
+            VagrantBoxDownload(
+                box_name=task.template_name,
+                box_version=task.template_version,
+                link_image=task.link_image,
+                timeout=None))
+        task.execute_subtask(restore)
+        task.execute_subtask(VagrantUp(timeout=None))
+        restore.verify_addresses()
+    except TaskException as exc:
+        logging.warning(
+            "Failed to restore checkpoint, provisioning from scratch: %s",
+            exc)
+        restore.discard()
+        return False
+    task.restored = True
+    return True
+
+
+def __bring_up(task, vagrant_up_retries, retry_delay):
     task.execute_subtask(
         VagrantBoxDownload(
             box_name=task.template_name,
@@ -59,11 +120,18 @@ def __setup_provision(task):
             link_image=task.link_image,
             timeout=None))
 
+    if task.driver is not None:
+        task.execute_subtask(DirectUp(task.driver, timeout=None))
+        return
+
     while True:
         try:
             task.execute_subtask(
                 VagrantUp(timeout=None))
             break
+        except FatalOutputException:
+            # retrying wouldn't help
+            raise
         except PopenException as exc:
             if exc.task.returncode == -15:  # SIGTERM
                 raise
@@ -71,18 +139,62 @@ def __setup_provision(task):
                 logging.info(
                     "Retrying to bring the machine up, %s retries left",
                     vagrant_up_retries)
+                task.trace_event('retry VagrantUp',
+                                 retries_left=vagrant_up_retries)
                 vagrant_up_retries -= 1
                 time.sleep(retry_delay)
             else:
                 raise
-    if provision_delay:
+
+
+def __setup_provision(task):
+    """
+    This tries to execute the provision twice due to
+    problems described in issue #20
+    """
+    if task.action_name == 'ad':
+        vagrant_up_retries = 2
+        vagrant_provision_retries = 3
+        provision_delay = 120
+    else:
+        vagrant_up_retries = 0
+        vagrant_provision_retries = 1
+        provision_delay = 0
+    retry_delay = 10
+
+    if __restore_checkpoint(task):
+        logging.info("Machines were restored from a checkpoint.")
+    elif task.warm:
+        logging.info("Machines were brought up by the warm pool.")
+    else:
+        __bring_up(task, vagrant_up_retries, retry_delay)
+    if tasks.ENFORCE_TOPOLOGY_LIMITS:
+        task.execute_subtask(
+            ApplyTopologyLimits(
+                domain_prefix=task.domain_prefix,
+                cpu=task.topology_cpu,
+                memory=task.topology_memory,
+                hard_memory_limit=tasks.TOPOLOGY_MEMORY_HARD_LIMIT,
+                raise_on_err=False))
+    task.before_provision()
+    if task.restored:
+        # the checkpoint was taken after provisioning
+        return
+    if provision_delay and not task.warm:
         logging.info("Waiting %s seconds before continuing to provision.",
                      provision_delay)
         time.sleep(provision_delay)
+    if task.driver is not None:
+        task.execute_subtask(DirectProvision(task.driver, timeout=None))
+        return
+
     while True:
         try:
             task.execute_subtask(VagrantProvision(timeout=None))
             break
+        except FatalOutputException:
+            # retrying wouldn't help
+            raise
         except PopenException as exc:
             if exc.task.returncode == -15:  # SIGTERM
                 raise
@@ -90,6 +202,8 @@ def __setup_provision(task):
                 logging.info(
                     "Retrying provisioning, %s retries left" %
                     vagrant_provision_retries)
+                task.trace_event('retry VagrantProvision',
+                                 retries_left=vagrant_provision_retries)
                 vagrant_provision_retries -= 1
                 time.sleep(retry_delay)
             else:
@@ -106,14 +220,14 @@ class VagrantUp(VagrantTask):
     def _run(self):
         self.execute_subtask(
             PopenTask(['vagrant', 'up', '--no-provision', '--parallel'],
-                      timeout=None))
+                      classifier=OutputClassifier(), timeout=None))
 
 
 class VagrantProvision(VagrantTask):
     def _run(self):
         self.execute_subtask(
             PopenTask(['vagrant', 'provision'],
-                      timeout=None))
+                      classifier=OutputClassifier(), timeout=None))
 
 
 class VagrantReload(VagrantTask):
@@ -121,15 +235,30 @@ class VagrantReload(VagrantTask):
         logging.info("Reloading vagrant machines.")
         self.execute_subtask(
             PopenTask(['vagrant', 'reload'],
-                      timeout=None)
+                      classifier=OutputClassifier(), timeout=None)
         )
 
 
 class VagrantCleanup(VagrantTask):
+    """
+    Tear down the job's domains directly, vagrant destroys them one by one.
+    vagrant then only forgets the machines, in the background like the
+    removal of the disks.
+    """
+    def __init__(self, domain_prefix, data_dir, **kwargs):
+        super(VagrantCleanup, self).__init__(**kwargs)
+        self.domain_prefix = domain_prefix
+        self.data_dir = data_dir
+
+    def forget_machines(self):
+        subprocess.run(
+            ["vagrant", "destroy", "--force"],
+            env=dict(os.environ, VAGRANT_CWD=self.data_dir),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
     def _run(self):
         logging.info("Destroying vagrant machines.")
-        self.execute_subtask(
-            PopenTask(["vagrant", "destroy", "--force"], raise_on_err=False))
+        DOMAIN_REAPER.reap(self.domain_prefix, cleanup=self.forget_machines)
 
 
 class VagrantBoxDownload(VagrantTask):
@@ -145,10 +274,23 @@ class VagrantBoxDownload(VagrantTask):
     def _run(self):
         self.box.update_latest_use()
 
+        if tasks.BOX_PREFETCHER is None:
+            self.download()
+            return
+        # don't download the box the prefetcher is downloading, nor the
+        # other way round
+        tasks.BOX_PREFETCHER.begin_download(self.box.name, self.box.version)
+        try:
+            self.download()
+        finally:
+            tasks.BOX_PREFETCHER.end_download(self.box.name, self.box.version)
+
+    def download(self):
         if not self.box.exists():
-            # If necessary delete oldest box to save space before downloading a
-            # new one
-            VagrantBox.delete_oldest_box()
+            # If necessary evict boxes to make space before downloading a new
+            # one
+            evict_boxes(self.box.name, self.box.version,
+                        quota=tasks.BOX_DISK_QUOTA)
 
             try:
                 self.execute_subtask(
@@ -156,10 +298,12 @@ class VagrantBoxDownload(VagrantTask):
                         'vagrant', 'box', 'add', self.box.name,
                         '--box-version', self.box.version,
                         '--provider', self.box.provider],
-                        timeout=None))
+                        classifier=OutputClassifier(), timeout=None))
             except TaskException as exc:
                 logging.error('Box download failed')
                 raise exc
+            if tasks.BOX_INVENTORY is not None:
+                tasks.BOX_INVENTORY.set_size(*self.box.key, self.box.size())
 
         # link box to libvirt
         if self.link_image and not self.box.libvirt_exists():
@@ -207,69 +351,31 @@ class VagrantBox(object):
             version=self.version)
 
     @property
-    def last_time_used(self):
-        box_key = '{name}_{version}_{provider}'.format(
-            name=self.name, version=self.version, provider=self.provider)
-        with open(tasks.BOX_STATS_FILE, 'r') as stats_file:
-            stats = yaml.safe_load(stats_file)
-            if not stats:
-                stats = {}
-
-        return stats.get(box_key, None)
-
-    @staticmethod
-    def delete_oldest_box():
-        def clean_last_time_used(box):
-            '''Return "yesterday" for boxes previously installed in the system.
-            '''
-            if box.last_time_used:
-                return box.last_time_used
-            return datetime.now() - timedelta(days=1)
-
-        all_boxes = sorted(
-            VagrantBox.installed_boxes(), key=clean_last_time_used)
+    def key(self):
+        return (self.name, self.version, self.provider)
 
-        # Do not delete Windows boxes
-        linux_boxes = [x for x in all_boxes if 'windows' not in x.name]
-
-        # Keep only the latest 2 boxes
-        for box in linux_boxes[:-2]:
-            box.delete_box()
+    @property
+    def last_time_used(self):
+        if tasks.BOX_INVENTORY is None:
+            return None
+        return tasks.BOX_INVENTORY.last_used(*self.key)
 
     @staticmethod
     def installed_boxes():
-        output = subprocess.check_output(
-            ['vagrant', 'box', 'list'], timeout=2000)
-
-        if 'There are no installed boxes!' in output.decode():
-            return []
-
-        all_boxes = []
-        for box_data in output.decode().strip().split('\n'):
-            matches = re.search(
-                r'(?P<name>[\/\w-]+)\s+\((?P<provider>[\w-]+)\,\s(?P<version>[\w.]+)\)',  # noqa
-                output.decode(),
-            )
-            box = VagrantBox(
-                name=matches.group('name'),
-                version=matches.group('version'),
-                provider=matches.group('provider'),
-            )
-            all_boxes.append(box)
-
-        return all_boxes
+        return [VagrantBox(box.name, box.version, box.provider)
+                for box in scan_boxes()]
 
     def update_latest_use(self):
-        box_key = '{name}_{version}_{provider}'.format(
-            name=self.name, version=self.version, provider=self.provider)
-        with open(tasks.BOX_STATS_FILE, 'r+') as stats_file:
-            stats = yaml.safe_load(stats_file)
-            if not stats:
-                stats = {}
+        if tasks.BOX_INVENTORY is None:
+            return
+        tasks.BOX_INVENTORY.record_use(*self.key, size=self.size())
 
-        stats[box_key] = datetime.now()
-        with open(tasks.BOX_STATS_FILE, 'w+') as stats_file:
-            yaml.dump(stats, stats_file)
+    def size(self):
+        """Size of the box image in bytes, None if not downloaded"""
+        try:
+            return os.path.getsize(self.vagrant_path)
+        except OSError:
+            return None
 
     def exists(self):
         return os.path.exists(self.vagrant_path)
@@ -285,3 +391,6 @@ class VagrantBox(object):
 
         subprocess.run(
             ['virsh', 'vol-delete', self.libvirt_path], timeout=2000)
+
+        if tasks.BOX_INVENTORY is not None:
+            tasks.BOX_INVENTORY.remove(*self.key)
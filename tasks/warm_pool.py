@@ -0,0 +1,252 @@
+"""
+Warm pool of booted VMs, so a job can skip downloading the box and booting
+its topology and go straight to provisioning.
+
+The pool boots VMs for the (template, Vagrantfile) pairs most used by recent
+jobs, within the resources the runner has left. Every pool entry is prepared
+as a job directory (jobs/<uuid>); the job claiming it adopts its UUID, so the
+names of the libvirt domains, the vagrant state and the synced folders of the
+VMs stay valid. Entries which are no longer wanted or don't fit into the
+resources left by running jobs are destroyed.
+
+VMs in the pool are only booted: provisioning installs the RPMs of the build
+the job tests, so it's left to the job.
+"""
+
+import collections
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+from . import constants
+from .box_eviction import BOX_USAGE
+from .common import (PopenTask, OutputClassifier, TaskException,
+                     create_file_from_template)
+from .vagrant import VagrantBoxDownload
+
+
+class PoolEntry(object):
+    def __init__(self, key, cpu, memory):
+        self.uuid = str(uuid.uuid1())
+        self.key = key
+        self.cpu = cpu
+        self.memory = memory
+        self.ready = False
+        # vagrant up of the entry while it's being booted
+        self.task = None
+
+    @property
+    def path(self):
+        return os.path.join(constants.JOBS_DIR, self.uuid)
+
+    @property
+    def env(self):
+        return {'VAGRANT_CWD': self.path}
+
+    def __str__(self):
+        return 'pool entry {uuid} ({vagrantfile} {name} {version})'.format(
+            uuid=self.uuid, name=self.key[0], version=self.key[1],
+            vagrantfile=os.path.basename(self.key[2]))
+
+
+class WarmPool(object):
+    def __init__(self, size, budget, history=constants.WARM_POOL_HISTORY):
+        """
+        size: maximum number of entries in the pool
+        budget: callable returning the CPUs and memory (MB) the runner has
+                left after the running jobs took theirs
+        history: number of recent jobs the demand is computed from
+        """
+        self.size = size
+        self.budget = budget
+        self.entries = []
+        self.demand = collections.deque(maxlen=history)
+        self.resources = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.done = False
+        self.thread = None
+        # entry being booted, in a thread of its own so that the pool keeps
+        # fitting its budget meanwhile
+        self.booting = None
+        self.boot_thread = None
+        # set while the runner starts a job which may claim an entry: its
+        # resources are already taken from the budget
+        self.expecting_claim = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.done = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.boot_thread is not None:
+            booting = self.booting
+            if booting is not None and booting.task is not None:
+                booting.task.terminate()
+            self.boot_thread.join()
+        for entry in list(self.entries):
+            self.destroy(entry)
+
+    def run(self):
+        while not self.done:
+            try:
+                self.fit()
+                self.refill()
+            except Exception as exc:
+                logging.error('Warm pool maintenance failed: %s', exc)
+                logging.debug(exc, exc_info=True)
+            self.wakeup.wait(constants.WARM_POOL_INTERVAL)
+            self.wakeup.clear()
+
+    def claim(self, key, cpu, memory):
+        """
+        Take a ready entry of the key out of the pool and return its UUID,
+        None if there is no such entry. Records the demand for the key.
+        """
+        with self.lock:
+            self.demand.append(key)
+            self.resources[key] = (cpu or 0, memory or 0)
+            for entry in self.entries:
+                if entry.ready and entry.key == key:
+                    self.entries.remove(entry)
+                    BOX_USAGE.release(*key[:2])
+                    break
+            else:
+                entry = None
+        # resources of the claimed entry now belong to the job, make the
+        # rest of the pool fit again
+        self.notify()
+        if entry is None:
+            return None
+        logging.info('Claimed {entry}'.format(entry=entry))
+        return entry.uuid
+
+    def notify(self):
+        """Make the pool fit its budget again right away"""
+        self.wakeup.set()
+
+    def expect_claim(self):
+        """
+        Keep every entry until end_claim, the runner is about to take the
+        resources of a job which may claim one of them
+        """
+        with self.lock:
+            self.expecting_claim = True
+
+    def end_claim(self):
+        """The job claimed its entry or won't claim any"""
+        with self.lock:
+            self.expecting_claim = False
+        self.notify()
+
+    def wanted(self):
+        """Keys the pool should have entries of, most demanded first"""
+        with self.lock:
+            counts = collections.Counter(self.demand)
+        return [key for key, _count in counts.most_common(self.size)]
+
+    def usage(self):
+        with self.lock:
+            return (sum(entry.cpu for entry in self.entries),
+                    sum(entry.memory for entry in self.entries))
+
+    def fit(self):
+        """Destroy entries not wanted anymore or not fitting the budget"""
+        wanted = self.wanted()
+        with self.lock:
+            if self.expecting_claim:
+                # the entry the job claims would be counted twice
+                return
+            idle = sorted(
+                (entry for entry in self.entries if entry.ready),
+                key=lambda entry: (entry.key in wanted, -entry.cpu))
+        cpu, memory = self.budget()
+        used_cpu, used_memory = self.usage()
+        for entry in idle:
+            if entry.key in wanted and used_cpu <= cpu and \
+                    used_memory <= memory:
+                break
+            used_cpu -= entry.cpu
+            used_memory -= entry.memory
+            self.destroy(entry)
+
+    def refill(self):
+        """
+        Start booting an entry for the most demanded key which has none,
+        unless an entry is already being booted
+        """
+        if self.boot_thread is not None and self.boot_thread.is_alive():
+            return
+        with self.lock:
+            present = {entry.key for entry in self.entries}
+        cpu, memory = self.budget()
+        used_cpu, used_memory = self.usage()
+        for key in self.wanted():
+            if key in present or self.done:
+                continue
+            need_cpu, need_memory = self.resources[key]
+            if (used_cpu + need_cpu > cpu or
+                    used_memory + need_memory > memory):
+                continue
+            entry = PoolEntry(key, need_cpu, need_memory)
+            with self.lock:
+                self.entries.append(entry)
+            # the box of the entry's VMs must not be evicted
+            BOX_USAGE.hold(*key[:2])
+            self.booting = entry
+            self.boot_thread = threading.Thread(
+                target=self.boot, args=(entry,), daemon=True)
+            self.boot_thread.start()
+            return
+
+    def boot(self, entry):
+        template_name, template_version, vagrantfile = entry.key
+        logging.info('Booting {entry}'.format(entry=entry))
+        try:
+            os.makedirs(entry.path)
+            shutil.copy(constants.ANSIBLE_CFG_FILE, entry.path)
+            create_file_from_template(
+                vagrantfile,
+                os.path.join(entry.path, 'Vagrantfile'),
+                dict(vagrant_template_name=template_name,
+                     vagrant_template_version=template_version))
+            VagrantBoxDownload(
+                box_name=template_name,
+                box_version=template_version,
+                timeout=None)()
+            entry.task = PopenTask(
+                ['vagrant', 'up', '--no-provision', '--parallel'],
+                env=entry.env, classifier=OutputClassifier(),
+                timeout=constants.WARM_POOL_BOOT_TIMEOUT)
+            if self.done:
+                raise TaskException(entry.task, 'runner is stopping')
+            entry.task()
+        except (TaskException, OSError, IOError) as exc:
+            logging.warning('Failed to boot {entry}: {exc}'.format(
+                entry=entry, exc=exc))
+            self.destroy(entry)
+            return
+        finally:
+            entry.task = None
+            self.booting = None
+        entry.ready = True
+        logging.info('{entry} is ready'.format(entry=entry))
+
+    def destroy(self, entry):
+        with self.lock:
+            if entry not in self.entries:
+                # claimed meanwhile, the VMs and directory are the job's now
+                return
+            self.entries.remove(entry)
+            BOX_USAGE.release(*entry.key[:2])
+        logging.info('Destroying {entry}'.format(entry=entry))
+        if os.path.exists(os.path.join(entry.path, 'Vagrantfile')):
+            PopenTask(['vagrant', 'destroy', '--force'], env=entry.env,
+                      raise_on_err=False)()
+        shutil.rmtree(entry.path, ignore_errors=True)